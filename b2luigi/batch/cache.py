@@ -1,9 +1,11 @@
-from cachetools import TTLCache
-
 import abc
+import threading
+import time
+
+from b2luigi.batch.limiter import get_limiter
 
 
-class BatchJobStatusCache(abc.ABC, TTLCache):
+class BatchJobStatusCache(abc.ABC):
     """
     Abstract base class for job status caches.
     Useful if the batch system provides the status of all jobs
@@ -15,23 +17,177 @@ class BatchJobStatusCache(abc.ABC, TTLCache):
     specified or for all accessible jobs (e.g. for all of this user).
     Having too much information (e.g. information on jobs
     which are not started by this b2luigi instance) does not matter.
+
+    Entries are valid for ``ttl`` seconds. The cache has no maximal size, so it
+    grows with the number of jobs in flight; outdated entries are dropped whenever the status
+    of all jobs is asked for.
+    If a job is not known (or outdated), the status of all jobs is asked for, but at most once per
+    ``ttl`` seconds: concurrent requests (e.g. from multiple threads) wait for the same query
+    instead of starting their own. Only if the job is still not known afterwards (and the query
+    for all jobs does not cover it, see :obj:`_is_covered_by_full_refresh`), it is asked for specifically.
+
+    The cache is thread safe. The number of cache hits and misses and of the queries
+    to the batch system are available via :obj:`statistics`.
+
+    If ``limiter_name`` is set, the time needed to ask for all jobs (and errors) is reported to the
+    submission limiter of this batch system (see :obj:`b2luigi.batch.limiter.get_limiter`), so that
+    fewer jobs are submitted while the batch system is slow.
     """
-    def __init__(self):
-        super(BatchJobStatusCache, self).__init__(maxsize=1000, ttl=20)
+    #: Name of the submission limiter to report the query times to (the name of the batch process class)
+    limiter_name = None
+
+    def __init__(self, ttl=20):
+        self.ttl = ttl
+
+        self._job_status = {}
+        self._lock = threading.Condition()
+
+        self._last_full_refresh = None
+        self._full_refresh_running = False
+
+        self._statistics = dict(hits=0, misses=0, full_refreshes=0, job_refreshes=0)
 
     @abc.abstractmethod
     def _ask_for_job_status(self, job_id=None):
         pass
 
+    @property
+    def statistics(self):
+        """
+        Dictionary with the number of ``hits`` and ``misses`` of the cache
+        and the number of queries for all jobs (``full_refreshes``) and for single jobs (``job_refreshes``).
+        """
+        with self._lock:
+            return dict(self._statistics)
+
+    def __setitem__(self, job_id, job_status):
+        with self._lock:
+            self._job_status[job_id] = (job_status, time.monotonic())
+
+    def __getitem__(self, job_id):
+        with self._lock:
+            try:
+                job_status = self._get_valid(job_id)
+                self._statistics["hits"] += 1
+                return job_status
+            except KeyError:
+                self._statistics["misses"] += 1
+
+        return self.__missing__(job_id)
+
+    def __contains__(self, job_id):
+        with self._lock:
+            try:
+                self._get_valid(job_id)
+                return True
+            except KeyError:
+                return False
+
+    def __len__(self):
+        with self._lock:
+            return len(self._job_status)
+
+    def __delitem__(self, job_id):
+        with self._lock:
+            del self._job_status[job_id]
+
+    def get(self, job_id, default=None):
+        try:
+            return self[job_id]
+        except KeyError:
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._job_status.clear()
+            self._last_full_refresh = None
+
+    def refresh_job(self, job_id):
+        """
+        Ask the batch system for the given job (without looking into the cache first)
+        and return its status. Raises a KeyError if the job can not be found.
+        """
+        with self._lock:
+            self._statistics["job_refreshes"] += 1
+
+        self._ask_for_job_status(job_id=job_id)
+        with self._lock:
+            return self._get_valid(job_id)
+
+    def _is_covered_by_full_refresh(self, job_id):
+        """
+        Override this function to return True, if asking for all jobs already looks everywhere the given job
+        could be found. Such jobs are not asked for specifically, if they are missing: asking again
+        would not give a different answer before the next query for all jobs.
+        The default implementation returns False.
+        """
+        return False
+
     def __missing__(self, job_id):
         # First, ask for all jobs
-        self._ask_for_job_status(job_id=None)
-        if job_id in self:
-            return self[job_id]
+        self._refresh_all()
+        with self._lock:
+            try:
+                return self._get_valid(job_id)
+            except KeyError:
+                if self._is_covered_by_full_refresh(job_id):
+                    raise
+                self._statistics["job_refreshes"] += 1
 
         # Then, ask specifically for this job
         self._ask_for_job_status(job_id=job_id)
-        if job_id in self:
-            return self[job_id]
+        with self._lock:
+            return self._get_valid(job_id)
+
+    def _refresh_all(self):
+        with self._lock:
+            # Somebody else is already asking, so just wait for the result
+            if self._full_refresh_running:
+                while self._full_refresh_running:
+                    self._lock.wait()
+                return
+
+            if self._last_full_refresh is not None and time.monotonic() - self._last_full_refresh < self.ttl:
+                return
+
+            self._full_refresh_running = True
+            self._statistics["full_refreshes"] += 1
+
+        start_time = time.monotonic()
+        try:
+            self._ask_for_job_status(job_id=None)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                self._record_query(start_time, error=True)
+            with self._lock:
+                self._full_refresh_running = False
+                self._lock.notify_all()
+            raise
+
+        self._record_query(start_time)
+
+        with self._lock:
+            self._full_refresh_running = False
+            self._last_full_refresh = start_time
+            self._drop_outdated()
+            self._lock.notify_all()
+
+    def _record_query(self, start_time, error=False):
+        if self.limiter_name is None:
+            return
+
+        limiter = get_limiter(self.limiter_name)
+        if limiter is not None:
+            limiter.record(time.monotonic() - start_time, error=error)
+
+    def _get_valid(self, job_id):
+        job_status, timestamp = self._job_status[job_id]
+        if time.monotonic() - timestamp > self.ttl:
+            raise KeyError(job_id)
+        return job_status
 
-        raise KeyError
+    def _drop_outdated(self):
+        now = time.monotonic()
+        outdated_job_ids = [job_id for job_id, (_, timestamp) in self._job_status.items() if now - timestamp > self.ttl]
+        for job_id in outdated_job_ids:
+            del self._job_status[job_id]
@@ -0,0 +1,109 @@
+import threading
+import time
+
+from b2luigi.core.settings import get_setting
+
+
+class SubmissionLimiter:
+    """
+    Adaptive limit on the submission rate and the number of jobs in flight (queued or running)
+    for a single batch system.
+
+    Submitting thousands of jobs at once (or asking for their status too often) can overload
+    the scheduler of the batch system, which then answers slowly or not at all.
+    The limiter adapts to the observed response times with an AIMD
+    (additive increase, multiplicative decrease) scheme: every answer faster than ``target_latency``
+    raises the allowed submission rate and number of jobs in flight by a small step (up to ``max_rate``
+    and ``max_in_flight``), every slow answer or error halves them.
+
+    The limiter never blocks: :obj:`try_acquire` tells whether another job may be submitted now.
+    Every successful call needs a matching :obj:`release` as soon as the job is finished.
+    Use the ``batch_limits`` setting to turn it on, see :obj:`get_limiter`.
+    """
+    #: Lowest submission rate (in jobs per second) the limiter goes down to
+    min_rate = 0.1
+    #: Minimal time (in seconds) between two decreases, so that a burst of errors is only counted once
+    decrease_interval = 1
+
+    def __init__(self, max_rate=20, max_in_flight=5000, target_latency=10):
+        self.max_rate = max_rate
+        self.max_in_flight = max_in_flight
+        self.target_latency = target_latency
+
+        # Start carefully and let the limits grow while the batch system keeps up
+        self.rate = max(self.min_rate, max_rate / 10)
+        self.in_flight_limit = max(1, max_in_flight // 10)
+        self.in_flight = 0
+
+        self._lock = threading.Lock()
+        self._tokens = max(1, self.rate)
+        self._last_refill = time.monotonic()
+        self._last_decrease = None
+
+    def try_acquire(self):
+        """Return True and count the job as in flight, if another job may be submitted right now."""
+        with self._lock:
+            self._refill()
+
+            if self.in_flight >= self.in_flight_limit or self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        """The job of an earlier successful :obj:`try_acquire` is finished (or was never submitted)."""
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+
+    def record(self, latency, error=False):
+        """Adapt the limits to a call to the batch system, which took ``latency`` seconds (or failed)."""
+        with self._lock:
+            if error or latency > self.target_latency:
+                now = time.monotonic()
+                if self._last_decrease is not None and now - self._last_decrease < self.decrease_interval:
+                    return
+
+                self._last_decrease = now
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.in_flight_limit = max(1, self.in_flight_limit // 2)
+                return
+
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+            self.in_flight_limit = min(self.max_in_flight, self.in_flight_limit + max(1, self.max_in_flight // 20))
+
+    def _refill(self):
+        now = time.monotonic()
+        # Allow a burst of at most one second worth of submissions
+        self._tokens = min(max(1, self.rate), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+
+# Limiters of all batch systems, keyed by the name of the batch process class
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """
+    Return the :obj:`SubmissionLimiter` of the batch system with the given name (the name
+    of its batch process class) or None, if the ``batch_limits`` setting is not turned on.
+    The upper limits are given by the settings ``batch_max_submission_rate`` (default 20 jobs per second),
+    ``batch_max_jobs_in_flight`` (default 5000) and ``batch_target_latency`` (default 10 seconds).
+    """
+    if not get_setting("batch_limits", default=False):
+        return None
+
+    with _limiters_lock:
+        try:
+            return _limiters[name]
+        except KeyError:
+            pass
+
+        limiter = SubmissionLimiter(max_rate=get_setting("batch_max_submission_rate", default=20),
+                                    max_in_flight=get_setting("batch_max_jobs_in_flight", default=5000),
+                                    target_latency=get_setting("batch_target_latency", default=10))
+        _limiters[name] = limiter
+
+        return limiter
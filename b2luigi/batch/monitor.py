@@ -0,0 +1,83 @@
+import sys
+import threading
+
+from b2luigi.core.settings import get_setting
+
+
+class JobMonitor:
+    """
+    Background thread checking the status of all running batch jobs on its own schedule.
+
+    Without the monitor, luigi asks every running batch process repeatedly if it is still alive,
+    which might block the scheduling loop for a long time whenever the job status needs to be queried
+    from the batch system (e.g. with ``condor_q`` or ``bjobs``).
+    With the monitor (turned on by the setting ``batch_job_monitor``), the processes are added after
+    their job was submitted and only the monitor thread calls ``get_job_status``.
+    Finished jobs are directly reported to luigi via the result queue, so ``is_alive``
+    only needs to look at the state in memory.
+
+    The status of all monitored jobs is checked every ``batch_job_monitor_interval`` seconds (default 10).
+    The thread is started with the first monitored process and stops when there is nothing left to monitor.
+    """
+    def __init__(self):
+        self._processes = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._wake_up = threading.Event()
+
+    def add(self, process):
+        with self._lock:
+            self._processes[id(process)] = process
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="b2luigi-job-monitor", daemon=True)
+                self._thread.start()
+
+    def remove(self, process):
+        with self._lock:
+            self._processes.pop(id(process), None)
+
+    def __contains__(self, process):
+        return id(process) in self._processes
+
+    def __len__(self):
+        return len(self._processes)
+
+    def check_now(self):
+        """Do not wait for the end of the current interval but check the job status right now."""
+        self._wake_up.set()
+
+    def _run(self):
+        interval = get_setting("batch_job_monitor_interval", default=10)
+
+        while True:
+            with self._lock:
+                processes = list(self._processes.values())
+
+                if not processes:
+                    self._thread = None
+                    return
+
+            for process in processes:
+                self._check_process(process)
+
+            self._wake_up.wait(interval)
+            self._wake_up.clear()
+
+    def _check_process(self, process):
+        # The process might have been terminated meanwhile
+        if process not in self:
+            return
+
+        try:
+            is_alive = process._check_job_status()
+        except Exception as e:
+            # Most probably a temporary problem of the batch system, so try again later
+            print(f"Could not check the job status of {process.task.task_id}: {e}", file=sys.stderr)
+            return
+
+        if not is_alive:
+            self.remove(process)
+
+
+_job_monitor = JobMonitor()
@@ -0,0 +1,35 @@
+import luigi
+
+from b2luigi.core.settings import get_setting
+from b2luigi.core.task import Task
+
+
+class PilotTask(Task):
+    """
+    Task run by a pilot job. Instead of doing any work itself, it starts a luigi worker
+    (see :obj:`b2luigi.batch.workers.PilotWorker`), which asks the central scheduler for any runnable task
+    and runs it directly in the pilot job, until there was nothing to do for ``pilot_idle_timeout`` seconds.
+    This way, the tasks do not need to wait in the queue of the batch system and the set up
+    of the environment is only done once per pilot.
+
+    The pilots are submitted by the scheduling b2luigi process if the setting ``batch_pilots`` is set
+    to the number of pilots (see :obj:`b2luigi.batch.workers.SendPilotWorker`).
+    Every pilot runs ``pilot_workers`` tasks at the same time (default 1).
+    """
+    task_namespace = "b2luigi"
+
+    pilot_number = luigi.IntParameter()
+    scheduler_host = luigi.Parameter(significant=False)
+    scheduler_port = luigi.IntParameter(significant=False)
+
+    def complete(self):
+        # A pilot is only started on purpose, so it is never done before
+        return False
+
+    def run(self):
+        from b2luigi.batch.workers import SendJobWorkerSchedulerFactory
+
+        # An assistant runs any runnable task known to the scheduler, not only its own ones
+        luigi.build([], scheduler_host=self.scheduler_host, scheduler_port=self.scheduler_port, assistant=True,
+                    workers=get_setting("pilot_workers", default=1),
+                    worker_scheduler_factory=SendJobWorkerSchedulerFactory(), log_level="INFO")
@@ -1,10 +1,20 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import socket
 import time
 import enum
 
 import luigi
 import luigi.scheduler
 
-from b2luigi.core.utils import on_failure
+from b2luigi.batch.limiter import get_limiter
+from b2luigi.batch.monitor import _job_monitor
+from b2luigi.core.executable import create_bundle_wrapper, create_executable_wrapper
+from b2luigi.core.settings import get_setting
+from b2luigi.core.utils import get_filename, get_job_status_file, get_task_file_dir, on_failure, read_job_status
 
 
 class JobStatus(enum.Enum):
@@ -12,6 +22,54 @@ class JobStatus(enum.Enum):
     successful = "successful"
     aborted = "aborted"
     idle = "idle"
+    unknown = "unknown"
+
+
+# Default identifier of this b2luigi session, created on first usage (see get_session_id)
+_default_session_id = None
+
+
+def get_session_id():
+    """
+    Return the identifier of this b2luigi session, which is used to tag the submitted batch jobs, so that
+    status queries only need to ask for our own jobs.
+    It can be set with the ``batch_session_id`` setting. By default, it is derived from the path of
+    the called script, the host, the process id and the start time, so every call of the script
+    (also at the same time) gets its own session. It stays the same during the whole run.
+    """
+    session_id = get_setting("batch_session_id", default=False)
+    if session_id:
+        return str(session_id)
+
+    global _default_session_id
+    if _default_session_id is None:
+        try:
+            script_path = os.path.abspath(get_filename())
+        except AttributeError:
+            script_path = os.getcwd()
+
+        session_name = f"{script_path}:{socket.gethostname()}:{os.getpid()}:{time.time()}"
+        _default_session_id = "b2luigi_" + hashlib.md5(session_name.encode()).hexdigest()[:12]
+
+    return _default_session_id
+
+
+# Processes waiting for their (bulk) submission, separately for each batch process class
+_pending_submissions = collections.defaultdict(list)
+
+# Processes waiting for the submission limiter (see b2luigi.batch.limiter), separately for each batch process class
+_throttled_processes = collections.defaultdict(collections.deque)
+
+# Thread pool for the submission in the background, created on first usage
+_submission_executor = None
+
+
+def _get_submission_executor(submission_threads):
+    global _submission_executor
+    if _submission_executor is None:
+        _submission_executor = concurrent.futures.ThreadPoolExecutor(max_workers=submission_threads,
+                                                                     thread_name_prefix="b2luigi-submission")
+    return _submission_executor
 
 
 class BatchProcess:
@@ -58,12 +116,78 @@ class BatchProcess:
         and ``get_log_file_dir`` to get the needed information.
 
         Checkout the implementation of the lsf task for some implementation example.
+
+        If many tasks get runnable at the same time, it might be faster to submit them
+        together (e.g. as a single job cluster) instead of one by one. If the setting ``bulk_submission_size``
+        is larger than 1, the processes are not started immediately but collected until either
+        this number is reached or luigi starts to ask for the status of the running jobs.
+        All collected processes are then handed to the class method ``start_jobs``, which
+        calls ``start_job`` for each of them by default. Batch systems supporting some form of
+        bulk submission can override it.
+
+        By default, the job status is checked whenever luigi asks if the process is still alive.
+        With the setting ``batch_job_monitor``, this is done in a background thread instead
+        (see :obj:`b2luigi.batch.monitor.JobMonitor`), so ``get_job_status`` might be called from
+        another thread than the other functions.
+
+        A batch worker writes the result of its task into the file ``job_status.json`` in the
+        task folder (see :obj:`b2luigi.core.utils.write_job_status`) when it is done.
+        This file is checked before ``get_job_status`` is called, so most finished jobs
+        are noticed without asking the batch system at all. Before the job is started, an already
+        existing file is removed.
+
+        The id of every submitted job (see :obj:`get_job_id`) is stored in the file ``batch_job.json`` in the
+        task folder. If the b2luigi process is restarted while the job is still queued or running,
+        it re-attaches to the job (see :obj:`reattach_job`) instead of submitting it again.
+        This can be turned off with the setting ``batch_reattach_jobs``.
+
+        Normally, the jobs are submitted one after the other in the main loop of luigi, so no finished
+        jobs are handled during the submission.
+        If the setting ``batch_submission_threads`` is larger than 0, the submission (including the creation
+        of the executable wrapper and all other files) is done in the background by a pool of that many threads.
+        While the job is submitted, the process is treated as running and the task shows the status message
+        "Submitting to the batch system" in the scheduler, until the job id is known.
+        In this case, ``start_job`` and ``start_jobs`` may be called from different threads at the same time.
+
+        With the setting ``batch_limits``, the submission rate and the number of jobs in flight are limited
+        separately for each batch system and adapted to the response time of the batch system
+        (see :obj:`b2luigi.batch.limiter.SubmissionLimiter`). Processes over the limit wait in a queue
+        (and are treated as running) until the next call to ``is_alive`` finds a free slot.
+
+        Many short tasks can be packed into a single batch job with the setting ``batch_bundle_size``.
+        Up to this number of tasks with the same ``batch_bundle`` setting (by default the task family) are
+        collected like for the bulk submission and only the first one of them (the leader) is handed to
+        ``start_job`` or ``start_jobs``. Its executable (see :obj:`create_executable_wrapper`) runs the tasks
+        of all processes in the bundle one after the other (or at the same time with the setting
+        ``batch_bundle_parallel``). Every task still reports its own result with the ``job_status.json`` file,
+        the status of the batch job is only used to find out when the bundle is finished.
+        Bundled jobs are not re-attached after a restart.
     """
     def __init__(self, task, scheduler, result_queue, worker_timeout):
         self.use_multiprocessing = False
         self.task = task
         self.timeout_time = time.time() + worker_timeout if worker_timeout else None
         self._terminated = False
+        self._job_status_file = None
+
+        self._unknown_since = None
+        self._unsuccessful_confirmations = 0
+
+        self._submission_time = None
+
+        # Only used for the submission in the background
+        self._submission_future = None
+        self._kill_requested = False
+        self._submitting_in_background = False
+
+        # Only used with the submission limiter
+        self._limiter = None
+        self._holds_limiter_slot = False
+        self._throttled = False
+
+        # Only used for bundled tasks
+        self._bundle_leader = None
+        self._bundled_processes = []
 
         self._result_queue = result_queue
         self._scheduler = scheduler
@@ -80,10 +204,14 @@ class BatchProcess:
         How you identify exactly your job is dependent on the implementation and needs to
         be handled by your own child class.
 
-        Must return one item of the JobStatus enumeration: running, aborted, successful or idle.
+        Must return one item of the JobStatus enumeration: running, aborted, successful or unknown.
         Will only be called after the job is started but may also be called when
         the job is finished already.
-        If the task status is unknown, return aborted. If the task has not started already but
+        If the job can currently not be found on the batch system (e.g. because it is
+        not listed anymore or the batch system did not answer), return unknown.
+        If this lasts longer than the grace period given by the setting ``batch_job_unknown_grace_period``
+        (in seconds, default 300), :obj:`confirm_job_status` is called.
+        If the task has not started already but
         is scheduled, return running nevertheless (for b2luigi it makes no difference).
         No matter if aborted via a call to kill_job, by the batch system or by an exception in the
         job itself, you should return aborted if the job is not finished successfully
@@ -91,6 +219,18 @@ class BatchProcess:
         """
         raise NotImplementedError
 
+    def confirm_job_status(self):
+        """
+        Called if the job status is unknown for longer than the grace period.
+        Override this function in your child class to check the status of the job with a more expensive,
+        but more reliable query to the batch system (e.g. in the history of finished jobs).
+        Return unknown if the job can still not be found. After ``batch_job_unknown_confirmations``
+        (default 3) unsuccessful confirmations, each after another grace period, the job is treated as aborted.
+
+        The default implementation treats the job as aborted directly.
+        """
+        return JobStatus.aborted
+
     def start_job(self):
         """
         Override this function in your child class to start a job on the batch system.
@@ -109,6 +249,24 @@ class BatchProcess:
         """
         raise NotImplementedError
 
+    @classmethod
+    def start_jobs(cls, processes):
+        """
+        Start the jobs of all given processes (all of this class) on the batch system.
+        Only used if the setting ``bulk_submission_size`` is larger than 1.
+        Override this function in your child class, if your batch system can submit multiple
+        jobs at once more efficiently. The default implementation calls ``start_job`` for each process.
+
+        Processes whose job could not be submitted should be marked with
+        ``process._submission_failed(explanation)``. If the function raises an exception, all
+        processes are treated as failed.
+        """
+        for process in processes:
+            try:
+                process.start_job()
+            except Exception as e:
+                process._submission_failed(f"Batch submission failed: {e}")
+
     def kill_job(self):
         """
         This command is used to abort a job started by the start_job function.
@@ -122,34 +280,490 @@ class BatchProcess:
         """
         raise NotImplementedError
 
+    @classmethod
+    def kill_jobs(cls, processes):
+        """
+        Abort the jobs of all given processes (all of this class), e.g. when the user presses Ctrl-C.
+        Override this function in your child class, if your batch system can remove multiple jobs at once
+        more efficiently. The default implementation calls ``kill_job`` for each process.
+        """
+        for process in processes:
+            process.kill_job()
+
+    @classmethod
+    def terminate_all(cls, processes):
+        """Terminate all given processes with as few calls to the batch system as possible."""
+        pending_processes = _pending_submissions[cls]
+        pending_process_ids = {id(process) for process in pending_processes}
+
+        # Bundled tasks are killed together with the job of their bundle, which is only killed once
+        processes_to_kill = {}
+        for process in processes:
+            if process._terminated:
+                continue
+
+            # Still waiting for the submission limiter, so there is nothing to kill
+            if process._throttled:
+                process._throttled = False
+                process._mark_terminated()
+                continue
+
+            # The job is killed as soon as its submission is finished
+            job_process = process._get_job_process()
+            if job_process._is_submitting():
+                job_process._kill_requested = True
+                continue
+
+            process._mark_terminated()
+
+            # Not submitted so far, so there is nothing to kill
+            if id(process) in pending_process_ids:
+                continue
+
+            _job_monitor.remove(process)
+            processes_to_kill.setdefault(id(job_process), job_process)
+
+        pending_processes[:] = [process for process in pending_processes if not process._terminated]
+
+        throttled_processes = _throttled_processes[cls]
+        remaining_processes = [process for process in throttled_processes if not process._terminated]
+        throttled_processes.clear()
+        throttled_processes.extend(remaining_processes)
+
+        if processes_to_kill:
+            cls.kill_jobs(list(processes_to_kill.values()))
+
+    def get_job_id(self):
+        """
+        Override this function in your child class to return the identifier of the submitted job
+        (as a string or number), if it is possible to re-attach to the job later with :obj:`reattach_job`.
+        The default implementation returns None, which turns off the re-attaching.
+        """
+        return None
+
+    def reattach_job(self, job_id, submission_time):
+        """
+        Override this function in your child class to re-attach to the job with the given id, which was
+        submitted for the same task by an earlier b2luigi process (e.g. before it was restarted).
+        Return True if the job is still queued or running; the job is then handled as if it was
+        started by this process and ``start_job`` is not called.
+        Otherwise return False, which leads to a new submission.
+        The job belongs to an earlier session (see :obj:`get_session_id`), so make sure it is also
+        included when asking for the status of all jobs of this session.
+        The default implementation always returns False.
+        """
+        return False
+
+    def create_executable_wrapper(self):
+        """
+        Create the executable to be started by the batch job of this process and return its path.
+        Use it in ``start_job`` and ``start_jobs`` instead of calling
+        :obj:`b2luigi.core.executable.create_executable_wrapper` directly, so that the bundled tasks are run as well.
+        """
+        if not self._bundled_processes:
+            return create_executable_wrapper(self.task)
+
+        parallel = get_setting("batch_bundle_parallel", task=self.task, default=False)
+        return create_bundle_wrapper([self.task] + [process.task for process in self._bundled_processes],
+                                     parallel=parallel)
+
     def run(self):
-        self.start_job()
+        self._limiter = get_limiter(type(self).__name__)
+        if self._limiter is None:
+            self._run_job()
+            return
+
+        self._throttled = True
+        _throttled_processes[type(self)].append(self)
+        self._release_throttled_processes()
+
+    def _run_job(self):
+        bulk_submission_size = get_setting("bulk_submission_size", task=self.task, default=1)
+        bundle_size = get_setting("batch_bundle_size", task=self.task, default=1)
+        if bulk_submission_size <= 1 and bundle_size <= 1:
+            submission_threads = get_setting("batch_submission_threads", task=self.task, default=0)
+            if submission_threads > 0:
+                self._submitting_in_background = True
+                self._set_status_message("Submitting to the batch system")
+                self._submission_future = _get_submission_executor(submission_threads).submit(
+                    self._submit_job_in_background)
+            else:
+                self._submit_job()
+            return
+
+        if self._reattach_to_submitted_job():
+            self._job_submitted()
+            return
+
+        self._remove_job_status_file()
+
+        pending_processes = _pending_submissions[type(self)]
+        pending_processes.append(self)
+
+        if len(pending_processes) >= max(1, bulk_submission_size) * max(1, bundle_size):
+            self._submit_pending_jobs()
 
     def terminate(self):
-        self.kill_job()
+        if self._throttled:
+            # Still waiting for the submission limiter, so there is nothing to kill
+            _throttled_processes[type(self)].remove(self)
+            self._throttled = False
+            return
+
+        pending_processes = _pending_submissions[type(self)]
+        if self in pending_processes:
+            # Not submitted so far, so there is nothing to kill
+            pending_processes.remove(self)
+            self._release_limiter_slot()
+            return
+
+        # The job is killed as soon as its submission is finished
+        job_process = self._get_job_process()
+        if job_process._is_submitting():
+            job_process._kill_requested = True
+            return
+
+        # Bundled tasks are killed together with the job of their bundle
+        _job_monitor.remove(self)
+        job_process.kill_job()
+        self._release_limiter_slot()
 
     def is_alive(self):
         if self._terminated:
             return False
 
-        job_status = self.get_job_status()
+        # Submit as many waiting processes as the submission limiter allows right now
+        if _throttled_processes[type(self)]:
+            self._release_throttled_processes()
+
+        # luigi is asking for the job status, so no more tasks are released right now
+        if _pending_submissions[type(self)]:
+            self._submit_pending_jobs()
 
+        if self._terminated:
+            return False
+
+        if self._throttled or self._is_submitting():
+            return True
+
+        # The job monitor will report the result as soon as the job is finished
+        if self in _job_monitor:
+            return True
+
+        return self._check_job_status()
+
+    def _check_job_status(self):
+        """Ask for the job status and report the result to luigi if the job is finished."""
+        job_status = self._get_job_status_from_file()
+        if job_status is None:
+            job_status = self._get_job_process().get_job_status()
+
+            # A finished bundle without a result of this task means it has not run (through)
+            if self._is_bundled() and job_status in (JobStatus.successful, JobStatus.aborted):
+                job_status = self._get_job_status_from_file() or JobStatus.aborted
+
+        if job_status == JobStatus.unknown:
+            job_status = self._handle_unknown_job_status()
+        else:
+            self._unknown_since = None
+            self._unsuccessful_confirmations = 0
+
+        # Mark the process as terminated before reporting, as the job monitor reports from another thread
         if job_status == JobStatus.successful:
             job_output = ""
+            self._mark_terminated()
             self._put_to_result_queue(status=luigi.scheduler.DONE, explanation=job_output)
-            self._terminated = True
             return False
         if job_status == JobStatus.aborted:
             job_output = ""
+            self._mark_terminated()
             self._put_to_result_queue(status=luigi.scheduler.FAILED, explanation=job_output)
             on_failure(self.task, job_output)
-            self._terminated = True
             return False
         if job_status == JobStatus.running:
             return True
 
         raise ValueError("get_job_status() returned an unknown job state!")
 
+    def _handle_unknown_job_status(self):
+        # Batch systems forget about jobs or do not answer from time to time, so give them some time
+        now = time.time()
+        if self._unknown_since is None:
+            self._unknown_since = now
+
+        grace_period = get_setting("batch_job_unknown_grace_period", task=self.task, default=300)
+        if now - self._unknown_since < grace_period:
+            return JobStatus.running
+
+        job_status = self._get_job_process().confirm_job_status()
+        if job_status == JobStatus.running:
+            # The job is still there, so give the batch system another grace period before asking again
+            self._unknown_since = now
+            self._unsuccessful_confirmations = 0
+            return job_status
+        if job_status != JobStatus.unknown:
+            if self._is_bundled() and job_status == JobStatus.successful:
+                return self._get_job_status_from_file() or JobStatus.aborted
+            return job_status
+
+        self._unsuccessful_confirmations += 1
+        confirmations = get_setting("batch_job_unknown_confirmations", task=self.task, default=3)
+        if self._unsuccessful_confirmations >= confirmations:
+            return JobStatus.aborted
+
+        # Wait for another grace period before asking again
+        self._unknown_since = now
+        return JobStatus.running
+
+    def _is_submitting(self):
+        return self._submission_future is not None and not self._submission_future.done()
+
+    def _submit_job(self):
+        if self._reattach_to_submitted_job():
+            self._job_submitted()
+            return
+
+        self._remove_job_status_file()
+
+        start_time = time.monotonic()
+        try:
+            self.start_job()
+        except Exception:
+            self._record_submission(start_time, error=True)
+            raise
+        self._record_submission(start_time)
+
+        self._job_submitted()
+
+    def _submit_job_in_background(self):
+        try:
+            self._submit_job()
+        except Exception as e:
+            self._submission_failed(f"Batch submission failed: {e}")
+            return
+
+        if self._kill_requested:
+            self._mark_terminated()
+            _job_monitor.remove(self)
+            self.kill_job()
+
+    @classmethod
+    def _submit_pending_jobs(cls):
+        processes = _pending_submissions.pop(cls, [])
+        if not processes:
+            return
+
+        submission_threads = get_setting("batch_submission_threads", task=processes[0].task, default=0)
+        bundle_leaders = cls._create_bundles(processes)
+
+        if submission_threads > 0:
+            for process in processes:
+                process._submitting_in_background = True
+                process._set_status_message("Submitting to the batch system")
+
+            future = _get_submission_executor(submission_threads).submit(cls._start_jobs_in_background,
+                                                                         bundle_leaders)
+            for process in processes:
+                process._submission_future = future
+            return
+
+        cls._start_jobs(bundle_leaders)
+
+    @staticmethod
+    def _create_bundles(processes):
+        """Pack the processes into bundles and return the processes to be submitted (the bundle leaders)."""
+        bundle_leaders = []
+        open_bundles = {}
+
+        for process in processes:
+            bundle_size = get_setting("batch_bundle_size", task=process.task, default=1)
+            if bundle_size <= 1:
+                bundle_leaders.append(process)
+                continue
+
+            bundle_name = get_setting("batch_bundle", task=process.task, default=process.task.get_task_family())
+            bundle_leader = open_bundles.get(bundle_name)
+
+            if bundle_leader is None or len(bundle_leader._bundled_processes) + 1 >= bundle_size:
+                open_bundles[bundle_name] = process
+                bundle_leaders.append(process)
+                continue
+
+            process._bundle_leader = bundle_leader
+            bundle_leader._bundled_processes.append(process)
+
+        return bundle_leaders
+
+    @classmethod
+    def _start_jobs_in_background(cls, processes):
+        cls._start_jobs(processes)
+
+        processes_to_kill = [process for process in processes if process._kill_requested and not process._terminated]
+        for process in processes_to_kill:
+            process._mark_terminated()
+            _job_monitor.remove(process)
+
+        if processes_to_kill:
+            cls.kill_jobs(processes_to_kill)
+
+    @classmethod
+    def _start_jobs(cls, processes):
+        start_time = time.monotonic()
+        try:
+            cls.start_jobs(processes)
+        except Exception as e:
+            processes[0]._record_submission(start_time, error=True)
+            for process in processes:
+                if not process._terminated:
+                    process._submission_failed(f"Batch submission failed: {e}")
+            return
+
+        processes[0]._record_submission(start_time)
+
+        for process in processes:
+            if not process._terminated:
+                process._job_submitted()
+
+    @classmethod
+    def _release_throttled_processes(cls):
+        throttled_processes = _throttled_processes[cls]
+        while throttled_processes:
+            process = throttled_processes[0]
+            if not process._limiter.try_acquire():
+                return
+
+            throttled_processes.popleft()
+            process._throttled = False
+            process._holds_limiter_slot = True
+
+            try:
+                process._run_job()
+            except Exception as e:
+                process._submission_failed(f"Batch submission failed: {e}")
+
+    def _record_submission(self, start_time, error=False):
+        if self._limiter is not None:
+            self._limiter.record(time.monotonic() - start_time, error=error)
+
+    def _mark_terminated(self):
+        self._terminated = True
+        self._release_limiter_slot()
+
+    def _release_limiter_slot(self):
+        if self._holds_limiter_slot:
+            self._holds_limiter_slot = False
+            self._limiter.release()
+
+    def _remove_job_status_file(self):
+        # A job status file from an earlier run of the task must not be mistaken for the result of this one
+        self._job_status_file = get_job_status_file(self.task)
+        try:
+            os.remove(self._job_status_file)
+        except FileNotFoundError:
+            pass
+
+    def _get_job_status_from_file(self):
+        if not self._job_status_file:
+            return None
+
+        job_status = read_job_status(self._job_status_file, self.task.task_id)
+        if job_status is None:
+            return None
+
+        if job_status["exit_status"] == 0:
+            return JobStatus.successful
+        return JobStatus.aborted
+
+    def _job_submitted(self):
+        self._write_batch_job_file()
+
+        if self._submitting_in_background:
+            self._submitting_in_background = False
+            job_id = self._get_job_process().get_job_id()
+            self._set_status_message(f"Batch job {job_id}" if job_id is not None else "Submitted to the batch system")
+
+        if get_setting("batch_job_monitor", task=self.task, default=False):
+            _job_monitor.add(self)
+
+        for process in self._bundled_processes:
+            if not process._terminated:
+                process._job_submitted()
+
+    def _set_status_message(self, message):
+        # Shown in the (central) scheduler, same as the progress of gbasf2 projects
+        if self._scheduler is not None:
+            self._scheduler.set_task_status_message(self.task.task_id, message)
+
+    def _is_bundled(self):
+        return self._bundle_leader is not None or bool(self._bundled_processes)
+
+    def _get_job_process(self):
+        # The process which has submitted the batch job running the task of this process
+        if self._bundle_leader is not None:
+            return self._bundle_leader
+        return self
+
+    def _get_batch_job_file(self):
+        return os.path.join(get_task_file_dir(self.task), "batch_job.json")
+
+    def _write_batch_job_file(self):
+        # Remember the job, so that a restarted b2luigi process can re-attach to it
+        job_id = self.get_job_id()
+        if job_id is None or self._is_bundled():
+            return
+
+        if self._submission_time is None:
+            self._submission_time = time.time()
+
+        batch_job = {
+            "task_id": self.task.task_id,
+            "batch_system": type(self).__name__,
+            "job_id": job_id,
+            "submission_time": self._submission_time,
+        }
+
+        batch_job_file = self._get_batch_job_file()
+        try:
+            os.makedirs(os.path.dirname(batch_job_file), exist_ok=True)
+            with open(batch_job_file, "w") as f:
+                json.dump(batch_job, f)
+        except OSError:
+            pass
+
+    def _reattach_to_submitted_job(self):
+        if not get_setting("batch_reattach_jobs", task=self.task, default=True):
+            return False
+
+        try:
+            with open(self._get_batch_job_file(), "r") as f:
+                batch_job = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        # The batch system is asked for exactly this job, so it does not matter which session submitted it
+        if batch_job.get("task_id") != self.task.task_id or batch_job.get("batch_system") != type(self).__name__:
+            return False
+
+        if not self.reattach_job(batch_job["job_id"], batch_job["submission_time"]):
+            return False
+
+        self._submission_time = batch_job["submission_time"]
+        self._job_status_file = get_job_status_file(self.task)
+        return True
+
+    def _submission_failed(self, explanation):
+        if self._submitting_in_background:
+            self._submitting_in_background = False
+            self._set_status_message(explanation)
+
+        self._put_to_result_queue(status=luigi.scheduler.FAILED, explanation=explanation)
+        on_failure(self.task, explanation)
+        self._mark_terminated()
+
+        for process in self._bundled_processes:
+            if not process._terminated:
+                process._submission_failed(explanation)
+
     def _put_to_result_queue(self, status, explanation):
         missing = []
         new_deps = []
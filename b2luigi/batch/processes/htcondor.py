@@ -2,25 +2,85 @@ import json
 import os
 import re
 import subprocess
+import time
 import enum
 
 from b2luigi.core.settings import get_setting
-from b2luigi.batch.processes import BatchProcess, JobStatus
+from b2luigi.batch.processes import BatchProcess, JobStatus, get_session_id
 from b2luigi.batch.cache import BatchJobStatusCache
 from b2luigi.core.utils import get_log_file_dir, get_task_file_dir
-from b2luigi.core.executable import create_executable_wrapper
 
 
 class HTCondorJobStatusCache(BatchJobStatusCache):
+    #: Maximal number of clusters asked for in a single condor_history call
+    history_chunk_size = 500
+    #: Seconds subtracted from the oldest submission time, to account for differing clocks
+    history_time_margin = 300
+    #: Number of history lookups, after which a job missing in condor_q and condor_history is not looked for anymore
+    history_max_misses = 3
+    limiter_name = "HTCondorProcess"
 
-    def _ask_for_job_status(self, job_id: int = None):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Submission time of all jobs submitted by us, which are not known to be finished
+        self._submitted_jobs = {}
+        # Number of history lookups, in which a submitted job could not be found at all
+        self._history_misses = {}
+        # Submitted jobs, which are not looked for in the history anymore after too many misses
+        self._lost_jobs = set()
+        # Jobs looked for by the last query for all jobs
+        self._last_refresh_jobs = set()
+        # Jobs of earlier sessions, which this session has re-attached to
+        self._reattached_jobs = set()
+
+    def add_submitted_jobs(self, job_ids, submission_time=None):
+        """Remember the given jobs (ClusterId.ProcId) as submitted, to look for them in the history later."""
+        if submission_time is None:
+            submission_time = time.time()
+
+        with self._lock:
+            for job_id in job_ids:
+                self._submitted_jobs[job_id] = submission_time
+
+    def add_reattached_jobs(self, job_ids, submission_time=None):
+        """
+        Remember the given jobs of an earlier session as submitted. They are not tagged with the id of
+        this session, so they are asked for separately whenever the status of all jobs is asked for.
+        """
+        self.add_submitted_jobs(job_ids, submission_time=submission_time)
+        with self._lock:
+            self._reattached_jobs.update(job_ids)
+
+    def remove_submitted_jobs(self, job_ids):
+        """Do not look for the given jobs in the history anymore."""
+        with self._lock:
+            for job_id in job_ids:
+                self._submitted_jobs.pop(job_id, None)
+                self._history_misses.pop(job_id, None)
+                self._reattached_jobs.discard(job_id)
+                self._lost_jobs.discard(job_id)
+
+    def get_session_constraint(self):
+        """ClassAd constraint matching all jobs of this session, including the re-attached ones."""
+        constraint = f'B2LuigiSession == "{get_session_id()}"'
+        with self._lock:
+            reattached_jobs = sorted(self._reattached_jobs)
+
+        for job_id in reattached_jobs:
+            cluster_id, proc_id = job_id.split(".")
+            constraint += f" || (ClusterId == {cluster_id} && ProcId == {proc_id})"
+        return constraint
+
+    def _ask_for_job_status(self, job_id: str = None):
         """
         With HTCondor, you can check the progress of your jobs using the `condor_q` command.
         If no `JobId` is given as argument, this command shows you the status of all queued jobs
         (usually only your own by default).
 
-        Normally the HTCondor `JobID` is stated as `ClusterId.ProcId`. Since only on job is queued per
-        cluster, we can identify jobs by their `ClusterId` (The `ProcId` will be 0 for all submitted jobs).
+        The HTCondor `JobID` is stated as `ClusterId.ProcId`, which is also used as the key in this cache.
+        If jobs are submitted one by one, there is only one job per cluster (with `ProcId` 0), but with
+        bulk submission all jobs of a bulk are in the same cluster.
         With the `-json` option, the `condor_q` output is returned in the JSON format. By specifying some
         attributes, not the entire job ClassAd is returned, but only the necessary information to match a
         job to its `JobStatus`. The output is given as `string` and cannot be directly parsed into a json
@@ -36,25 +96,94 @@ class HTCondorJobStatusCache(BatchJobStatusCache):
         Sometimes it might happen that a job is completed in between the status checks. Then its final status
         can be found in the `condor_history` file (works mostly in the same way as `condor_q`).
         Both commands are used in order to find out the `JobStatus`.
+
+        Scanning the history is expensive, so when asking for all jobs, all jobs submitted by us but
+        missing in the `condor_q` output are looked up with a single `condor_history` call
+        (constrained to their cluster ids and only reading the history back to the oldest submission).
+        A job which can not be found in the history for ``history_max_misses`` times (e.g. because the
+        history was rotated) is not looked for anymore. It is then reported as unknown, so the
+        batch process can settle its status, see :obj:`b2luigi.batch.processes.BatchProcess`.
+        Until the next query for all jobs, a submitted job missing there is not asked for separately:
+        the lookup of a single job is left to the confirmation of unknown jobs (see ``confirm_job_status``).
+
+        All jobs are tagged with the `B2LuigiSession` ClassAd attribute at submission
+        (see :obj:`b2luigi.batch.processes.get_session_id`), so when asking for all jobs,
+        `condor_q` only returns the jobs of this session (and the jobs of earlier sessions re-attached to).
         """
         # https://htcondor.readthedocs.io/en/latest/man-pages/condor_q.html
-        q_cmd = ["condor_q", "-json", "-attributes", "ClusterId,JobStatus,ExitStatus"]
+        q_cmd = ["condor_q", "-json", "-attributes", "ClusterId,ProcId,JobStatus,ExitStatus"]
 
         if job_id:
             output = subprocess.check_output(q_cmd + [str(job_id)])
         else:
-            output = subprocess.check_output(q_cmd)
+            with self._lock:
+                asked_jobs = set(self._submitted_jobs) | self._lost_jobs
+
+            # Only ask for the jobs of this session
+            output = subprocess.check_output(q_cmd + ["-constraint", self.get_session_constraint()])
 
         seen_ids = self._fill_from_output(output)
 
+        if not job_id:
+            self._ask_for_missing_jobs_in_history(seen_ids)
+            with self._lock:
+                self._last_refresh_jobs = asked_jobs
+
         # If the specified job can not be found in the condor_q output, we need to request its history
         if job_id and job_id not in seen_ids:
             # https://htcondor.readthedocs.io/en/latest/man-pages/condor_history.html
-            history_cmd = ["condor_history", "-json", "-attributes", "ClusterId,JobStatus,ExitCode", "-match", "1", str(job_id)]
+            history_cmd = ["condor_history", "-json", "-attributes", "ClusterId,ProcId,JobStatus,ExitCode",
+                           "-match", "1", str(job_id)]
             output = subprocess.check_output(history_cmd)
 
             self._fill_from_output(output)
 
+    def _ask_for_missing_jobs_in_history(self, seen_ids):
+        with self._lock:
+            missing_jobs = {job_id: submission_time for job_id, submission_time in self._submitted_jobs.items()
+                            if job_id not in seen_ids}
+            # Jobs listed by condor_q are not missing anymore
+            for job_id in seen_ids:
+                self._history_misses.pop(job_id, None)
+
+        if not missing_jobs:
+            return
+
+        cluster_ids = sorted({int(job_id.split(".")[0]) for job_id in missing_jobs})
+        # The history is read from the newest to the oldest job, so we can stop at the oldest submission
+        since_time = int(min(missing_jobs.values()) - self.history_time_margin)
+
+        found_ids = set()
+        for start in range(0, len(cluster_ids), self.history_chunk_size):
+            chunk = cluster_ids[start:start + self.history_chunk_size]
+            constraint = f"member(ClusterId, {{{', '.join(map(str, chunk))}}})"
+
+            # https://htcondor.readthedocs.io/en/latest/man-pages/condor_history.html
+            history_cmd = ["condor_history", "-json", "-attributes", "ClusterId,ProcId,JobStatus,ExitCode",
+                           "-constraint", constraint, "-since", f"EnteredCurrentStatus < {since_time}"]
+            output = subprocess.check_output(history_cmd)
+
+            found_ids |= self._fill_from_output(output)
+
+        # Jobs missing everywhere would otherwise be looked for on every refresh
+        with self._lock:
+            for job_id in missing_jobs:
+                if job_id in found_ids or job_id not in self._submitted_jobs:
+                    self._history_misses.pop(job_id, None)
+                    continue
+
+                self._history_misses[job_id] = self._history_misses.get(job_id, 0) + 1
+                if self._history_misses[job_id] >= self.history_max_misses:
+                    del self._submitted_jobs[job_id]
+                    del self._history_misses[job_id]
+                    self._lost_jobs.add(job_id)
+
+    def _is_covered_by_full_refresh(self, job_id):
+        # All submitted jobs are asked for with condor_q and, if missing there, in the history.
+        # Looking for a single job in the history again is left to the confirmation of unknown jobs.
+        with self._lock:
+            return job_id in self._last_refresh_jobs
+
     def _fill_from_output(self, output):
         output = output.decode()
 
@@ -64,12 +193,20 @@ class HTCondorJobStatusCache(BatchJobStatusCache):
             return seen_ids
 
         for status_dict in json.loads(output):
+            job_id = f"{status_dict['ClusterId']}.{status_dict.get('ProcId', 0)}"
+
             if status_dict["JobStatus"] == HTCondorJobStatus.completed and status_dict["ExitCode"]:
-                self[status_dict["ClusterId"]] = HTCondorJobStatus.failed
+                self[job_id] = HTCondorJobStatus.failed
             else:
-                self[status_dict["ClusterId"]] = status_dict["JobStatus"]
+                self[job_id] = status_dict["JobStatus"]
 
-            seen_ids.add(status_dict["ClusterId"])
+            seen_ids.add(job_id)
+
+            # Finished jobs do not need to be looked up in the history anymore
+            if status_dict["JobStatus"] in [HTCondorJobStatus.completed, HTCondorJobStatus.removed]:
+                with self._lock:
+                    self._submitted_jobs.pop(job_id, None)
+                    self._reattached_jobs.discard(job_id)
 
         return seen_ids
 
@@ -135,12 +272,29 @@ class HTCondorProcess(BatchProcess):
 
         condor_q -batch <job name>
 
+    * If a job can not be found with ``condor_q`` or in the history (or the schedd does not answer),
+      it is not treated as aborted directly. After the grace period (setting ``batch_job_unknown_grace_period``)
+      the job is looked up again with ``condor_q`` and ``condor_history`` and only declared aborted if it is
+      still missing after ``batch_job_unknown_confirmations`` tries.
+
+    * If the setting ``bulk_submission_size`` is larger than 1, tasks which get runnable together and
+      share the same HTCondor settings are submitted as a single cluster with one job (``ProcId``) per task,
+      using a single ``condor_submit`` call. The submit file ``bulk_job.submit`` is written into the
+      task folder of the first task of the bulk. The log files stay at the same place as for single jobs.
+
+    * When b2luigi is stopped (e.g. with Ctrl-C), all running jobs are removed with a few ``condor_rm``
+      calls with many job ids each. With the setting ``batch_kill_session``, a single ``condor_rm``
+      removes all jobs of this session instead (including the jobs of earlier calls re-attached to).
+
     Example:
 
         .. literalinclude:: ../../examples/htcondor/htcondor_example.py
            :linenos:
     """
 
+    #: Maximal number of jobs removed with a single condor_rm call
+    kill_chunk_size = 500
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -150,11 +304,39 @@ class HTCondorProcess(BatchProcess):
         if not self._batch_job_id:
             return JobStatus.aborted
 
+        # The job might just not be listed (yet) or the schedd did not answer
         try:
             job_status = _batch_job_status_cache[self._batch_job_id]
-        except KeyError:
-            return JobStatus.aborted
+        except (KeyError, subprocess.CalledProcessError):
+            return JobStatus.unknown
 
+        return self._to_job_status(job_status)
+
+    def get_job_id(self):
+        return self._batch_job_id
+
+    def reattach_job(self, job_id, submission_time):
+        self._batch_job_id = job_id
+        _batch_job_status_cache.add_reattached_jobs([job_id], submission_time=submission_time)
+
+        if self.get_job_status() == JobStatus.running:
+            return True
+
+        _batch_job_status_cache.remove_submitted_jobs([job_id])
+        self._batch_job_id = None
+        return False
+
+    def confirm_job_status(self):
+        # Ask condor_q and the history for exactly this job
+        try:
+            job_status = _batch_job_status_cache.refresh_job(self._batch_job_id)
+        except (KeyError, subprocess.CalledProcessError):
+            return JobStatus.unknown
+
+        return self._to_job_status(job_status)
+
+    @staticmethod
+    def _to_job_status(job_status):
         if job_status in [HTCondorJobStatus.completed]:
             return JobStatus.successful
         if job_status in [HTCondorJobStatus.idle, HTCondorJobStatus.running]:
@@ -175,7 +357,51 @@ class HTCondorProcess(BatchProcess):
         if not match:
             raise RuntimeError("Batch submission failed with output " + output)
 
-        self._batch_job_id = int(match.group(0)[:-1])
+        self._batch_job_id = f"{match.group(0)[:-1]}.0"
+        _batch_job_status_cache.add_submitted_jobs([self._batch_job_id])
+
+    @classmethod
+    def start_jobs(cls, processes):
+        # Only jobs with the same settings can end up in the same cluster
+        process_groups = {}
+        for process in processes:
+            try:
+                job_settings = _get_htcondor_job_settings(process.task)
+            except Exception as e:
+                process._submission_failed(f"Batch submission failed: {e}")
+                continue
+
+            group_key = tuple((key, str(value)) for key, value in job_settings.items())
+            process_groups.setdefault(group_key, (job_settings, []))[1].append(process)
+
+        for job_settings, process_group in process_groups.values():
+            try:
+                if len(process_group) == 1:
+                    process_group[0].start_job()
+                else:
+                    cls._start_cluster(process_group, job_settings)
+            except Exception as e:
+                for process in process_group:
+                    process._submission_failed(f"Batch submission failed: {e}")
+
+    @staticmethod
+    def _start_cluster(processes, job_settings):
+        submit_file = _create_htcondor_bulk_submit_file(processes, job_settings)
+
+        submit_file_dir, submit_file = os.path.split(submit_file)
+        output = subprocess.check_output(["condor_submit", submit_file], cwd=submit_file_dir)
+
+        output = output.decode()
+        match = re.search(r"([0-9]+) job\(s\) submitted to cluster ([0-9]+)\.", output)
+        if not match or int(match.group(1)) != len(processes):
+            raise RuntimeError("Batch submission failed with output " + output)
+
+        cluster_id = match.group(2)
+        # The jobs of a cluster are numbered in the order of the queue statement
+        for proc_id, process in enumerate(processes):
+            process._batch_job_id = f"{cluster_id}.{proc_id}"
+
+        _batch_job_status_cache.add_submitted_jobs([process._batch_job_id for process in processes])
 
     def kill_job(self):
         if not self._batch_job_id:
@@ -183,6 +409,18 @@ class HTCondorProcess(BatchProcess):
 
         subprocess.run(["condor_rm", str(self._batch_job_id)], stdout=subprocess.DEVNULL)
 
+    @classmethod
+    def kill_jobs(cls, processes):
+        if get_setting("batch_kill_session", default=False):
+            # All jobs of this session, including the ones not known to this process
+            subprocess.run(["condor_rm", "-constraint", _batch_job_status_cache.get_session_constraint()],
+                           stdout=subprocess.DEVNULL)
+            return
+
+        job_ids = [str(process._batch_job_id) for process in processes if process._batch_job_id]
+        for start in range(0, len(job_ids), cls.kill_chunk_size):
+            subprocess.run(["condor_rm"] + job_ids[start:start + cls.kill_chunk_size], stdout=subprocess.DEVNULL)
+
     def _create_htcondor_submit_file(self):
         submit_file_content = []
 
@@ -200,44 +438,11 @@ class HTCondorProcess(BatchProcess):
         submit_file_content.append(f"log = {job_log_file}")
 
         # Specify the executable
-        executable_file = create_executable_wrapper(self.task)
+        executable_file = self.create_executable_wrapper()
         submit_file_content.append(f"executable = {os.path.basename(executable_file)}")
 
         # Specify additional settings
-        general_settings = get_setting("htcondor_settings", dict())
-        try:
-            general_settings.update(self.task.htcondor_settings)
-        except AttributeError:
-            pass
-
-        transfer_files = get_setting("transfer_files", task=self.task, default=[])
-        if transfer_files:
-            working_dir = get_setting("working_dir", task=self.task, default="")
-            if not working_dir or working_dir != ".":
-                raise ValueError("If using transfer_files, the working_dir must be explicitely set to '.'")
-
-            general_settings.setdefault("should_transfer_files", "YES")
-            general_settings.setdefault("when_to_transfer_output", "ON_EXIT")
-
-            transfer_files = set(transfer_files)
-
-            for transfer_file in transfer_files:
-                if os.path.abspath(transfer_file) != transfer_file:
-                    raise ValueError(
-                        "You should only give absolute file names in transfer_files!" +
-                        f"{os.path.abspath(transfer_file)} != {transfer_file}"
-                    )
-
-            env_setup_script = get_setting("env_script", task=self.task, default="")
-            if env_setup_script:
-                # TODO: make sure to call it relatively
-                transfer_files.add(os.path.abspath(env_setup_script))
-
-            general_settings.setdefault("transfer_input_files", ",".join(transfer_files))
-
-        job_name = get_setting("job_name", task=self.task, default=False)
-        if job_name is not False:
-            general_settings.setdefault("JobBatchName", job_name)
+        general_settings = _get_htcondor_job_settings(self.task)
 
         for key, item in general_settings.items():
             submit_file_content.append(f"{key} = {item}")
@@ -255,3 +460,85 @@ class HTCondorProcess(BatchProcess):
             submit_file.write("\n".join(submit_file_content))
 
         return submit_file_path
+
+
+def _get_htcondor_job_settings(task):
+    """
+    Return the HTCondor settings (without the executable and log files) to be written into
+    the submit file for the given task.
+    """
+    general_settings = dict(get_setting("htcondor_settings", dict()))
+    try:
+        general_settings.update(task.htcondor_settings)
+    except AttributeError:
+        pass
+
+    transfer_files = get_setting("transfer_files", task=task, default=[])
+    if transfer_files:
+        working_dir = get_setting("working_dir", task=task, default="")
+        if not working_dir or working_dir != ".":
+            raise ValueError("If using transfer_files, the working_dir must be explicitely set to '.'")
+
+        general_settings.setdefault("should_transfer_files", "YES")
+        general_settings.setdefault("when_to_transfer_output", "ON_EXIT")
+
+        transfer_files = set(transfer_files)
+
+        for transfer_file in transfer_files:
+            if os.path.abspath(transfer_file) != transfer_file:
+                raise ValueError(
+                    "You should only give absolute file names in transfer_files!" +
+                    f"{os.path.abspath(transfer_file)} != {transfer_file}"
+                )
+
+        env_setup_script = get_setting("env_script", task=task, default="")
+        if env_setup_script:
+            # TODO: make sure to call it relatively
+            transfer_files.add(os.path.abspath(env_setup_script))
+
+        general_settings.setdefault("transfer_input_files", ",".join(sorted(transfer_files)))
+
+    job_name = get_setting("job_name", task=task, default=False)
+    if job_name is not False:
+        general_settings.setdefault("JobBatchName", job_name)
+
+    # Tag the job, to only ask for the jobs of this session later
+    general_settings.setdefault("+B2LuigiSession", f'"{get_session_id()}"')
+
+    return general_settings
+
+
+def _create_htcondor_bulk_submit_file(processes, job_settings):
+    """
+    Write a submit file for a single cluster with one job per given process.
+    All tasks need to share the given HTCondor settings.
+    Every job gets its own queue statement after setting its executable and log files, as the
+    paths contain the parameter values of the tasks, which may include commas or spaces
+    (so they can not be given as itemdata of a single queue statement).
+    """
+    submit_file_content = []
+
+    for key, item in job_settings.items():
+        submit_file_content.append(f"{key} = {item}")
+
+    for process in processes:
+        log_file_dir = get_log_file_dir(process.task)
+        os.makedirs(log_file_dir, exist_ok=True)
+
+        executable_file = os.path.abspath(process.create_executable_wrapper())
+        submit_file_content.append(f"executable = {executable_file}")
+
+        for key, log_file in [("output", "stdout"), ("error", "stderr"), ("log", "job.log")]:
+            submit_file_content.append(f"{key} = {os.path.abspath(os.path.join(log_file_dir, log_file))}")
+
+        submit_file_content.append("queue 1")
+
+    output_path = get_task_file_dir(processes[0].task)
+    submit_file_path = os.path.join(output_path, "bulk_job.submit")
+
+    os.makedirs(output_path, exist_ok=True)
+
+    with open(submit_file_path, "w") as submit_file:
+        submit_file.write("\n".join(submit_file_content))
+
+    return submit_file_path
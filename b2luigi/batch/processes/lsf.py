@@ -1,32 +1,93 @@
 import json
 import re
+import shlex
+import stat
 import subprocess
 import os
 
-from b2luigi.batch.processes import BatchProcess, JobStatus
+from b2luigi.batch.processes import BatchProcess, JobStatus, get_session_id
 from b2luigi.batch.cache import BatchJobStatusCache
-from b2luigi.core.utils import get_log_file_dir
-from b2luigi.core.executable import create_executable_wrapper
+from b2luigi.core.utils import get_log_file_dir, get_task_file_dir
 from b2luigi.core.settings import get_setting
 
 
 class LSFJobStatusCache(BatchJobStatusCache):
+    limiter_name = "LSFProcess"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # Jobs of earlier sessions (in another job group), which this session has re-attached to
+        self._reattached_jobs = set()
+
+    def add_reattached_jobs(self, job_ids):
+        """Also ask for the given jobs of an earlier session, whenever the status of all jobs is asked for."""
+        with self._lock:
+            self._reattached_jobs.update(job_ids)
+
+    def remove_reattached_jobs(self, job_ids):
+        with self._lock:
+            self._reattached_jobs.difference_update(job_ids)
+
+    def get_reattached_jobs(self):
+        with self._lock:
+            return sorted(self._reattached_jobs)
 
     def _ask_for_job_status(self, job_id=None):
+        bjobs_cmd = ["bjobs", "-json", "-o", "jobid stat jobindex"]
         if job_id:
-            output = subprocess.check_output(["bjobs", "-json", "-o", "jobid stat", str(job_id)])
-        else:
-            output = subprocess.check_output(["bjobs", "-json", "-o", "jobid stat"])
+            self._fill_from_output(subprocess.check_output(bjobs_cmd + [str(job_id)]))
+            return
+
+        # Only ask for the jobs of this session
+        self._fill_from_output(subprocess.check_output(bjobs_cmd + ["-g", get_job_group()]))
+
+        reattached_jobs = self.get_reattached_jobs()
+        if reattached_jobs:
+            # bjobs fails if one of the jobs is not known anymore, but still lists all others
+            result = subprocess.run(bjobs_cmd + reattached_jobs, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self._fill_from_output(result.stdout)
+
+    def _fill_from_output(self, output):
         output = output.decode()
+        if not output.strip():
+            return
         output = json.loads(output)["RECORDS"]
 
         for record in output:
-            self[record["JOBID"]] = record["STAT"]
+            # Jobs which are not known (anymore) are reported with an error message instead of a status
+            if "STAT" not in record:
+                continue
+
+            job_id = self._get_job_id(record)
+            self[job_id] = record["STAT"]
+
+            if record["STAT"] in ["DONE", "EXIT"]:
+                self.remove_reattached_jobs([job_id])
+
+    @staticmethod
+    def _get_job_id(record):
+        """
+        Jobs of a job array are stored as jobid[index], all others just with their job id.
+        Depending on the LSF version, the index is either part of the JOBID or only given as JOBINDEX
+        (which is 0 for jobs not in an array).
+        """
+        job_id = record["JOBID"]
+        job_index = record.get("JOBINDEX", "0")
+
+        if "[" in job_id or not job_index or str(job_index) == "0":
+            return job_id
+        return f"{job_id}[{job_index}]"
 
 
 _batch_job_status_cache = LSFJobStatusCache()
 
 
+def get_job_group():
+    """LSF job group of all jobs submitted in this session."""
+    return f"/b2luigi/{get_session_id()}"
+
+
 class LSFProcess(BatchProcess):
     """
     Reference implementation of the batch process for a LSF batch system.
@@ -57,8 +118,32 @@ class LSFProcess(BatchProcess):
       This also applies we start in the same working directory and can reuse
       the same executable etc.
       Normally, you do not need to supply ``env_script`` or alike.
+
+    * If the setting ``bulk_submission_size`` is larger than 1, tasks which get runnable together and share
+      the same ``queue`` and ``job_name`` are submitted as a single job array (``-J "<job_name>[1-N]"``).
+      The array runs the script ``array_job.sh`` in the task folder of the first task, which starts the executable
+      of the task belonging to the ``$LSB_JOBINDEX``. The log files of the tasks stay at the same place as
+      for single jobs, the LSF job report of each array element is written next to the array script.
+      Without a ``job_name``, the array is called ``b2luigi``.
+
+    * If a job can not be found with ``bjobs`` anymore (or ``bjobs`` fails), it is not treated as aborted directly.
+      After the grace period (setting ``batch_job_unknown_grace_period``), ``bhist -l`` is used to find out
+      what happened with the job. It is only declared aborted if it is
+      still missing after ``batch_job_unknown_confirmations`` tries.
+
+    * All jobs are submitted into the job group ``/b2luigi/<session id>``
+      (see :obj:`b2luigi.batch.processes.get_session_id`), so that only the jobs of this
+      session need to be asked for when checking the job status. Jobs of earlier sessions re-attached to
+      (see :obj:`b2luigi.batch.processes.BatchProcess`) are asked for with an additional ``bjobs`` call.
+
+    * When b2luigi is stopped (e.g. with Ctrl-C), all running jobs are killed with a few ``bkill``
+      calls with many job ids each. With the setting ``batch_kill_session``, a single ``bkill -g``
+      kills all jobs in the job group of this session instead.
     """
 
+    #: Maximal number of jobs killed with a single bkill call
+    kill_chunk_size = 500
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -68,10 +153,11 @@ class LSFProcess(BatchProcess):
         if not self._batch_job_id:
             return JobStatus.aborted
 
+        # bjobs forgets about finished jobs after some time or might not answer
         try:
             job_status = _batch_job_status_cache[self._batch_job_id]
-        except KeyError:
-            return JobStatus.aborted
+        except (KeyError, subprocess.CalledProcessError):
+            return JobStatus.unknown
 
         if job_status == "DONE":
             return JobStatus.successful
@@ -80,8 +166,31 @@ class LSFProcess(BatchProcess):
 
         return JobStatus.running
 
+    def get_job_id(self):
+        return self._batch_job_id
+
+    def reattach_job(self, job_id, submission_time):
+        self._batch_job_id = job_id
+        _batch_job_status_cache.add_reattached_jobs([job_id])
+
+        if self.get_job_status() == JobStatus.running:
+            return True
+
+        _batch_job_status_cache.remove_reattached_jobs([job_id])
+        self._batch_job_id = None
+        return False
+
+    def confirm_job_status(self):
+        # bhist also knows about jobs, which are not shown by bjobs anymore
+        try:
+            output = subprocess.check_output(["bhist", "-l", self._batch_job_id], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return JobStatus.unknown
+
+        return _parse_bhist_output(output.decode())
+
     def start_job(self):
-        command = ["bsub", "-env all"]
+        command = ["bsub", "-env all", "-g", get_job_group()]
 
         queue = get_setting("queue", task=self.task, default=False)
         if queue is not False:
@@ -99,7 +208,7 @@ class LSFProcess(BatchProcess):
 
         command += ["-eo", stderr_log_file, "-oo", stdout_log_file]
 
-        executable_file = create_executable_wrapper(self.task)
+        executable_file = self.create_executable_wrapper()
         command.append(executable_file)
 
         output = subprocess.check_output(command)
@@ -112,8 +221,123 @@ class LSFProcess(BatchProcess):
 
         self._batch_job_id = match.group(0)[1:-1]
 
+    @classmethod
+    def start_jobs(cls, processes):
+        # Only jobs with the same queue and name can end up in the same array
+        process_groups = {}
+        for process in processes:
+            queue = get_setting("queue", task=process.task, default=False)
+            job_name = get_setting("job_name", task=process.task, default=False)
+            process_groups.setdefault((queue, job_name), []).append(process)
+
+        for (queue, job_name), process_group in process_groups.items():
+            try:
+                if len(process_group) == 1:
+                    process_group[0].start_job()
+                else:
+                    cls._start_array(process_group, queue, job_name)
+            except Exception as e:
+                for process in process_group:
+                    process._submission_failed(f"Batch submission failed: {e}")
+
+    @staticmethod
+    def _start_array(processes, queue, job_name):
+        array_script = _create_lsf_array_script(processes)
+
+        command = ["bsub", "-env all", "-g", get_job_group()]
+
+        if queue is not False:
+            command += ["-q", queue]
+
+        if job_name is False:
+            job_name = "b2luigi"
+        command += ["-J", f"{job_name}[1-{len(processes)}]"]
+
+        # The job report of LSF, the output of the tasks itself is written by the array script
+        array_log_file = os.path.join(os.path.dirname(array_script), "array_job_%I.log")
+        command += ["-oo", array_log_file]
+
+        command.append(array_script)
+
+        output = subprocess.check_output(command)
+        output = output.decode()
+
+        match = re.search(r"<[0-9]+>", output)
+        if not match:
+            raise RuntimeError("Batch submission failed with output " + output)
+
+        array_job_id = match.group(0)[1:-1]
+        # LSF array indices start at 1
+        for array_index, process in enumerate(processes, start=1):
+            process._batch_job_id = f"{array_job_id}[{array_index}]"
+
     def kill_job(self):
         if not self._batch_job_id:
             return
 
         subprocess.run(["bkill", self._batch_job_id], stdout=subprocess.DEVNULL, check=False)
+
+    @classmethod
+    def kill_jobs(cls, processes):
+        if get_setting("batch_kill_session", default=False):
+            # All jobs of this session, including the ones not known to this process
+            subprocess.run(["bkill", "-g", get_job_group(), "0"], stdout=subprocess.DEVNULL, check=False)
+
+            # The jobs of earlier sessions re-attached to are in another job group
+            job_ids = _batch_job_status_cache.get_reattached_jobs()
+        else:
+            job_ids = [process._batch_job_id for process in processes if process._batch_job_id]
+
+        for start in range(0, len(job_ids), cls.kill_chunk_size):
+            subprocess.run(["bkill"] + job_ids[start:start + cls.kill_chunk_size], stdout=subprocess.DEVNULL,
+                           check=False)
+
+
+def _parse_bhist_output(output):
+    """Extract the job status out of the long output format of bhist."""
+    # Long lines are wrapped and continued with an indentation
+    output = re.sub(r"\n\s+", "", output)
+
+    if "Done successfully" in output:
+        return JobStatus.successful
+    if "Exited" in output or "Completed <exit>" in output:
+        return JobStatus.aborted
+    if "Submitted from host" in output:
+        return JobStatus.running
+
+    return JobStatus.unknown
+
+
+def _create_lsf_array_script(processes):
+    """
+    Write the script started by every element of a job array, which runs the executable
+    of the process with the index ``$LSB_JOBINDEX`` (starting at 1) in the given list.
+    """
+    script_content = ["#!/bin/bash", 'case "$LSB_JOBINDEX" in']
+
+    for array_index, process in enumerate(processes, start=1):
+        log_file_dir = get_log_file_dir(process.task)
+        os.makedirs(log_file_dir, exist_ok=True)
+
+        stdout_log_file = os.path.abspath(os.path.join(log_file_dir, "stdout"))
+        stderr_log_file = os.path.abspath(os.path.join(log_file_dir, "stderr"))
+        executable_file = os.path.abspath(process.create_executable_wrapper())
+
+        script_content.append(f"    {array_index}) exec {shlex.quote(executable_file)} "
+                              f"> {shlex.quote(stdout_log_file)} 2> {shlex.quote(stderr_log_file)} ;;")
+
+    script_content.append('    *) echo "Unknown array index $LSB_JOBINDEX" >&2; exit 1 ;;')
+    script_content.append("esac")
+
+    output_path = get_task_file_dir(processes[0].task)
+    array_script_path = os.path.abspath(os.path.join(output_path, "array_job.sh"))
+
+    os.makedirs(output_path, exist_ok=True)
+
+    with open(array_script_path, "w") as f:
+        f.write("\n".join(script_content) + "\n")
+
+    st = os.stat(array_script_path)
+    os.chmod(array_script_path, st.st_mode | stat.S_IEXEC)
+
+    return array_script_path
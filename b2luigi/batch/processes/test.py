@@ -3,7 +3,6 @@ import os
 
 from b2luigi.batch.processes import BatchProcess, JobStatus
 from b2luigi.core.utils import get_log_file_dir
-from b2luigi.core.executable import create_executable_wrapper
 
 
 class TestProcess(BatchProcess):
@@ -30,7 +29,7 @@ class TestProcess(BatchProcess):
         stdout_log_file = os.path.join(log_file_dir, "stdout")
         stderr_log_file = os.path.join(log_file_dir, "stderr")
 
-        executable_file = create_executable_wrapper(self.task)
+        executable_file = self.create_executable_wrapper()
 
         with open(stdout_log_file, "w") as stdout_file:
             with open(stderr_log_file, "w") as stderr_file:
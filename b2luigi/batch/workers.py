@@ -1,14 +1,22 @@
+import collections
+import datetime
 import enum
+import queue
 
 import luigi.interface
+import luigi.scheduler
 import luigi.worker
 
+from b2luigi.batch.pilots import PilotTask
+from b2luigi.batch.processes import BatchProcess
 from b2luigi.batch.processes.lsf import LSFProcess
 from b2luigi.batch.processes.htcondor import HTCondorProcess
 from b2luigi.batch.processes.gbasf2 import Gbasf2Process
 from b2luigi.batch.processes.test import TestProcess
 from b2luigi.core.settings import get_setting
-from b2luigi.core.utils import create_output_dirs
+from b2luigi.core.targets import invalidate_task_outputs
+from b2luigi.core.task_index import record_complete_task
+from b2luigi.core.utils import create_output_dirs, get_known_complete_task_ids
 
 
 class BatchSystems(enum.Enum):
@@ -20,7 +28,75 @@ class BatchSystems(enum.Enum):
 
 
 class SendJobWorker(luigi.worker.Worker):
+    """
+    luigi worker sending the tasks to the batch system instead of running them itself.
+
+    By default, every running batch job takes up one of the ``workers`` of luigi, although the
+    process is just asking for the job status from time to time. With the setting ``batch_workers``,
+    the batch jobs are handled in addition to the luigi workers: up to this number of batch jobs
+    (or any number if set to True) are running at the same time, while the given number of workers
+    is only used for the tasks running locally.
+
+    Tasks already known to be complete (see :obj:`b2luigi.core.utils.remember_completeness`)
+    are put into the completion cache of luigi, so they are not checked again during scheduling.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # luigi versions before 3.1 have no completion cache, so they just check all tasks again
+        known_complete_task_ids = get_known_complete_task_ids()
+        if known_complete_task_ids and hasattr(self, "_task_completion_cache"):
+            # The cache is handed to the (possibly parallel) completeness checks, so it needs to be picklable
+            if self._task_completion_cache is None:
+                self._task_completion_cache = {}
+            self._task_completion_cache.update(dict.fromkeys(known_complete_task_ids, True))
+
+    @property
+    def worker_processes(self):
+        batch_workers = get_setting("batch_workers", default=False)
+        if not batch_workers:
+            return self._worker_processes
+
+        # The running tasks are not there yet during the initialization of the luigi worker
+        running_tasks = getattr(self, "_running_tasks", {})
+        running_batch_jobs = sum(isinstance(process, BatchProcess) for process in running_tasks.values())
+        if batch_workers is not True and running_batch_jobs >= batch_workers:
+            # No new tasks until one of the running ones is finished
+            return len(running_tasks)
+
+        return self._worker_processes + running_batch_jobs
+
+    @worker_processes.setter
+    def worker_processes(self, worker_processes):
+        self._worker_processes = worker_processes
+
+    def __exit__(self, type, value, traceback):
+        # Kill all batch jobs together instead of asking each process for its status and killing one by one
+        batch_processes = collections.defaultdict(list)
+        for process in self._running_tasks.values():
+            if isinstance(process, BatchProcess):
+                batch_processes[process.__class__].append(process)
+
+        for process_class, processes in batch_processes.items():
+            process_class.terminate_all(processes)
+
+        # The remaining (local) processes are handled as usual
+        return super().__exit__(type, value, traceback)
+
+    def _add_task(self, *args, **kwargs):
+        # The outputs of a task which has just run have been created by another process
+        task_id = kwargs["task_id"]
+        if kwargs["status"] == luigi.scheduler.DONE and task_id in self._running_tasks:
+            task = self._scheduled_tasks[task_id]
+            invalidate_task_outputs(task)
+            record_complete_task(task)
+
+        super()._add_task(*args, **kwargs)
+
     def _create_task_process(self, task):
+        return self._create_batch_process(task, result_queue=self._task_result_queue)
+
+    def _create_batch_process(self, task, result_queue):
         batch_system = BatchSystems(get_setting("batch_system", default=BatchSystems.lsf, task=task))
 
         if batch_system == BatchSystems.lsf:
@@ -32,15 +108,122 @@ class SendJobWorker(luigi.worker.Worker):
         elif batch_system == BatchSystems.test:
             process_class = TestProcess
         elif batch_system == BatchSystems.local:
-            create_output_dirs(task)
-            return super()._create_task_process(task)
+            return self._create_local_task_process(task)
         else:
             raise NotImplementedError
 
         return process_class(task=task, scheduler=self._scheduler,
-                             result_queue=self._task_result_queue, worker_timeout=self._config.timeout)
+                             result_queue=result_queue, worker_timeout=self._config.timeout)
+
+    def _create_local_task_process(self, task):
+        create_output_dirs(task)
+        task_process = super()._create_task_process(task)
+        # Only the workers for local tasks decide whether to use an extra process, not the batch jobs
+        task_process.use_multiprocessing = self._config.force_multiprocessing or self._worker_processes > 1
+        return task_process
+
+
+class PilotWorker(SendJobWorker):
+    """
+    luigi worker running in a pilot job (see :obj:`b2luigi.batch.pilots.PilotTask`).
+    It is started as a luigi assistant, so it runs any runnable task of the central scheduler
+    and it runs all of them locally. It stops after ``pilot_idle_timeout`` seconds (default 300)
+    without anything to do.
+    """
+    def _create_task_process(self, task):
+        return self._create_local_task_process(task)
+
+    def _keep_alive(self, get_work_response):
+        idle_timeout = get_setting("pilot_idle_timeout", default=300)
+        idle_since = self._idle_since or datetime.datetime.now()
+        return (datetime.datetime.now() - idle_since).total_seconds() < idle_timeout
+
+
+class SendPilotWorker(SendJobWorker):
+    """
+    luigi worker of the scheduling process, if the tasks are run by pilot jobs (setting ``batch_pilots``).
+    It does not run any task itself, but only hands the tasks to the central scheduler, submits the
+    given number of pilot jobs (see :obj:`b2luigi.batch.pilots.PilotTask`) and waits until the pilots have
+    done all tasks or have stopped. Pilots still running at the end are killed.
+
+    Pilots can only be submitted to a batch system running a b2luigi process in the job,
+    so ``local`` and ``gbasf2`` are not supported.
+    """
+    #: Batch systems, which can not run pilot jobs
+    unsupported_batch_systems = (BatchSystems.local, BatchSystems.gbasf2)
+
+    def __init__(self, scheduler_host, scheduler_port, number_of_pilots, **kwargs):
+        pilot_tasks = [PilotTask(pilot_number=pilot_number, scheduler_host=scheduler_host,
+                                 scheduler_port=scheduler_port) for pilot_number in range(number_of_pilots)]
+        for pilot_task in pilot_tasks:
+            batch_system = BatchSystems(get_setting("batch_system", default=BatchSystems.lsf, task=pilot_task))
+            if batch_system in self.unsupported_batch_systems:
+                raise ValueError(f"Pilot jobs can not be run with the batch system {batch_system.value}, "
+                                 f"please use another batch system or turn off batch_pilots.")
+
+        super().__init__(worker_processes=0, **kwargs)
+
+        self._pilot_tasks = pilot_tasks
+        self._pilots = []
+
+    def __enter__(self):
+        super().__enter__()
+
+        # The pilots can already wait in the queue of the batch system while the tasks are scheduled
+        for pilot_task in self._pilot_tasks:
+            # The result of a pilot is not the result of any scheduled task
+            pilot = self._create_batch_process(pilot_task, result_queue=queue.Queue())
+            pilot.run()
+            self._pilots.append(pilot)
+
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pilots = collections.defaultdict(list)
+        for pilot in self._pilots:
+            pilots[pilot.__class__].append(pilot)
+
+        for process_class, processes in pilots.items():
+            process_class.terminate_all(processes)
+
+        return super().__exit__(type, value, traceback)
+
+    def run(self):
+        run_succeeded = super().run()
+
+        # The tasks were run by the pilots, so ask the scheduler for their results to show them in the summary
+        for status in [luigi.scheduler.DONE, luigi.scheduler.FAILED]:
+            for task_id in self._scheduler.task_list(status=status, upstream_status=""):
+                task = self._scheduled_tasks.get(task_id)
+                if task is not None:
+                    self._add_task_history.append((task, status, True))
+
+        return run_succeeded
+
+    def _keep_alive(self, get_work_response):
+        if not get_work_response.n_pending_tasks and not get_work_response.running_tasks:
+            return False
+
+        # Without any pilot, nobody would run the remaining tasks
+        return any(pilot.is_alive() for pilot in self._pilots)
 
 
 class SendJobWorkerSchedulerFactory(luigi.interface._WorkerSchedulerFactory):
     def create_worker(self, scheduler, worker_processes, assistant=False):
+        # Only pilot jobs start assistants
+        if assistant:
+            return PilotWorker(scheduler=scheduler, worker_processes=worker_processes, assistant=assistant)
         return SendJobWorker(scheduler=scheduler, worker_processes=worker_processes, assistant=assistant)
+
+
+class SendPilotWorkerSchedulerFactory(luigi.interface._WorkerSchedulerFactory):
+    def __init__(self, scheduler_host, scheduler_port, number_of_pilots):
+        super().__init__()
+
+        self.scheduler_host = scheduler_host
+        self.scheduler_port = scheduler_port
+        self.number_of_pilots = number_of_pilots
+
+    def create_worker(self, scheduler, worker_processes, assistant=False):
+        return SendPilotWorker(scheduler_host=self.scheduler_host, scheduler_port=self.scheduler_port,
+                               number_of_pilots=self.number_of_pilots, scheduler=scheduler)
@@ -27,6 +27,11 @@ def get_cli_arguments(ignore_additional_command_line_args=False):
     parser.add_argument("--dry-run",
                         help="Do not run any task but set the return value to 0, if the tasks are complete.",
                         action="store_true")
+    parser.add_argument("--complete-check-threads",
+                        help="If given, check the completeness of all tasks with this number of threads in parallel "
+                             "before scheduling (or in the dry-run).",
+                        type=int,
+                        default=0)
     parser.add_argument("--scheduler-host",
                         help="If given, use this host as a central scheduler instead of a local one.", default="")
     parser.add_argument("--scheduler-port",
@@ -36,6 +41,8 @@ def get_cli_arguments(ignore_additional_command_line_args=False):
 
     parser.add_argument("--task-id",
                         help="EXPERT.", default="")
+    parser.add_argument("--task-file",
+                        help="EXPERT.", default="")
 
     if not ignore_additional_command_line_args:
         args = parser.parse_args()
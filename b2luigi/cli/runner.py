@@ -1,44 +1,81 @@
 import collections
+import time
 
 import luigi
 import luigi.server
 import luigi.configuration
 
-from b2luigi.batch.workers import SendJobWorkerSchedulerFactory
-from b2luigi.core.settings import set_setting
-from b2luigi.core.utils import task_iterator, get_all_output_files_in_tree
-from b2luigi.core.utils import create_output_dirs
+from b2luigi.batch.workers import SendJobWorkerSchedulerFactory, SendPilotWorkerSchedulerFactory
+from b2luigi.core.settings import get_setting, set_setting
+from b2luigi.core.task_index import get_task_index
+from b2luigi.core.utils import task_iterator, get_all_output_files_in_tree, check_complete_in_parallel
+from b2luigi.core.utils import remember_completeness, forget_completeness
+from b2luigi.core.utils import create_output_dirs, create_task_from_description, write_job_status
 
 
 def run_as_batch_worker(task_list, cli_args, kwargs):
-    found_task = False
-    for root_task in task_list:
-        for task in task_iterator(root_task):
-            if task.task_id != cli_args.task_id:
-                continue
+    task = _get_batch_worker_task(task_list, cli_args)
+    set_setting("_dispatch_local_execution", True)
 
-            found_task = True
-            set_setting("_dispatch_local_execution", True)
+    # TODO: We do not process the information if (a) we have a new dependency and (b) why the task has failed.
+    # TODO: Would be also nice to run the event handlers
+    start_time = time.time()
+    try:
+        create_output_dirs(task)
+        task.run()
+        task.on_success()
+    except BaseException as ex:
+        task.on_failure(ex)
+        _write_job_status(task, exit_status=1, start_time=start_time)
+        raise ex
+
+    _write_job_status(task, exit_status=0, start_time=start_time)
+
+
+def _write_job_status(task, exit_status, start_time):
+    # The job status file is only a shortcut for the scheduling process, so a problem here should not fail the task
+    try:
+        write_job_status(task, exit_status=exit_status, start_time=start_time, end_time=time.time())
+    except OSError:
+        pass
+
+
+def _get_batch_worker_task(task_list, cli_args):
+    # Rebuilding the task from its description is fast, so try this first
+    if cli_args.task_file:
+        try:
+            task = create_task_from_description(cli_args.task_file)
+        except Exception:
+            # Any problem (missing file, changed task definitions etc.) is handled by the fallback below
+            task = None
+
+        if task is not None and task.task_id == cli_args.task_id:
+            return task
+
+    # Otherwise reproduce the task graph and search for the task
+    visited = set()
+    for root_task in task_list:
+        for task in task_iterator(root_task, visited=visited):
+            if task.task_id == cli_args.task_id:
+                return task
 
-            # TODO: We do not process the information if (a) we have a new dependency and (b) why the task has failed.
-            # TODO: Would be also nice to run the event handlers
-            try:
-                create_output_dirs(task)
-                task.run()
-                task.on_success()
-            except BaseException as ex:
-                task.on_failure(ex)
-                raise ex
+    raise ValueError(f"The task id {cli_args.task_id} to be executed by this batch worker "
+                     f"does not exist in the locally reproduced task graph.")
 
-            return
 
-    if not found_task:
-        raise ValueError(f"The task id {task.task_id} to be executed by this batch worker "
-                         f"does not exist in the locally reproduced task graph.")
+def run_batched(task_list, cli_args, kwargs):
+    number_of_pilots = get_setting("batch_pilots", default=0)
+    if not number_of_pilots:
+        run_luigi(task_list, cli_args, kwargs)
+        return
 
+    # The pilots ask the central scheduler for their tasks
+    if not (cli_args.scheduler_host or cli_args.scheduler_port):
+        raise ValueError("Pilot jobs need a central scheduler, please give --scheduler-host and --scheduler-port.")
 
-def run_batched(task_list, cli_args, kwargs):
-    run_luigi(task_list, cli_args, kwargs)
+    scheduler_host, scheduler_port = _get_scheduler_address(cli_args)
+    worker_scheduler_factory = SendPilotWorkerSchedulerFactory(scheduler_host, scheduler_port, number_of_pilots)
+    run_luigi(task_list, cli_args, kwargs, worker_scheduler_factory=worker_scheduler_factory)
 
 
 def run_local(task_list, cli_args, kwargs):
@@ -46,20 +83,33 @@ def run_local(task_list, cli_args, kwargs):
     run_luigi(task_list, cli_args, kwargs)
 
 
-def run_luigi(task_list, cli_args, kwargs):
+def run_luigi(task_list, cli_args, kwargs, worker_scheduler_factory=None):
+    # luigi does not know about the task index, so we need to check the tasks beforehand to make use of it
+    if cli_args.complete_check_threads or get_task_index() is not None:
+        completeness = check_complete_in_parallel(task_list, threads=cli_args.complete_check_threads or 1)
+        # The workers hand the complete tasks to the completion cache of luigi
+        remember_completeness(completeness)
+
     if cli_args.scheduler_host or cli_args.scheduler_port:
-        core_settings = luigi.interface.core()
-        host = cli_args.scheduler_host or core_settings.scheduler_host
-        port = int(cli_args.scheduler_port) or core_settings.scheduler_port
-        kwargs["scheduler_host"] = host
-        kwargs["scheduler_port"] = port
+        kwargs["scheduler_host"], kwargs["scheduler_port"] = _get_scheduler_address(cli_args)
     else:
         kwargs["local_scheduler"] = True
 
-    kwargs["worker_scheduler_factory"] = SendJobWorkerSchedulerFactory()
+    kwargs["worker_scheduler_factory"] = worker_scheduler_factory or SendJobWorkerSchedulerFactory()
 
     kwargs.setdefault("log_level", "INFO")
-    luigi.build(task_list, **kwargs)
+    try:
+        luigi.build(task_list, **kwargs)
+    finally:
+        # The tasks may change until the next call (e.g. in the same notebook)
+        forget_completeness()
+
+
+def _get_scheduler_address(cli_args):
+    core_settings = luigi.interface.core()
+    host = cli_args.scheduler_host or core_settings.scheduler_host
+    port = int(cli_args.scheduler_port) or core_settings.scheduler_port
+    return host, port
 
 
 def run_test_mode(task_list, cli_args, kwargs):
@@ -72,8 +122,9 @@ def show_all_outputs(task_list, *args, **kwargs):
 
     all_output_files = collections.defaultdict(list)
 
+    visited = set()
     for task in task_list:
-        output_files = get_all_output_files_in_tree(task)
+        output_files = get_all_output_files_in_tree(task, visited=visited)
         for key, file_names in output_files.items():
             all_output_files[key] += file_names
 
@@ -90,11 +141,16 @@ def show_all_outputs(task_list, *args, **kwargs):
         print()
 
 
-def dry_run(task_list):
+def dry_run(task_list, complete_check_threads=0):
     nonfinished_task_list = collections.defaultdict(set)
 
+    visited = set()
+    completeness = {}
+    if complete_check_threads:
+        check_complete_in_parallel(task_list, threads=complete_check_threads, completeness=completeness)
+
     for root_task in task_list:
-        for task in task_iterator(root_task, only_non_complete=True):
+        for task in task_iterator(root_task, only_non_complete=True, visited=visited, completeness=completeness):
             nonfinished_task_list[task.__class__.__name__].add(task)
 
     non_completed_tasks = 0
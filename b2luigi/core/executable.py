@@ -1,10 +1,11 @@
 import os
+import shlex
 import stat
 import subprocess
 
 from b2luigi.core.settings import get_setting
 from b2luigi.core.utils import (add_on_failure_function, create_cmd_from_task, get_filename, get_log_file_dir,
-                                get_task_file_dir, map_folder)
+                                get_task_file_dir, map_folder, write_task_description)
 
 
 def create_executable_wrapper(task):
@@ -57,6 +58,9 @@ def create_executable_wrapper(task):
     with open(executable_wrapper_path, "w") as f:
         f.write("\n".join(executable_wrapper_content))
 
+    # Store how to rebuild the task, so the batch worker does not need to search the whole task graph for it
+    write_task_description(task)
+
     # make wrapper executable
     st = os.stat(executable_wrapper_path)
     os.chmod(executable_wrapper_path, st.st_mode | stat.S_IEXEC)
@@ -64,6 +68,51 @@ def create_executable_wrapper(task):
     return executable_wrapper_path
 
 
+def create_bundle_wrapper(tasks, parallel=False):
+    """
+    Create an executable bash script, which runs the executable wrappers (see :obj:`create_executable_wrapper`)
+    of all given tasks one after the other or all at the same time (if ``parallel`` is True),
+    e.g. to run many short tasks in a single batch job.
+    The output of every task is written into the files ``bundled_stdout`` and ``bundled_stderr``
+    in its log folder. The script fails, if at least one of the tasks has failed.
+    It is written into the folder of the first task.
+    """
+    shell = get_setting("shell", task=tasks[0], default="bash")
+    bundle_wrapper_content = [f"#!/bin/{shell}", "exit_status=0"]
+
+    for task in tasks:
+        log_file_dir = get_log_file_dir(task)
+        os.makedirs(log_file_dir, exist_ok=True)
+
+        stdout_log_file = shlex.quote(os.path.abspath(os.path.join(log_file_dir, "bundled_stdout")))
+        stderr_log_file = shlex.quote(os.path.abspath(os.path.join(log_file_dir, "bundled_stderr")))
+        executable_file = shlex.quote(os.path.abspath(create_executable_wrapper(task)))
+
+        command = f"{executable_file} > {stdout_log_file} 2> {stderr_log_file}"
+        if parallel:
+            bundle_wrapper_content.append(f"{command} &")
+        else:
+            bundle_wrapper_content.append(f"{command} || exit_status=1")
+
+    if parallel:
+        bundle_wrapper_content.append("for job in $(jobs -p); do wait $job || exit_status=1; done")
+
+    bundle_wrapper_content.append("exit $exit_status")
+
+    bundle_file_dir = get_task_file_dir(tasks[0])
+    os.makedirs(bundle_file_dir, exist_ok=True)
+
+    bundle_wrapper_path = os.path.join(bundle_file_dir, "bundle_wrapper.sh")
+
+    with open(bundle_wrapper_path, "w") as f:
+        f.write("\n".join(bundle_wrapper_content) + "\n")
+
+    st = os.stat(bundle_wrapper_path)
+    os.chmod(bundle_wrapper_path, st.st_mode | stat.S_IEXEC)
+
+    return bundle_wrapper_path
+
+
 def run_task_remote(task):
     """
     Run a given task "remotely", which means
@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 import contextlib
@@ -6,6 +7,14 @@ import warnings
 # The global object hosting the current settings
 _current_global_settings = {}
 
+# Parsed settings files, keyed by their path. Each entry holds the stat signature
+# of the file at the time it was parsed together with its content.
+_settings_file_cache = {}
+
+# Merged settings of all files up the tree, keyed by the stat signatures of the files.
+# As a missing key is simply not part of the merged dictionary, this also caches negative lookups.
+_merged_settings_cache = {}
+
 
 def get_setting(key, default=None, task=None, deprecated_keys=None):
     """
@@ -45,6 +54,9 @@ def get_setting(key, default=None, task=None, deprecated_keys=None):
        script *or any folder above that*.
        This makes it possible to have general project settings (e.g. the output path
        or the batch system) and a specific ``settings.json`` for your sub-project.
+       Each ``settings.json`` is only parsed once and re-read whenever its
+       modification time (or size) changes, so you can still edit it while
+       your script is running.
 
     With this function, you can get the current value of a specific setting with the given key.
     If there is no setting defined with this name,
@@ -103,18 +115,79 @@ def clear_setting(key):
         pass
 
 
-def _setting_file_iterator():
+def _setting_file_signatures():
+    """
+    Return a tuple of (path, mtime, size) for all settings files from the
+    current working directory up the tree, with the closest file first.
+    Only a single stat call is needed per folder.
+    """
+    signatures = []
     path = os.getcwd()
 
     while True:
         json_file = os.path.join(path, "settings.json")
-        if os.path.exists(json_file):
-            yield json_file
+        try:
+            stat_result = os.stat(json_file)
+        except OSError:
+            pass
+        else:
+            signatures.append((json_file, stat_result.st_mtime_ns, stat_result.st_size))
 
         path = os.path.split(path)[0]
         if path == "/":
             break
 
+    return tuple(signatures)
+
+
+def _load_settings_file(json_file, signature):
+    """
+    Return the content of the given settings file, parsing it
+    only if it has changed since the last call.
+    """
+    try:
+        cached_signature, content = _settings_file_cache[json_file]
+        if cached_signature == signature:
+            return content
+    except KeyError:
+        pass
+
+    with open(json_file, "r") as f:
+        content = json.load(f)
+
+    _settings_file_cache[json_file] = (signature, content)
+    return content
+
+
+def _get_file_settings():
+    """
+    Return the merged content of all settings files up the tree,
+    where settings of closer files override the ones further up.
+    """
+    signatures = _setting_file_signatures()
+
+    try:
+        return _merged_settings_cache[signatures]
+    except KeyError:
+        pass
+
+    merged_settings = {}
+    for json_file, mtime, size in reversed(signatures):
+        merged_settings.update(_load_settings_file(json_file, (mtime, size)))
+
+    # Outdated entries are never hit again, so just start over if too many accumulate
+    if len(_merged_settings_cache) > 100:
+        _merged_settings_cache.clear()
+    _merged_settings_cache[signatures] = merged_settings
+
+    return merged_settings
+
+
+def _clear_settings_file_cache():
+    """Forget all parsed settings files, e.g. for testing."""
+    _settings_file_cache.clear()
+    _merged_settings_cache.clear()
+
 
 @contextlib.contextmanager
 def with_new_settings():
@@ -149,13 +222,15 @@ def _get_setting_implementation(key, task):
         pass
 
     # And finally check the settings files
-    for settings_file in _setting_file_iterator():
-        try:
-            with open(settings_file, "r") as f:
-                j = json.load(f)
-                return j[key]
-        except KeyError:
-            pass
+    try:
+        value = _get_file_settings()[key]
+    except KeyError:
+        pass
+    else:
+        # The parsed content is shared between calls, so make sure nobody modifies it
+        if isinstance(value, (dict, list)):
+            return copy.deepcopy(value)
+        return value
 
     # The setting was not found, so raise a KeyError
     raise KeyError(f"No settings found for {key}!")
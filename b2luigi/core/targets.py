@@ -0,0 +1,118 @@
+import contextlib
+import os
+import threading
+
+import luigi
+
+
+class TargetExistenceCache:
+    """
+    Cache for the existence of files, which lists a whole folder with a single
+    ``os.scandir`` call and answers all further existence checks for files in the same
+    folder from memory.
+    As all outputs created with :meth:`b2luigi.Task.add_to_output` live in
+    a predictable folder structure, this turns one file system request per file into one per folder.
+
+    The cache does not notice files created or removed by others. Therefore the listing of a folder
+    needs to be invalidated whenever b2luigi creates or moves outputs, which is done by the
+    :obj:`CachedLocalTarget` itself and whenever a task has run successfully.
+    """
+    def __init__(self):
+        self._directory_listings = {}
+        self._lock = threading.Lock()
+        # Increased on every invalidation, to not store listings which might have been outdated meanwhile
+        self._generation = 0
+
+    def exists(self, path):
+        directory, file_name = os.path.split(os.path.abspath(path))
+
+        with self._lock:
+            listing = self._directory_listings.get(directory)
+            generation = self._generation
+
+        if listing is None:
+            listing = self._list_directory(directory)
+
+            with self._lock:
+                if generation == self._generation:
+                    self._directory_listings[directory] = listing
+
+        return file_name in listing
+
+    def invalidate(self, path):
+        """Forget the listing of the folder of the given path (and of the path itself, if it is a folder)."""
+        path = os.path.abspath(path)
+
+        with self._lock:
+            self._generation += 1
+            self._directory_listings.pop(path, None)
+            self._directory_listings.pop(os.path.dirname(path), None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._directory_listings.clear()
+
+    def __len__(self):
+        return len(self._directory_listings)
+
+    @staticmethod
+    def _list_directory(directory):
+        try:
+            with os.scandir(directory) as entries:
+                return frozenset(entry.name for entry in entries)
+        except (FileNotFoundError, NotADirectoryError):
+            return frozenset()
+
+
+_target_existence_cache = TargetExistenceCache()
+
+
+class CachedLocalTarget(luigi.LocalTarget):
+    """
+    ``luigi.LocalTarget``, which uses the :obj:`TargetExistenceCache` to check for its existence.
+    Used for the outputs of :meth:`b2luigi.Task.add_to_output`, if the setting ``cache_target_existence``
+    is turned on.
+    """
+    def exists(self):
+        return _target_existence_cache.exists(self.path)
+
+    def makedirs(self):
+        super().makedirs()
+        _target_existence_cache.invalidate(self.path)
+
+    def move(self, new_path, raise_if_exists=False):
+        super().move(new_path, raise_if_exists=raise_if_exists)
+        _target_existence_cache.invalidate(self.path)
+        _target_existence_cache.invalidate(new_path)
+
+    def remove(self):
+        super().remove()
+        _target_existence_cache.invalidate(self.path)
+
+    @contextlib.contextmanager
+    def temporary_path(self):
+        try:
+            with super().temporary_path() as temporary_path:
+                yield temporary_path
+        finally:
+            _target_existence_cache.invalidate(self.path)
+
+
+def invalidate_task_outputs(task):
+    """Forget the cached existence of all outputs of the given task, e.g. because it has just run."""
+    # Nothing to do (and no need to call the output function) if the cache is not used at all
+    if not len(_target_existence_cache):
+        return
+
+    for target in luigi.task.flatten(task.output()):
+        try:
+            path = target.path
+        except AttributeError:
+            continue
+        _target_existence_cache.invalidate(path)
+
+
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def _invalidate_outputs_on_success(task):
+    invalidate_task_outputs(task)
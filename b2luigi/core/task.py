@@ -1,7 +1,11 @@
+import os
+
 from b2luigi.core import utils
 
 import luigi
 
+from b2luigi.core.settings import get_setting
+from b2luigi.core.targets import CachedLocalTarget
 from b2luigi.core.utils import create_output_file_name
 
 
@@ -51,6 +55,12 @@ class Task(luigi.Task):
         This function will automatically use a ``LocalTarget``.
         If you do not want this, you can override the :obj:`_get_output_file_target` function.
 
+        If you turn on the setting ``cache_target_existence``, the existence of the targets
+        is checked by listing the content of their folder only once and answering all further
+        checks for files in the same folder from memory.
+        This speeds up the completeness checks of large task graphs considerably,
+        but you should only use it if your outputs are only created by b2luigi tasks.
+
         Example:
             This adds two files called ``some_file.txt`` and ``some_other_file.txt`` to the output::
 
@@ -82,6 +92,10 @@ class Task(luigi.Task):
         Either use the key argument or dictionary indexing with the key given to :obj:`add_to_output`
         to get back a list (!) of file paths.
 
+        The input file names are only collected once per task instance.
+        If the requirements of your task can change, set ``cache_input_file_names``
+        to ``False`` in your task to turn this off.
+
         Args:
             key (:obj:`str`, optional): If given, only return a list of file paths with this given key.
 
@@ -89,7 +103,33 @@ class Task(luigi.Task):
             If key is none, returns a dictionary of keys to list of file paths.
             Else, returns only the list of file paths for this given key.
         """
-        return self._transform_input(self.input(), key)
+        return self._get_input_file_names(key=key)
+
+    def iter_input_file_names(self, key):
+        """
+        Lazy version of :obj:`get_input_file_names` for a single key:
+        yield the file paths with the given key one by one, without building up the full
+        dictionary of all input file names first.
+        Useful for tasks with a very large number of requirements, which only need to
+        go once through the file names.
+        In contrast to :obj:`get_input_file_names`, an unknown key does not raise an error,
+        but just yields nothing.
+
+        Args:
+            key (:obj:`str`): Yield all file paths with this given key.
+        """
+        if self._cache_input_file_names():
+            input_file_names = getattr(self, "_input_file_names", {})
+            if None in input_file_names:
+                # A task without any inputs has no file names at all
+                file_paths = input_file_names[None] or {}
+                yield from file_paths.get(key, [])
+                return
+
+        for input_dict in map(utils._to_dict, utils._iter_flatten(self.input())):
+            for input_key, value in input_dict.items():
+                if os.path.basename(utils.flatten_to_file_paths(input_key)) == key:
+                    yield utils.flatten_to_file_paths(value)
 
     def get_input_file_names_from_dict(self, requirement_key, key=None):
         """
@@ -138,7 +178,56 @@ class Task(luigi.Task):
             If key is none, returns a dictionary of keys to list of file paths.
             Else, returns only the list of file paths for this given key.
         """
-        return self._transform_input(self.input()[requirement_key], key)
+        return self._get_input_file_names(requirement_key=requirement_key, key=key)
+
+    def _get_input_file_names(self, requirement_key=None, key=None):
+        if not self._cache_input_file_names():
+            input_generator = self.input() if requirement_key is None else self.input()[requirement_key]
+            file_paths = self._transform_input(input_generator)
+        else:
+            file_paths = self._get_cached_input_file_names(requirement_key)
+
+        # A task without any inputs has no file names at all
+        if not file_paths:
+            return [] if key is not None else {}
+
+        if not self._cache_input_file_names():
+            return file_paths[key] if key is not None else file_paths
+
+        # Hand out copies, so the cached lists can not be changed by the caller
+        if key is not None:
+            return self._copy_if_list(file_paths[key])
+        return {file_key: self._copy_if_list(values) for file_key, values in file_paths.items()}
+
+    def _get_cached_input_file_names(self, requirement_key):
+        try:
+            input_file_names = self._input_file_names
+        except AttributeError:
+            input_file_names = self._input_file_names = {}
+
+        try:
+            return input_file_names[requirement_key]
+        except KeyError:
+            pass
+
+        input_generator = self.input() if requirement_key is None else self.input()[requirement_key]
+        file_paths = input_file_names[requirement_key] = self._transform_input(input_generator)
+        return file_paths
+
+    @staticmethod
+    def _copy_if_list(values):
+        if isinstance(values, list):
+            return list(values)
+        return values
+
+    def _cache_input_file_names(self):
+        try:
+            return self._use_input_file_names_cache
+        except AttributeError:
+            pass
+
+        self._use_input_file_names_cache = get_setting("cache_input_file_names", task=self, default=True)
+        return self._use_input_file_names_cache
 
     def get_output_file_name(self, key):
         """
@@ -155,10 +244,22 @@ class Task(luigi.Task):
         Return:
             Returns only the file path for this given key.
         """
-        target = self._get_output_target(key)
-        file_paths = utils.flatten_to_file_paths(target)
+        if not self._cache_output_targets():
+            return utils.flatten_to_file_paths(self._get_output_target(key))
 
-        return file_paths
+        try:
+            output_file_names = self._output_file_names
+        except AttributeError:
+            output_file_names = self._output_file_names = {}
+
+        try:
+            return output_file_names[key]
+        except KeyError:
+            pass
+
+        file_path = utils.flatten_to_file_paths(self._get_output_target(key))
+        output_file_names[key] = file_path
+        return file_path
 
     def _get_input_targets(self, key):
         """Shortcut to get the input targets for a given key. Will return a luigi target."""
@@ -167,11 +268,50 @@ class Task(luigi.Task):
 
     def _get_output_target(self, key):
         """Shortcut to get the output target for a given key. Will return a luigi target."""
-        output_dict = utils.flatten_to_dict(self.output())
-        return output_dict[key]
+        return self._get_output_target_dict()[key]
+
+    def _get_output_target_dict(self):
+        """
+        Return the dictionary of all output targets of this task.
+        As the outputs normally only depend on the (immutable) parameters,
+        it is only created once per task instance.
+        If the outputs of your task can change, set ``cache_output_targets``
+        to ``False`` in your task to turn this off.
+        """
+        if not self._cache_output_targets():
+            return utils.flatten_to_dict(self.output())
+
+        try:
+            return self._output_target_dict
+        except AttributeError:
+            pass
+
+        self._output_target_dict = utils.flatten_to_dict(self.output())
+        return self._output_target_dict
+
+    def _cache_output_targets(self):
+        try:
+            return self._use_output_target_cache
+        except AttributeError:
+            pass
+
+        self._use_output_target_cache = get_setting("cache_output_targets", task=self, default=True)
+        return self._use_output_target_cache
+
+    def _get_serialized_parameters(self):
+        """Return the serialized parameters of this task, which are only created once per task instance."""
+        try:
+            return self._serialized_parameters
+        except AttributeError:
+            pass
+
+        self._serialized_parameters = utils.get_serialized_parameters(self)
+        return self._serialized_parameters
 
     def _get_output_file_target(self, base_filename, **kwargs):
         file_name = create_output_file_name(self, base_filename, **kwargs)
+        if get_setting("cache_target_existence", task=self, default=False):
+            return CachedLocalTarget(file_name)
         return luigi.LocalTarget(file_name)
 
 
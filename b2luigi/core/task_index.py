@@ -0,0 +1,199 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from b2luigi.core.settings import get_setting
+from b2luigi.core.utils import flatten_to_dict, flatten_to_file_paths, get_serialized_parameters, map_folder
+
+
+class TaskIndex:
+    """
+    Persistent on-disk index (a SQLite database) of completed tasks.
+    For every task it stores the serialized parameters and the paths of all
+    output files together with their modification time and size at the moment
+    the task was seen complete.
+
+    On a restart of a large task graph, tasks found in the index do not need to be
+    checked by calling their ``complete()`` function (which might e.g. open ROOT files),
+    and their dependencies are skipped as usual for complete tasks.
+    The same information is also used to answer ``--show-output``.
+
+    How much the index is trusted is controlled by the ``validation`` mode:
+
+    * ``"lazy"`` (default): whenever a task is looked up, the modification time and size of
+      its outputs are compared with the stored values (a single stat per file).
+      If anything changed or is missing, the entry is dropped and the task is checked normally.
+    * ``"none"``: the index is trusted without looking at the file system at all.
+
+    Only tasks, whose outputs are all files, are added to the index.
+    Use the ``task_index`` setting to turn it on, see :obj:`get_task_index`.
+    """
+    #: Number of added entries after which the changes are written to disk
+    commit_interval = 1000
+
+    def __init__(self, path, validation="lazy"):
+        if validation not in ("lazy", "none"):
+            raise ValueError(f"Unknown validation mode {validation} for the task index. Use 'lazy' or 'none'.")
+
+        self.path = path
+        self.validation = validation
+
+        self._lock = threading.Lock()
+        self._uncommitted_changes = 0
+
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                                 "task_id TEXT PRIMARY KEY, task_family TEXT, parameters TEXT, "
+                                 "outputs TEXT, recorded_at REAL)")
+        self._connection.commit()
+
+        atexit.register(self.commit)
+
+    def record(self, task):
+        """
+        Add the task to the index, assuming it is complete.
+        Returns False, if the task could not be added (because it has non-file or missing outputs).
+        """
+        outputs = []
+
+        for target_key, target in flatten_to_dict(task.output()).items():
+            try:
+                file_key, file_name = flatten_to_file_paths({target_key: target}).popitem()
+                stat_result = os.stat(file_name)
+            except (AttributeError, OSError):
+                return False
+
+            outputs.append((file_key, os.path.abspath(file_name), stat_result.st_mtime_ns, stat_result.st_size))
+
+        if not outputs:
+            return False
+
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)",
+                                     (task.task_id, task.get_task_family(),
+                                      json.dumps(get_serialized_parameters(task)), json.dumps(outputs), time.time()))
+            self._changed()
+
+        return True
+
+    def get(self, task_id):
+        """
+        Return the entry of the task with the given id as a dictionary
+        (with the keys ``task_family``, ``parameters`` and ``outputs``)
+        or None, if the task is not in the index or the entry is outdated.
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT task_family, parameters, outputs FROM tasks WHERE task_id = ?",
+                                           (task_id, )).fetchone()
+
+        if row is None:
+            return None
+
+        task_family, parameters, outputs = row
+        outputs = json.loads(outputs)
+
+        if self.validation == "lazy" and not self._outputs_are_unchanged(outputs):
+            self.remove(task_id)
+            return None
+
+        return dict(task_family=task_family, parameters=json.loads(parameters), outputs=outputs)
+
+    def is_complete(self, task):
+        """Return True, if the task is in the index (and its outputs did not change)."""
+        return self.get(task.task_id) is not None
+
+    def remove(self, task_id):
+        with self._lock:
+            self._connection.execute("DELETE FROM tasks WHERE task_id = ?", (task_id, ))
+            self._changed()
+
+    def commit(self):
+        with self._lock:
+            self._connection.commit()
+            self._uncommitted_changes = 0
+
+    def close(self):
+        atexit.unregister(self.commit)
+        self.commit()
+        self._connection.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def _changed(self):
+        self._uncommitted_changes += 1
+        if self._uncommitted_changes >= self.commit_interval:
+            self._connection.commit()
+            self._uncommitted_changes = 0
+
+    @staticmethod
+    def _outputs_are_unchanged(outputs):
+        for _, file_name, mtime, size in outputs:
+            try:
+                stat_result = os.stat(file_name)
+            except OSError:
+                return False
+
+            if stat_result.st_mtime_ns != mtime or stat_result.st_size != size:
+                return False
+
+        return True
+
+
+# Opened task indices, keyed by their path and validation mode
+_task_indices = {}
+
+
+def get_task_index():
+    """
+    Return the :obj:`TaskIndex` configured with the ``task_index`` setting (the path
+    of the database file, relative paths are evaluated relative to your script)
+    or None, if no index should be used.
+    The validation mode can be chosen with the ``task_index_validation`` setting.
+    """
+    path = get_setting("task_index", default=False)
+    if not path:
+        return None
+
+    path = map_folder(path)
+    validation = get_setting("task_index_validation", default="lazy")
+
+    try:
+        return _task_indices[(path, validation)]
+    except KeyError:
+        pass
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    task_index = TaskIndex(path, validation=validation)
+    _task_indices[(path, validation)] = task_index
+
+    return task_index
+
+
+def check_complete(task):
+    """
+    Same as calling ``task.complete()``, but answered from the task index if possible.
+    Complete tasks are added to the index.
+    """
+    task_index = get_task_index()
+    if task_index is None:
+        return task.complete()
+
+    if task_index.is_complete(task):
+        return True
+
+    is_complete = task.complete()
+    if is_complete:
+        task_index.record(task)
+    return is_complete
+
+
+def record_complete_task(task):
+    """Add the given task to the task index (if one is used), e.g. after it has run successfully."""
+    task_index = get_task_index()
+    if task_index is not None:
+        task_index.record(task)
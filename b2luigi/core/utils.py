@@ -1,7 +1,10 @@
+import concurrent.futures
 import contextlib
 import importlib
 
+import collections.abc
 import itertools
+import json
 import os
 import collections
 import sys
@@ -9,6 +12,7 @@ import types
 import warnings
 
 import colorama
+from luigi.task_register import Register
 
 from b2luigi.core.settings import get_setting
 
@@ -71,7 +75,7 @@ def fill_kwargs_with_lists(**kwargs):
     for key, value in kwargs.items():
         if value is None:
             value = []
-        if isinstance(value, str) or not isinstance(value, collections.Iterable):
+        if isinstance(value, str) or not isinstance(value, collections.abc.Iterable):
             value = [value]
         return_kwargs[key] = value
 
@@ -118,40 +122,178 @@ def flatten_to_dict(inputs):
     :param inputs: The input structure
     :return: A dict constructed as described above.
     """
-    inputs = _flatten(inputs)
-    inputs = map(_to_dict, inputs)
-
     joined_dict = {}
-    for i in inputs:
-        for key, value in i.items():
-            joined_dict[key] = value
+    for item in _iter_flatten(inputs):
+        if isinstance(item, dict):
+            joined_dict.update(item)
+        else:
+            joined_dict[item] = item
     return joined_dict
 
 
 def flatten_to_list_of_dicts(inputs):
-    inputs = _flatten(inputs)
-    inputs = map(_to_dict, inputs)
-
     joined_dict = collections.defaultdict(list)
-    for i in inputs:
-        for key, value in i.items():
-            joined_dict[key].append(value)
+    for item in _iter_flatten(inputs):
+        if isinstance(item, dict):
+            for key, value in item.items():
+                joined_dict[key].append(value)
+        else:
+            joined_dict[item].append(item)
     return dict(joined_dict)
 
 
-def task_iterator(task, only_non_complete=False):
-    if not only_non_complete or not task.complete():
+def task_iterator(task, only_non_complete=False, visited=None, completeness=None):
+    """
+    Iterate over the given task and all its (direct and indirect) dependencies
+    in depth-first order.
+    Every task is only yielded once, even if it is required by multiple other tasks.
+
+    Parameters:
+        task: The root task to start from.
+        only_non_complete (bool, optional): Only yield tasks which are not complete and
+            do not descend into the dependencies of complete tasks.
+        visited (set, optional): Task ids which should not be yielded (again).
+            Handing in the same set for multiple root tasks makes sure shared
+            dependencies are only visited once. Will be filled with the visited task ids.
+        completeness (dict, optional): Mapping of task ids to already known results of ``complete()``.
+            Will be filled with all results checked during the iteration.
+    """
+    if visited is None:
+        visited = set()
+    if completeness is None:
+        completeness = {}
+
+    stack = [task]
+    while stack:
+        task = stack.pop()
+
+        if task.task_id in visited:
+            continue
+        visited.add(task.task_id)
+
+        if only_non_complete:
+            if task.task_id not in completeness:
+                completeness[task.task_id] = _check_complete(task)
+            if completeness[task.task_id]:
+                continue
+
         yield task
-        for dep in task.deps():
-            yield from task_iterator(dep, only_non_complete=only_non_complete)
 
+        # reversed, so that the first dependency is processed first
+        stack.extend(reversed(task.deps()))
+
+
+def check_complete_in_parallel(task_list, threads, completeness=None, checked_tasks=None):
+    """
+    Check the completeness of all tasks in the graphs of the given root tasks
+    on a pool of ``threads`` threads.
+    This is especially useful on slow (shared) file systems, where a single check
+    of a target can take a long time.
+
+    Same as for :obj:`task_iterator` with ``only_non_complete=True``, dependencies
+    of complete tasks are not checked.
+    Tasks whose ``complete()`` raised an exception are not included in the result,
+    so the usual error handling can take place when they are checked again.
+
+    Parameters:
+        task_list (list): The root tasks.
+        threads (int): Maximal number of checks running in parallel.
+        completeness (dict, optional): Mapping of task ids to already known results of ``complete()``.
+            Will be filled with the results.
+        checked_tasks (dict, optional): Will be filled with a mapping of task ids to the checked task instances.
+
+    Return:
+        A mapping of task ids to the result of ``complete()``.
+    """
+    if completeness is None:
+        completeness = {}
+
+    def check(task):
+        try:
+            is_complete = completeness[task.task_id]
+        except KeyError:
+            try:
+                is_complete = _check_complete(task)
+            except Exception:
+                return None, []
+
+        if is_complete:
+            return True, []
+        return False, task.deps()
+
+    visited = set()
+    tasks_to_check = []
+    for task in task_list:
+        if task.task_id not in visited:
+            visited.add(task.task_id)
+            tasks_to_check.append(task)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        # Check the graph level by level, so only dependencies of incomplete tasks are checked
+        while tasks_to_check:
+            next_tasks_to_check = []
+
+            for task, (is_complete, deps) in zip(tasks_to_check, executor.map(check, tasks_to_check)):
+                if is_complete is None:
+                    continue
+                completeness[task.task_id] = is_complete
+                if checked_tasks is not None:
+                    checked_tasks[task.task_id] = task
+
+                for dep in deps:
+                    if dep.task_id not in visited:
+                        visited.add(dep.task_id)
+                        next_tasks_to_check.append(dep)
 
-def get_all_output_files_in_tree(root_module, key=None):
+            tasks_to_check = next_tasks_to_check
+
+    return completeness
+
+
+# Ids of the tasks already known to be complete, e.g. from a check of the whole graph before starting luigi
+_known_complete_task_ids = set()
+
+
+def remember_completeness(completeness):
+    """
+    Remember the results of completeness checks done beforehand (e.g. by :obj:`check_complete_in_parallel`),
+    so the luigi workers do not need to check the complete tasks again.
+    Same as luigi's own completion cache, a complete task is assumed to stay complete.
+
+    Parameters:
+        completeness (dict): Mapping of task ids to the result of ``complete()``.
+    """
+    _known_complete_task_ids.update(task_id for task_id, is_complete in completeness.items() if is_complete)
+
+
+def get_known_complete_task_ids():
+    """Return the ids of all tasks handed to :obj:`remember_completeness` as complete."""
+    return set(_known_complete_task_ids)
+
+
+def forget_completeness():
+    """Forget all results handed to :obj:`remember_completeness`."""
+    _known_complete_task_ids.clear()
+
+
+def get_all_output_files_in_tree(root_module, key=None, visited=None):
     if key:
-        return get_all_output_files_in_tree(root_module)[key]
+        return get_all_output_files_in_tree(root_module, visited=visited)[key]
+
+    from b2luigi.core.task_index import get_task_index
+    task_index = get_task_index()
 
     all_output_files = collections.defaultdict(list)
-    for task in task_iterator(root_module):
+    for task in task_iterator(root_module, visited=visited):
+        # Complete tasks can be answered from the task index without looking at the outputs
+        task_index_entry = task_index.get(task.task_id) if task_index is not None else None
+        if task_index_entry is not None:
+            for file_key, file_name, _, _ in task_index_entry["outputs"]:
+                all_output_files[file_key].append(dict(exists=True,
+                                                       parameters=task_index_entry["parameters"],
+                                                       file_name=file_name))
+            continue
+
         output_dict = flatten_to_dict(task.output())
         if not output_dict:
             continue
@@ -167,30 +309,103 @@ def get_all_output_files_in_tree(root_module, key=None):
     return all_output_files
 
 
-def filter_from_params(output_files, **kwargs):
-    kwargs_list = fill_kwargs_with_lists(**kwargs)
+class OutputParameterIndex:
+    """
+    Inverted index of output file records (as returned by :obj:`get_all_output_files_in_tree`
+    for a given key) from parameter name to parameter value to the records with this value.
+    Build it once, if you need to filter a large number of output files multiple times
+    with :obj:`filter_from_params`.
+
+    Example:
+        .. code-block:: python
+
+            output_files = get_all_output_files_in_tree(root_task, key="output.root")
+            index = OutputParameterIndex(output_files)
 
-    if not kwargs_list:
-        return output_files
+            for run_number in run_numbers:
+                files = filter_from_params(index, experiment_number=[7, 8], run_number=run_number)
+    """
+    def __init__(self, output_files):
+        self.output_files = list(output_files)
 
-    file_names = []
+        #: parameter name -> serialized value -> set of record ids
+        self._record_ids_by_value = collections.defaultdict(lambda: collections.defaultdict(set))
+        #: parameter name -> set of record ids of records without this parameter
+        self._record_ids_without_parameter = {}
 
-    for kwargs in product_dict(**kwargs_list):
-        for output_dict in output_files:
-            parameters = output_dict["parameters"]
+        for record_id, output_dict in enumerate(self.output_files):
+            for key, value in output_dict["parameters"].items():
+                self._record_ids_by_value[key][str(value)].add(record_id)
 
-            not_use = False
-            for key, value in kwargs.items():
-                if key in parameters and str(parameters[key]) != str(value):
-                    not_use = True
-                    break
+    def filter(self, **kwargs):
+        """Same as :obj:`filter_from_params`, but using the index."""
+        kwargs_list = fill_kwargs_with_lists(**kwargs)
 
-            if not_use:
-                continue
+        if not kwargs_list:
+            return self.output_files
+
+        matching_record_ids = None
+
+        for key, values in kwargs_list.items():
+            # Records without this parameter are not filtered out by it
+            record_ids = set(self._get_record_ids_without_parameter(key))
+
+            values_index = self._record_ids_by_value.get(key, {})
+            values = list(values)
+            if not values:
+                # Same as for the cross product of all values, an empty list does not match anything
+                return {}.values()
 
-            file_names.append(output_dict)
+            for value in values:
+                record_ids |= values_index.get(str(value), set())
 
-    return {x["file_name"]: x for x in file_names}.values()
+            if matching_record_ids is None:
+                matching_record_ids = record_ids
+            else:
+                matching_record_ids &= record_ids
+
+        file_names = (self.output_files[record_id] for record_id in sorted(matching_record_ids))
+        return {x["file_name"]: x for x in file_names}.values()
+
+    def _get_record_ids_without_parameter(self, key):
+        try:
+            return self._record_ids_without_parameter[key]
+        except KeyError:
+            pass
+
+        record_ids_with_parameter = set()
+        for record_ids in self._record_ids_by_value.get(key, {}).values():
+            record_ids_with_parameter |= record_ids
+
+        record_ids = set(range(len(self.output_files))) - record_ids_with_parameter
+        self._record_ids_without_parameter[key] = record_ids
+        return record_ids
+
+
+def filter_from_params(output_files, **kwargs):
+    """
+    Return only those output file records (as returned by :obj:`get_all_output_files_in_tree` for a given key),
+    whose parameters match the given keyword filters.
+    Each filter value can either be a single value or a list of allowed values.
+    Records, which do not have a parameter with this name at all, are not filtered out.
+
+    Parameters:
+        output_files: The list of output file records or an :obj:`OutputParameterIndex` built from it.
+            If you filter the same records multiple times, building the index once is faster.
+        kwargs: Parameter names and their allowed value(s).
+    """
+    if not isinstance(output_files, OutputParameterIndex):
+        if not fill_kwargs_with_lists(**kwargs):
+            return output_files
+        output_files = OutputParameterIndex(output_files)
+
+    return output_files.filter(**kwargs)
+
+
+def _check_complete(task):
+    # imported here, as the task index itself depends on the utilities in this module
+    from b2luigi.core.task_index import check_complete
+    return check_complete(task)
 
 
 def get_task_from_file(file_name, task_name, **kwargs):
@@ -223,7 +438,11 @@ def get_serialized_parameters(task):
 
 
 def create_output_file_name(task, base_filename, result_dir=None):
-    serialized_parameters = get_serialized_parameters(task)
+    if hasattr(task, "_get_serialized_parameters"):
+        # b2luigi tasks only serialize their parameters once
+        serialized_parameters = task._get_serialized_parameters()
+    else:
+        serialized_parameters = get_serialized_parameters(task)
 
     if not result_dir:
         # Be sure to evaluate things relative to the current executed file, not to where we are now
@@ -264,6 +483,101 @@ def get_task_file_dir(task):
     return task_file_dir
 
 
+def get_task_description_file(task):
+    """Return the path of the file describing how to reconstruct the given task, see :obj:`write_task_description`."""
+    return os.path.abspath(os.path.join(get_task_file_dir(task), "task_description.json"))
+
+
+def write_task_description(task):
+    """
+    Write out a compact description of the task (its family, module and serialized parameters)
+    into the task file dir.
+    A batch worker can rebuild the task directly from it with :obj:`create_task_from_description`,
+    instead of reconstructing the full task graph to find it.
+    """
+    task_description = {
+        "task_id": task.task_id,
+        "task_family": task.get_task_family(),
+        "task_module": task.__class__.__module__,
+        "parameters": task.to_str_params(),
+    }
+
+    task_description_file = get_task_description_file(task)
+    os.makedirs(os.path.dirname(task_description_file), exist_ok=True)
+
+    with open(task_description_file, "w") as f:
+        json.dump(task_description, f)
+
+    return task_description_file
+
+
+def create_task_from_description(task_description_file):
+    """
+    Rebuild a task from the description written by :obj:`write_task_description`.
+    The task class needs to be importable, which is always the case if it is defined
+    in the currently executed file (or any module imported by it).
+    """
+    with open(task_description_file, "r") as f:
+        task_description = json.load(f)
+
+    task_family = task_description["task_family"]
+    task_module = task_description["task_module"]
+
+    if task_family not in Register.task_names() and task_module != "__main__":
+        importlib.import_module(task_module)
+
+    task_class = Register.get_task_cls(task_family)
+    return task_class.from_str_params(task_description["parameters"])
+
+
+def get_job_status_file(task):
+    """Return the path of the file in which a batch worker reports the result of the task, see :obj:`write_job_status`."""
+    return os.path.abspath(os.path.join(get_task_file_dir(task), "job_status.json"))
+
+
+def write_job_status(task, exit_status, start_time, end_time):
+    """
+    Write the exit status (0 for success) and the start and end time of a task run by a batch worker
+    into the task file dir.
+    As this only needs a single look into the file system, the batch process checks this file before
+    asking the batch system for the status of the job.
+    The file is written atomically, so it is never read half-written.
+    """
+    job_status = {
+        "task_id": task.task_id,
+        "exit_status": exit_status,
+        "start_time": start_time,
+        "end_time": end_time,
+    }
+
+    job_status_file = get_job_status_file(task)
+    os.makedirs(os.path.dirname(job_status_file), exist_ok=True)
+
+    tmp_job_status_file = f"{job_status_file}.{os.getpid()}.tmp"
+    with open(tmp_job_status_file, "w") as f:
+        json.dump(job_status, f)
+    os.replace(tmp_job_status_file, job_status_file)
+
+    return job_status_file
+
+
+def read_job_status(job_status_file, task_id):
+    """
+    Return the content of the job status file written by :obj:`write_job_status` as a dictionary
+    or None, if the file does not exist (so the job has not finished) or belongs to another task.
+    """
+    try:
+        with open(job_status_file, "r") as f:
+            job_status = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if job_status.get("task_id") != task_id:
+        return None
+
+    return job_status
+
+
 def get_filename():
     import __main__
     return __main__.__file__
@@ -295,20 +609,44 @@ def _to_dict(d):
     return {d: d}
 
 
-def _flatten(struct):
-    if isinstance(struct, dict) or isinstance(struct, str):
-        return [struct]
+def _iter_flatten(struct):
+    """
+    Yield all leaves of the (arbitrarily nested) structure in order.
+    Dicts and strings are leaves, all other iterables are descended into.
+    Uses an explicit stack of iterators instead of recursion, so neither the nesting
+    depth is limited nor are intermediate lists created.
+    """
+    if isinstance(struct, (dict, str)):
+        yield struct
+        return
 
-    result = []
     try:
-        iterator = iter(struct)
+        stack = [iter(struct)]
     except TypeError:
-        return [struct]
+        yield struct
+        return
 
-    for f in iterator:
-        result += _flatten(f)
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, (dict, str)):
+                yield item
+                continue
+
+            try:
+                iterator = iter(item)
+            except TypeError:
+                yield item
+                continue
 
-    return result
+            # descend into the item and continue with the rest of this level afterwards
+            stack.append(iterator)
+            break
+        else:
+            stack.pop()
+
+
+def _flatten(struct):
+    return list(_iter_flatten(struct))
 
 
 def on_failure(self, exception):
@@ -337,7 +675,7 @@ def create_cmd_from_task(task):
     if isinstance(prefix, str):
         raise ValueError("Your specified executable_prefix needs to be a list of strings, e.g. [strace]")
 
-    cmd = prefix
+    cmd = list(prefix)
 
     executable = get_setting("executable", task=task, default=[sys.executable])
 
@@ -345,7 +683,7 @@ def create_cmd_from_task(task):
         raise ValueError("Your specified executable needs to be a list of strings, e.g. [python3]")
 
     cmd += executable
-    cmd += [filename, "--batch-runner", "--task-id", task.task_id]
+    cmd += [filename, "--batch-runner", "--task-id", task.task_id, "--task-file", get_task_description_file(task)]
 
     return cmd
 
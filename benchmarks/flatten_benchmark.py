@@ -0,0 +1,93 @@
+"""
+Benchmark of the flattening of input/output structures in b2luigi.core.utils.
+
+Compares the generator based implementation with the former recursive one
+for structures with 10^3 to 10^6 targets, e.g. the inputs of a merge task.
+
+Usage:
+    python benchmarks/flatten_benchmark.py [--max-exponent 6] [--repeat 3]
+"""
+import argparse
+import collections
+import time
+
+import luigi
+
+from b2luigi.core import utils
+
+
+def _recursive_flatten(struct):
+    """The former implementation of utils._flatten."""
+    if isinstance(struct, dict) or isinstance(struct, str):
+        return [struct]
+
+    result = []
+    try:
+        iterator = iter(struct)
+    except TypeError:
+        return [struct]
+
+    for f in iterator:
+        result += _recursive_flatten(f)
+
+    return result
+
+
+def _recursive_flatten_to_list_of_dicts(inputs):
+    inputs = _recursive_flatten(inputs)
+    inputs = map(utils._to_dict, inputs)
+
+    joined_dict = collections.defaultdict(list)
+    for i in inputs:
+        for key, value in i.items():
+            joined_dict[key].append(value)
+    return dict(joined_dict)
+
+
+def _create_inputs(number_of_targets):
+    """Input structure like the one of a task requiring many tasks with two outputs each."""
+    return [[{"file_a": luigi.LocalTarget(f"results/i={i}/file_a")},
+             {"file_b": luigi.LocalTarget(f"results/i={i}/file_b")}]
+            for i in range(number_of_targets // 2)]
+
+
+def _create_nested_inputs(number_of_targets, branching=4):
+    """Input structure with nested lists, e.g. wrapper tasks requiring other wrapper tasks."""
+    inputs = [{"file_a": luigi.LocalTarget(f"results/i={i}/file_a")} for i in range(number_of_targets)]
+    while len(inputs) > branching:
+        inputs = [inputs[i:i + branching] for i in range(0, len(inputs), branching)]
+    return inputs
+
+
+def _time(function, inputs, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(inputs)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-exponent", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'structure':>10} {'targets':>10} {'recursive [s]':>14} {'generator [s]':>14} {'speedup':>8}")
+    for structure, create_inputs in [("flat", _create_inputs), ("nested", _create_nested_inputs)]:
+        for exponent in range(3, args.max_exponent + 1):
+            inputs = create_inputs(10 ** exponent)
+
+            assert _recursive_flatten_to_list_of_dicts(inputs) == utils.flatten_to_list_of_dicts(inputs)
+
+            recursive = _time(_recursive_flatten_to_list_of_dicts, inputs, args.repeat)
+            generator = _time(utils.flatten_to_list_of_dicts, inputs, args.repeat)
+
+            print(f"{structure:>10} {10 ** exponent:>10} {recursive:>14.4f} {generator:>14.4f} "
+                  f"{recursive / generator:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
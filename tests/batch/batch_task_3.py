@@ -0,0 +1,21 @@
+import b2luigi
+
+
+class BundledTask(b2luigi.Task):
+    some_parameter = b2luigi.IntParameter()
+
+    def output(self):
+        yield self.add_to_output("test.txt")
+
+    def run(self):
+        if self.some_parameter == 2:
+            raise RuntimeError("This task fails on purpose")
+
+        with open(self.get_output_file_name("test.txt"), "w") as f:
+            f.write("Test")
+
+
+if __name__ == "__main__":
+    b2luigi.set_setting("batch_system", "test")
+    b2luigi.set_setting("batch_bundle_size", 4)
+    b2luigi.process([BundledTask(some_parameter=i) for i in range(4)], batch=True, workers=4)
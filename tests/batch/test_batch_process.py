@@ -1,10 +1,95 @@
+import json
 import os
+import queue
 import subprocess
+import threading
+import time
+from unittest.mock import Mock
+
+import b2luigi
+import luigi.scheduler
+from b2luigi.batch import limiter
+from b2luigi.batch.monitor import _job_monitor
+from b2luigi.batch.processes import BatchProcess, JobStatus
+from b2luigi.batch.workers import SendJobWorker
+from b2luigi.core.utils import get_job_status_file, write_job_status
 
 from ..helpers import B2LuigiTestCase
+from .batch_task_1 import MyTask
+
+
+class RecordingProcess(BatchProcess):
+    started_tasks = []
+    killed_tasks = []
+    kill_calls = 0
+    job_status = JobStatus.running
+
+    def get_job_status(self):
+        return self.job_status
+
+    def start_job(self):
+        self.started_tasks.append(self.task)
+
+    def kill_job(self):
+        self.killed_tasks.append(self.task)
+
+    @classmethod
+    def kill_jobs(cls, processes):
+        cls.kill_calls += 1
+        super().kill_jobs(processes)
+
+
+class BlockingProcess(BatchProcess):
+    release = threading.Event()
+    fail = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.killed = False
+        self.status_calls = 0
+
+    def get_job_status(self):
+        self.status_calls += 1
+        return JobStatus.running
+
+    def start_job(self):
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("No connection to the batch system")
+
+    def kill_job(self):
+        self.killed = True
+
+
+class MonitoredProcess(BatchProcess):
+    job_status = JobStatus.running
+    confirmed_job_status = JobStatus.unknown
+    status_threads = set()
+
+    def get_job_status(self):
+        self.status_threads.add(threading.current_thread())
+        return self.job_status
+
+    def confirm_job_status(self):
+        return self.confirmed_job_status
+
+    def start_job(self):
+        pass
+
+    def kill_job(self):
+        pass
 
 
 class BatchProcessTestCase(B2LuigiTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Start every test with a clean record of the (class wide) started and killed jobs
+        RecordingProcess.started_tasks = []
+        RecordingProcess.killed_tasks = []
+        RecordingProcess.kill_calls = 0
+
     def test_simple_task(self):
         self.call_file("batch/batch_task_1.py")
         self.assertTrue(os.path.exists("some_parameter=bla_blub/test.txt"))
@@ -18,3 +103,321 @@ class BatchProcessTestCase(B2LuigiTestCase):
         self.assertIn(b"Task MyAdditionalTask failed!", out.splitlines())
         self.assertIn(b"Please have a look into the log files in", out.splitlines())
         self.assertIn(b"This progress looks :( because there were failed tasks", out.splitlines())
+
+    def test_bulk_submission(self):
+        b2luigi.set_setting("bulk_submission_size", 3)
+        tasks = [MyTask(f"bulk_{i}") for i in range(5)]
+        processes = [RecordingProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+                     for task in tasks]
+
+        try:
+            for process in processes:
+                process.run()
+            self.assertEqual(RecordingProcess.started_tasks, tasks[:3])
+
+            # the last process is not submitted at all, when terminated before
+            processes[4].terminate()
+            self.assertEqual(RecordingProcess.killed_tasks, [])
+
+            # asking for the status submits the remaining processes
+            self.assertTrue(processes[0].is_alive())
+            self.assertEqual(RecordingProcess.started_tasks, tasks[:4])
+        finally:
+            b2luigi.clear_setting("bulk_submission_size")
+
+    def test_bundles(self):
+        b2luigi.set_setting("batch_bundle_size", 2)
+        tasks = [MyTask(f"bundle_{i}") for i in range(3)]
+
+        try:
+            processes = [RecordingProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+                         for task in tasks]
+            for process in processes:
+                process.run()
+
+            # only the bundle leaders are submitted
+            self.assertTrue(processes[0].is_alive())
+            self.assertEqual(RecordingProcess.started_tasks, [tasks[0], tasks[2]])
+            self.assertEqual(processes[0]._bundled_processes, [processes[1]])
+            self.assertIs(processes[1]._bundle_leader, processes[0])
+
+            # the bundle job has finished, but the bundled task has not reported any result
+            processes[0].job_status = JobStatus.successful
+            self.assertFalse(processes[1].is_alive())
+            _, status, _, _, _ = processes[1]._result_queue.get_nowait()
+            self.assertEqual(status, luigi.scheduler.FAILED)
+        finally:
+            b2luigi.clear_setting("batch_bundle_size")
+
+    def test_kill_bundles(self):
+        b2luigi.set_setting("batch_bundle_size", 3)
+        tasks = [MyTask(f"kill_bundle_{i}") for i in range(5)]
+
+        try:
+            processes = [RecordingProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+                         for task in tasks]
+            for process in processes:
+                process.run()
+            self.assertTrue(processes[0].is_alive())
+            self.assertEqual(RecordingProcess.started_tasks, [tasks[0], tasks[3]])
+
+            # the task of the leader has finished, while its bundle job still runs the other tasks
+            processes[0]._mark_terminated()
+
+            # the bundled tasks are killed with the job of their leader
+            processes[4].terminate()
+            self.assertEqual(RecordingProcess.killed_tasks, [tasks[3]])
+
+            # every bundle job is only killed once
+            RecordingProcess.killed_tasks = []
+            RecordingProcess.terminate_all(processes[1:4])
+            self.assertEqual(RecordingProcess.kill_calls, 1)
+            self.assertEqual(RecordingProcess.killed_tasks, [tasks[0], tasks[3]])
+        finally:
+            b2luigi.clear_setting("batch_bundle_size")
+
+    def test_job_monitor(self):
+        b2luigi.set_setting("batch_job_monitor", True)
+        b2luigi.set_setting("batch_job_monitor_interval", 0.01)
+
+        try:
+            process = MonitoredProcess(task=MyTask("monitored"), scheduler=None, result_queue=queue.Queue(),
+                                       worker_timeout=None)
+            process.run()
+            self.assertIn(process, _job_monitor)
+            self.assertTrue(process.is_alive())
+
+            MonitoredProcess.job_status = JobStatus.successful
+            _job_monitor.check_now()
+
+            task_id, status, _, _, _ = process._result_queue.get(timeout=5)
+            self.assertEqual(task_id, process.task.task_id)
+            self.assertEqual(status, luigi.scheduler.DONE)
+
+            self.assertFalse(process.is_alive())
+            self.assertNotIn(threading.current_thread(), MonitoredProcess.status_threads)
+        finally:
+            b2luigi.clear_setting("batch_job_monitor")
+            b2luigi.clear_setting("batch_job_monitor_interval")
+
+    def test_job_status_file(self):
+        b2luigi.set_setting("result_dir", os.path.join(self.test_dir, "results"))
+        task = MyTask("job_status_file")
+
+        # an old result is not used
+        write_job_status(task, exit_status=0, start_time=0, end_time=1)
+
+        process = MonitoredProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+        MonitoredProcess.job_status = JobStatus.running
+        process.run()
+        self.assertFalse(os.path.exists(get_job_status_file(task)))
+        self.assertTrue(process.is_alive())
+
+        # the batch system is not asked anymore, once the job has reported its result
+        write_job_status(task, exit_status=1, start_time=2, end_time=3)
+        self.assertFalse(process.is_alive())
+
+        _, status, _, _, _ = process._result_queue.get_nowait()
+        self.assertEqual(status, luigi.scheduler.FAILED)
+
+    def test_bundled_tasks(self):
+        self.call_file("batch/batch_task_3.py", stderr=subprocess.STDOUT)
+
+        # every task is handled on its own, although all of them ran in the same job
+        for some_parameter in [0, 1, 3]:
+            self.assertTrue(os.path.exists(f"some_parameter={some_parameter}/test.txt"))
+        self.assertFalse(os.path.exists("some_parameter=2/test.txt"))
+
+        bundle_wrappers = []
+        for root, _, files in os.walk(self.test_dir):
+            bundle_wrappers += [os.path.join(root, f) for f in files if f == "bundle_wrapper.sh"]
+        self.assertEqual(len(bundle_wrappers), 1)
+
+    def test_job_status_file_of_batch_worker(self):
+        self.call_file("batch/batch_task_1.py")
+
+        job_status_files = []
+        for root, _, files in os.walk(self.test_dir):
+            job_status_files += [os.path.join(root, f) for f in files if f == "job_status.json"]
+
+        self.assertEqual(len(job_status_files), 2)
+        with open(job_status_files[0], "r") as f:
+            self.assertEqual(json.load(f)["exit_status"], 0)
+
+    def test_unknown_job_status(self):
+        b2luigi.set_setting("result_dir", os.path.join(self.test_dir, "results"))
+        b2luigi.set_setting("batch_job_unknown_grace_period", 0.05)
+        b2luigi.set_setting("batch_job_unknown_confirmations", 2)
+
+        try:
+            process = MonitoredProcess(task=MyTask("unknown"), scheduler=None, result_queue=queue.Queue(),
+                                       worker_timeout=None)
+            MonitoredProcess.job_status = JobStatus.unknown
+            MonitoredProcess.confirmed_job_status = JobStatus.unknown
+            process.run()
+
+            # during the grace period and after the first failed confirmation, the job is still alive
+            self.assertTrue(process.is_alive())
+            time.sleep(0.1)
+            self.assertTrue(process.is_alive())
+            self.assertEqual(process._unsuccessful_confirmations, 1)
+
+            # a known job status resets everything
+            MonitoredProcess.job_status = JobStatus.running
+            self.assertTrue(process.is_alive())
+            self.assertEqual(process._unsuccessful_confirmations, 0)
+
+            # a confirmation is trusted
+            MonitoredProcess.job_status = JobStatus.unknown
+            MonitoredProcess.confirmed_job_status = JobStatus.successful
+            self.assertTrue(process.is_alive())
+            time.sleep(0.1)
+            self.assertFalse(process.is_alive())
+            _, status, _, _, _ = process._result_queue.get_nowait()
+            self.assertEqual(status, luigi.scheduler.DONE)
+
+            # without any confirmation, the job is aborted at the end
+            process = MonitoredProcess(task=MyTask("unknown_2"), scheduler=None, result_queue=queue.Queue(),
+                                       worker_timeout=None)
+            MonitoredProcess.confirmed_job_status = JobStatus.unknown
+            process.run()
+            for _ in range(3):
+                process.is_alive()
+                time.sleep(0.1)
+            self.assertFalse(process.is_alive())
+            _, status, _, _, _ = process._result_queue.get_nowait()
+            self.assertEqual(status, luigi.scheduler.FAILED)
+        finally:
+            MonitoredProcess.job_status = JobStatus.running
+            b2luigi.clear_setting("batch_job_unknown_grace_period")
+            b2luigi.clear_setting("batch_job_unknown_confirmations")
+
+    def test_kill_on_exit(self):
+        tasks = [MyTask(f"exit_{i}") for i in range(3)]
+
+        with SendJobWorker(scheduler=luigi.scheduler.Scheduler()) as worker:
+            for task in tasks:
+                process = RecordingProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+                worker._running_tasks[task.task_id] = process
+
+        self.assertEqual(RecordingProcess.kill_calls, 1)
+        self.assertEqual(RecordingProcess.killed_tasks, tasks)
+
+    def test_batch_workers(self):
+        worker = SendJobWorker(scheduler=luigi.scheduler.Scheduler(), worker_processes=2)
+        for i in range(5):
+            task = MyTask(f"batch_worker_{i}")
+            worker._running_tasks[task.task_id] = RecordingProcess(task=task, scheduler=None, result_queue=queue.Queue(),
+                                                                   worker_timeout=None)
+
+        # by default, every batch job takes up a worker
+        self.assertEqual(worker.worker_processes, 2)
+
+        b2luigi.set_setting("batch_workers", True)
+        try:
+            self.assertEqual(worker.worker_processes, 7)
+
+            # local tasks only use the workers
+            b2luigi.set_setting("batch_system", "local")
+            local_process = worker._create_task_process(MyTask("local"))
+            self.assertTrue(local_process.use_multiprocessing)
+            worker._running_tasks["local"] = local_process
+            self.assertEqual(worker.worker_processes, 7)
+
+            # no new tasks, if the maximal number of batch jobs is running
+            b2luigi.set_setting("batch_workers", 5)
+            self.assertEqual(worker.worker_processes, 6)
+            b2luigi.set_setting("batch_workers", 10)
+            self.assertEqual(worker.worker_processes, 7)
+        finally:
+            b2luigi.clear_setting("batch_workers")
+            b2luigi.clear_setting("batch_system")
+
+    def test_submission_in_background(self):
+        b2luigi.set_setting("result_dir", os.path.join(self.test_dir, "results"))
+        b2luigi.set_setting("batch_submission_threads", 2)
+        BlockingProcess.release.clear()
+
+        try:
+            scheduler = Mock()
+            processes = [BlockingProcess(task=MyTask(f"background_{i}"), scheduler=scheduler,
+                                         result_queue=queue.Queue(), worker_timeout=None) for i in range(2)]
+            for process in processes:
+                process.run()
+
+            # The submission does not block, the process is alive meanwhile
+            for process in processes:
+                self.assertTrue(process.is_alive())
+                self.assertEqual(process.status_calls, 0)
+                scheduler.set_task_status_message.assert_any_call(process.task.task_id,
+                                                                  "Submitting to the batch system")
+
+            # terminating during the submission kills the job afterwards
+            processes[1].terminate()
+            self.assertFalse(processes[1].killed)
+
+            BlockingProcess.release.set()
+            for process in processes:
+                process._submission_future.result(timeout=5)
+
+            # the message is replaced as soon as the job is submitted
+            for process in processes:
+                scheduler.set_task_status_message.assert_any_call(process.task.task_id,
+                                                                  "Submitted to the batch system")
+            self.assertTrue(processes[0].is_alive())
+            self.assertEqual(processes[0].status_calls, 1)
+
+            self.assertTrue(processes[1].killed)
+            self.assertFalse(processes[1].is_alive())
+
+            # a failed submission is reported as failed task
+            BlockingProcess.fail = True
+            process = BlockingProcess(task=MyTask("background_failed"), scheduler=None, result_queue=queue.Queue(),
+                                      worker_timeout=None)
+            process.run()
+            process._submission_future.result(timeout=5)
+
+            self.assertFalse(process.is_alive())
+            _, status, explanation, _, _ = process._result_queue.get_nowait()
+            self.assertEqual(status, luigi.scheduler.FAILED)
+            self.assertIn("No connection to the batch system", explanation)
+        finally:
+            BlockingProcess.fail = False
+            BlockingProcess.release.set()
+            b2luigi.clear_setting("batch_submission_threads")
+
+    def test_submission_limits(self):
+        b2luigi.set_setting("batch_limits", True)
+        b2luigi.set_setting("batch_max_jobs_in_flight", 2)
+        b2luigi.set_setting("batch_max_submission_rate", 1000)
+        tasks = [MyTask(f"limited_{i}") for i in range(4)]
+
+        try:
+            processes = [RecordingProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+                         for task in tasks]
+            for process in processes:
+                process.run()
+
+            # only two jobs are allowed in flight, the others are waiting but alive
+            self.assertEqual(RecordingProcess.started_tasks, tasks[:2])
+            self.assertTrue(processes[2].is_alive())
+            self.assertEqual(RecordingProcess.started_tasks, tasks[:2])
+
+            # a finished job makes room for the next one
+            processes[0].job_status = JobStatus.successful
+            self.assertFalse(processes[0].is_alive())
+            self.assertTrue(processes[1].is_alive())
+            self.assertEqual(RecordingProcess.started_tasks, tasks[:3])
+
+            # a waiting process is not submitted at all, when terminated before
+            processes[3].terminate()
+            processes[1].job_status = JobStatus.successful
+            self.assertFalse(processes[1].is_alive())
+            self.assertTrue(processes[2].is_alive())
+            self.assertEqual(RecordingProcess.started_tasks, tasks[:3])
+            self.assertEqual(limiter.get_limiter("RecordingProcess").in_flight, 1)
+        finally:
+            b2luigi.clear_setting("batch_limits")
+            b2luigi.clear_setting("batch_max_jobs_in_flight")
+            b2luigi.clear_setting("batch_max_submission_rate")
+            limiter._limiters.clear()
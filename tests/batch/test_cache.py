@@ -0,0 +1,76 @@
+import threading
+import time
+from unittest import TestCase
+
+from b2luigi.batch.cache import BatchJobStatusCache
+
+
+class FakeJobStatusCache(BatchJobStatusCache):
+    def __init__(self, jobs, finished_jobs=None, delay=0, **kwargs):
+        super().__init__(**kwargs)
+
+        self.jobs = jobs
+        self.finished_jobs = finished_jobs or {}
+        self.delay = delay
+        self.queries = []
+
+    def _ask_for_job_status(self, job_id=None):
+        self.queries.append(job_id)
+        time.sleep(self.delay)
+
+        if job_id is None:
+            for known_job_id, job_status in self.jobs.items():
+                self[known_job_id] = job_status
+        elif job_id in self.finished_jobs:
+            self[job_id] = self.finished_jobs[job_id]
+
+
+class BatchJobStatusCacheTestCase(TestCase):
+    def test_many_jobs(self):
+        cache = FakeJobStatusCache({job_id: "running" for job_id in range(5000)})
+
+        for job_id in range(5000):
+            self.assertEqual(cache[job_id], "running")
+
+        self.assertEqual(cache.queries, [None])
+        self.assertEqual(len(cache), 5000)
+        self.assertEqual(cache.statistics, dict(hits=4999, misses=1, full_refreshes=1, job_refreshes=0))
+
+    def test_unknown_jobs(self):
+        cache = FakeJobStatusCache({1: "running"}, finished_jobs={2: "done"})
+
+        self.assertEqual(cache[2], "done")
+        self.assertRaises(KeyError, cache.__getitem__, 3)
+        self.assertIsNone(cache.get(4))
+
+        # only a single query for all jobs, but one per unknown job
+        self.assertEqual(cache.queries, [None, 2, 3, 4])
+        self.assertEqual(cache.statistics["job_refreshes"], 3)
+
+    def test_expiry(self):
+        cache = FakeJobStatusCache({1: "running"}, ttl=0.05)
+
+        self.assertEqual(cache[1], "running")
+        cache.jobs = {1: "done"}
+        self.assertEqual(cache[1], "running")
+
+        time.sleep(0.1)
+        self.assertNotIn(1, cache)
+        self.assertEqual(cache[1], "done")
+        self.assertEqual(cache.queries, [None, None])
+
+    def test_concurrent_misses(self):
+        cache = FakeJobStatusCache({job_id: "running" for job_id in range(10)}, delay=0.1)
+        results = {}
+
+        def ask(job_id):
+            results[job_id] = cache[job_id]
+
+        threads = [threading.Thread(target=ask, args=(job_id, )) for job_id in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {job_id: "running" for job_id in range(10)})
+        self.assertEqual(cache.queries, [None])
@@ -5,13 +5,18 @@ Utilities that require a running gbasf2 or Dirac environment will not net
 tested in this test case, only the functions that can be run independently.
 """
 
-from b2luigi.batch.processes.htcondor import HTCondorProcess
+from b2luigi.batch.processes import get_session_id
+from b2luigi.batch.processes.htcondor import HTCondorJobStatus, HTCondorJobStatusCache, HTCondorProcess
+from b2luigi.core.executable import create_executable_wrapper
+from b2luigi.core.utils import get_task_file_dir
 
 from ..helpers import B2LuigiTestCase
 from .batch_task_1 import MyTask
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 import os
+import queue
 import b2luigi
+import luigi.scheduler
 
 
 class TestHTCondorCreateSubmitFile(B2LuigiTestCase):
@@ -22,6 +27,7 @@ class TestHTCondorCreateSubmitFile(B2LuigiTestCase):
         htcondor_mock_process = Mock()
         task.get_task_file_dir = lambda: self.test_dir
         htcondor_mock_process.task = task
+        htcondor_mock_process.create_executable_wrapper = lambda: create_executable_wrapper(task)
         #  create submit file
         HTCondorProcess._create_htcondor_submit_file(htcondor_mock_process)
         # read submit file and return string
@@ -37,6 +43,7 @@ class TestHTCondorCreateSubmitFile(B2LuigiTestCase):
             error = ..
             log = ..
             executable = executable_wrapper.sh
+            +B2LuigiSession = "..."
             queue 1
         """
         submit_file_lines = self._get_htcondor_submit_file_string(MyTask("some_parameter")).splitlines()
@@ -44,7 +51,22 @@ class TestHTCondorCreateSubmitFile(B2LuigiTestCase):
         self.assertIn("error = ", submit_file_lines[1])
         self.assertIn("log = ", submit_file_lines[2])
         self.assertEqual("executable = executable_wrapper.sh", submit_file_lines[3])
-        self.assertEqual("queue 1", submit_file_lines[4])
+        self.assertEqual(f'+B2LuigiSession = "{get_session_id()}"', submit_file_lines[4])
+        self.assertEqual("queue 1", submit_file_lines[5])
+
+    def test_session_id(self):
+        session_id = get_session_id()
+        self.assertEqual(get_session_id(), session_id)
+
+        # another call of the same script (e.g. at the same time) gets its own session
+        with patch("b2luigi.batch.processes._default_session_id", None), patch("os.getpid", return_value=-1):
+            self.assertNotEqual(get_session_id(), session_id)
+        self.assertEqual(get_session_id(), session_id)
+
+        b2luigi.set_setting("batch_session_id", "my_session")
+        submit_file_string = self._get_htcondor_submit_file_string(MyTask("some_parameter"))
+        b2luigi.clear_setting("batch_session_id")
+        self.assertIn('+B2LuigiSession = "my_session"', submit_file_string.splitlines())
 
     def test_not_setting_job_name(self):
         submit_file_string = self._get_htcondor_submit_file_string(MyTask("some_parameter"))
@@ -74,3 +96,242 @@ class TestHTCondorCreateSubmitFile(B2LuigiTestCase):
         b2luigi.clear_setting("htcondor_settings")
         self.assertNotIn("JobBatchName = job_name_global", submit_file_lines)
         self.assertIn("JobBatchName = job_name_htcondor", submit_file_lines)
+
+
+class TestHTCondorBulkSubmission(B2LuigiTestCase):
+    def setUp(self):
+        super().setUp()
+
+        b2luigi.set_setting("result_dir", os.path.join(self.test_dir, "results"))
+        b2luigi.set_setting("bulk_submission_size", 3)
+
+    def tearDown(self):
+        b2luigi.clear_setting("bulk_submission_size")
+
+        super().tearDown()
+
+    @staticmethod
+    def _create_process(task):
+        return HTCondorProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+
+    def test_single_cluster(self):
+        processes = [self._create_process(MyTask(f"bulk_{i}")) for i in range(3)]
+
+        with patch("subprocess.check_output", return_value=b"3 job(s) submitted to cluster 42.\n") as check_output:
+            for process in processes:
+                process.run()
+
+        check_output.assert_called_once()
+        self.assertEqual([process._batch_job_id for process in processes], ["42.0", "42.1", "42.2"])
+
+        submit_file_path = os.path.join(check_output.call_args[1]["cwd"], "bulk_job.submit")
+        with open(submit_file_path, "r") as submit_file:
+            submit_file_lines = submit_file.read().splitlines()
+
+        # one queue statement per job, in the order of the processes
+        self.assertEqual(submit_file_lines.count("queue 1"), 3)
+        self.assertEqual(submit_file_lines[-1], "queue 1")
+
+        executable_files = [line[len("executable = "):] for line in submit_file_lines
+                            if line.startswith("executable = ")]
+        self.assertEqual(len(executable_files), 3)
+        for i, executable_file in enumerate(executable_files):
+            self.assertTrue(os.path.exists(executable_file))
+            self.assertIn(f"some_parameter=bulk_{i}", executable_file)
+        self.assertTrue(submit_file_lines[-2].startswith("log = "))
+
+    def test_list_parameters(self):
+        class ListTask(b2luigi.Task):
+            runs = b2luigi.ListParameter()
+
+            def output(self):
+                yield self.add_to_output("test.txt")
+
+        tasks = [ListTask(runs=[i, i + 1]) for i in range(2)]
+        processes = [self._create_process(task) for task in tasks]
+
+        with patch("subprocess.check_output", return_value=b"2 job(s) submitted to cluster 42.\n") as check_output:
+            for process in processes:
+                process.run()
+            HTCondorProcess._submit_pending_jobs()
+
+        self.assertEqual([process._batch_job_id for process in processes], ["42.0", "42.1"])
+        submit_file_path = os.path.join(check_output.call_args[1]["cwd"], "bulk_job.submit")
+        with open(submit_file_path, "r") as submit_file:
+            submit_file_lines = submit_file.read().splitlines()
+
+        # the paths include commas and spaces, but are still given completely
+        executable_files = [line[len("executable = "):] for line in submit_file_lines
+                            if line.startswith("executable = ")]
+        for i, (task, executable_file) in enumerate(zip(tasks, executable_files)):
+            self.assertIn(f"runs=[{i}, {i + 1}]", executable_file)
+            self.assertEqual(os.path.dirname(executable_file), os.path.abspath(get_task_file_dir(task)))
+            self.assertTrue(os.path.exists(executable_file))
+
+    def test_different_settings(self):
+        special_task = MyTask("bulk_special")
+        special_task.htcondor_settings = {"request_memory": "4 GB"}
+        processes = [self._create_process(task) for task in [MyTask("bulk_0"), special_task, MyTask("bulk_1")]]
+
+        outputs = [b"2 job(s) submitted to cluster 42.\n", b"1 job(s) submitted to cluster 43.\n"]
+        with patch("subprocess.check_output", side_effect=outputs) as check_output:
+            for process in processes:
+                process.run()
+
+        self.assertEqual(check_output.call_count, 2)
+        self.assertEqual([process._batch_job_id for process in processes], ["42.0", "43.0", "42.1"])
+
+    def test_failed_submission(self):
+        processes = [self._create_process(MyTask(f"bulk_{i}")) for i in range(2)]
+
+        with patch("subprocess.check_output", return_value=b"ERROR: Failed to connect to local queue schedd!\n"):
+            for process in processes:
+                process.run()
+            self.assertFalse(processes[0].is_alive())
+
+        for process in processes:
+            self.assertFalse(process.is_alive())
+            task_id, status, explanation, _, _ = process._result_queue.get_nowait()
+            self.assertEqual(status, luigi.scheduler.FAILED)
+            self.assertIn("Batch submission failed", explanation)
+
+    def test_job_status_per_proc(self):
+        cache = HTCondorJobStatusCache()
+        cache._fill_from_output(b'[{"ClusterId": 42, "ProcId": 0, "JobStatus": 4, "ExitCode": 0},'
+                                b'{"ClusterId": 42, "ProcId": 1, "JobStatus": 4, "ExitCode": 1},'
+                                b'{"ClusterId": 42, "ProcId": 2, "JobStatus": 2}]')
+
+        self.assertEqual(cache["42.0"], HTCondorJobStatus.completed)
+        self.assertEqual(cache["42.1"], HTCondorJobStatus.failed)
+        self.assertEqual(cache["42.2"], HTCondorJobStatus.running)
+
+    def test_history_for_missing_jobs(self):
+        cache = HTCondorJobStatusCache()
+        cache.add_submitted_jobs(["42.0", "42.1", "43.0"], submission_time=10000)
+        cache.add_submitted_jobs(["44.0"], submission_time=20000)
+
+        def check_output(command):
+            if command[0] == "condor_q":
+                return b'[{"ClusterId": 44, "ProcId": 0, "JobStatus": 2}]'
+            return (b'[{"ClusterId": 42, "ProcId": 0, "JobStatus": 4, "ExitCode": 0},'
+                    b'{"ClusterId": 42, "ProcId": 1, "JobStatus": 4, "ExitCode": 1},'
+                    b'{"ClusterId": 43, "ProcId": 0, "JobStatus": 3}]')
+
+        with patch("subprocess.check_output", side_effect=check_output) as mocked_check_output:
+            self.assertEqual(cache["42.0"], HTCondorJobStatus.completed)
+            self.assertEqual(cache["42.1"], HTCondorJobStatus.failed)
+            self.assertEqual(cache["43.0"], HTCondorJobStatus.removed)
+            self.assertEqual(cache["44.0"], HTCondorJobStatus.running)
+
+        self.assertEqual(mocked_check_output.call_count, 2)
+        q_command = mocked_check_output.call_args_list[0][0][0]
+        self.assertIn(f'B2LuigiSession == "{get_session_id()}"', q_command)
+
+        history_command = mocked_check_output.call_args_list[1][0][0]
+        self.assertEqual(history_command[0], "condor_history")
+        self.assertIn("member(ClusterId, {42, 43})", history_command)
+        self.assertIn(f"EnteredCurrentStatus < {10000 - cache.history_time_margin}", history_command)
+
+        # only the running job is still missing
+        self.assertEqual(list(cache._submitted_jobs), ["44.0"])
+
+    def test_missing_job_not_asked_for_separately(self):
+        cache = HTCondorJobStatusCache(ttl=60)
+        cache.add_submitted_jobs(["42.0"], submission_time=10000)
+
+        with patch("subprocess.check_output", return_value=b"") as mocked_check_output:
+            for _ in range(5):
+                self.assertNotIn("42.0", cache)
+                self.assertIsNone(cache.get("42.0"))
+
+            # a single query of condor_q and the history for all jobs
+            self.assertEqual([call[0][0][0] for call in mocked_check_output.call_args_list],
+                             ["condor_q", "condor_history"])
+
+            # asking for exactly this job is still possible
+            mocked_check_output.reset_mock()
+            self.assertRaises(KeyError, cache.refresh_job, "42.0")
+            self.assertEqual([call[0][0][0] for call in mocked_check_output.call_args_list],
+                             ["condor_q", "condor_history"])
+            self.assertIn("-match", mocked_check_output.call_args[0][0])
+
+    def test_job_missing_in_history(self):
+        cache = HTCondorJobStatusCache()
+        cache.add_submitted_jobs(["42.0", "43.0"], submission_time=10000)
+
+        def check_output(command):
+            if command[0] == "condor_q":
+                return b'[{"ClusterId": 43, "ProcId": 0, "JobStatus": 2}]'
+            return b""
+
+        with patch("subprocess.check_output", side_effect=check_output) as mocked_check_output:
+            for _ in range(cache.history_max_misses - 1):
+                cache._ask_for_job_status()
+            self.assertEqual(set(cache._submitted_jobs), {"42.0", "43.0"})
+
+            # after too many lookups, the job is not looked for in the history anymore
+            cache._ask_for_job_status()
+            self.assertEqual(list(cache._submitted_jobs), ["43.0"])
+
+            mocked_check_output.reset_mock()
+            cache._ask_for_job_status()
+            self.assertEqual(mocked_check_output.call_count, 1)
+
+        # so its status is unknown
+        self.assertNotIn("42.0", cache)
+        self.assertEqual(cache["43.0"], HTCondorJobStatus.running)
+
+    def test_reattach_to_running_job(self):
+        b2luigi.set_setting("bulk_submission_size", 1)
+        task = MyTask("reattach")
+
+        with patch("subprocess.check_output", return_value=b"1 job(s) submitted to cluster 42.\n"):
+            self._create_process(task).run()
+
+        # a new b2luigi process finds the job still running
+        process = self._create_process(task)
+        with patch("b2luigi.batch.processes.htcondor._batch_job_status_cache", HTCondorJobStatusCache()), \
+                patch("subprocess.check_output", return_value=b'[{"ClusterId": 42, "ProcId": 0, "JobStatus": 2}]') \
+                as check_output:
+            process.run()
+
+        self.assertEqual(process._batch_job_id, "42.0")
+        self.assertNotIn("condor_submit", [call[0][0][0] for call in check_output.call_args_list])
+
+        # if the job is gone, the task is submitted again
+        def check_output(command, **kwargs):
+            if command[0] == "condor_submit":
+                return b"1 job(s) submitted to cluster 43.\n"
+            return b""
+
+        process = self._create_process(task)
+        with patch("b2luigi.batch.processes.htcondor._batch_job_status_cache", HTCondorJobStatusCache()), \
+                patch("subprocess.check_output", side_effect=check_output):
+            process.run()
+
+        self.assertEqual(process._batch_job_id, "43.0")
+
+    def test_reattach_after_restart(self):
+        b2luigi.set_setting("bulk_submission_size", 1)
+        task = MyTask("reattach_restart")
+
+        with patch("subprocess.check_output", return_value=b"1 job(s) submitted to cluster 42.\n"):
+            self._create_process(task).run()
+
+        # the restarted b2luigi process has its own session, but still finds the job
+        cache = HTCondorJobStatusCache()
+        process = self._create_process(task)
+        with patch("b2luigi.batch.processes._default_session_id", None), \
+                patch("b2luigi.batch.processes.htcondor._batch_job_status_cache", cache), \
+                patch("subprocess.check_output", return_value=b'[{"ClusterId": 42, "ProcId": 0, "JobStatus": 2}]') \
+                as check_output:
+            process.run()
+
+            self.assertEqual(process._batch_job_id, "42.0")
+            commands = [call[0][0] for call in check_output.call_args_list]
+            self.assertNotIn("condor_submit", [command[0] for command in commands])
+
+            # the job is part of the status queries of this session, so it is not looked for in the history
+            self.assertEqual([command[0] for command in commands], ["condor_q"])
+            self.assertIn("(ClusterId == 42 && ProcId == 0)", commands[0][-1])
+            self.assertIn(f'B2LuigiSession == "{get_session_id()}"', commands[0][-1])
@@ -0,0 +1,79 @@
+from unittest import TestCase
+
+import b2luigi
+from b2luigi.batch import limiter
+from b2luigi.batch.limiter import SubmissionLimiter
+
+from .test_cache import FakeJobStatusCache
+
+
+class SubmissionLimiterTestCase(TestCase):
+    def test_in_flight_limit(self):
+        submission_limiter = SubmissionLimiter(max_rate=100, max_in_flight=20)
+        self.assertEqual(submission_limiter.in_flight_limit, 2)
+
+        self.assertTrue(submission_limiter.try_acquire())
+        self.assertTrue(submission_limiter.try_acquire())
+        self.assertFalse(submission_limiter.try_acquire())
+
+        submission_limiter.release()
+        self.assertTrue(submission_limiter.try_acquire())
+        self.assertEqual(submission_limiter.in_flight, 2)
+
+    def test_rate_limit(self):
+        submission_limiter = SubmissionLimiter(max_rate=10, max_in_flight=1000)
+        self.assertEqual(submission_limiter.rate, 1)
+
+        # only a single submission per second at the start
+        self.assertTrue(submission_limiter.try_acquire())
+        self.assertFalse(submission_limiter.try_acquire())
+
+    def test_additive_increase_multiplicative_decrease(self):
+        submission_limiter = SubmissionLimiter(max_rate=10, max_in_flight=1000, target_latency=1)
+
+        for _ in range(100):
+            submission_limiter.record(0.1)
+        self.assertEqual(submission_limiter.rate, 10)
+        self.assertEqual(submission_limiter.in_flight_limit, 1000)
+
+        submission_limiter.record(2)
+        self.assertEqual(submission_limiter.rate, 5)
+        self.assertEqual(submission_limiter.in_flight_limit, 500)
+
+        # a burst of errors is only counted once
+        submission_limiter.record(0.1, error=True)
+        self.assertEqual(submission_limiter.rate, 5)
+
+        submission_limiter._last_decrease = None
+        submission_limiter.record(0.1, error=True)
+        self.assertEqual(submission_limiter.rate, 2.5)
+        self.assertEqual(submission_limiter.in_flight_limit, 250)
+
+        for _ in range(20):
+            submission_limiter._last_decrease = None
+            submission_limiter.record(0.1, error=True)
+        self.assertEqual(submission_limiter.rate, SubmissionLimiter.min_rate)
+        self.assertEqual(submission_limiter.in_flight_limit, 1)
+
+    def test_get_limiter(self):
+        self.assertIsNone(limiter.get_limiter("SomeProcess"))
+
+        b2luigi.set_setting("batch_limits", True)
+        b2luigi.set_setting("batch_max_submission_rate", 5)
+        try:
+            submission_limiter = limiter.get_limiter("SomeProcess")
+            self.assertIs(submission_limiter, limiter.get_limiter("SomeProcess"))
+            self.assertIsNot(submission_limiter, limiter.get_limiter("OtherProcess"))
+            self.assertEqual(submission_limiter.max_rate, 5)
+
+            # slow status queries lower the limits
+            FakeJobStatusCache.limiter_name = "SomeProcess"
+            cache = FakeJobStatusCache({1: "running"}, delay=0.05)
+            submission_limiter.target_latency = 0.01
+            self.assertEqual(cache[1], "running")
+            self.assertEqual(submission_limiter.rate, 0.25)
+        finally:
+            FakeJobStatusCache.limiter_name = None
+            b2luigi.clear_setting("batch_limits")
+            b2luigi.clear_setting("batch_max_submission_rate")
+            limiter._limiters.clear()
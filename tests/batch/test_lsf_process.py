@@ -0,0 +1,164 @@
+import os
+import queue
+from unittest.mock import Mock, patch
+
+import b2luigi
+from b2luigi.batch.processes import JobStatus
+from b2luigi.batch.processes.lsf import LSFJobStatusCache, LSFProcess, _parse_bhist_output, get_job_group
+
+from ..helpers import B2LuigiTestCase
+from .batch_task_1 import MyTask
+
+
+class LSFArraySubmissionTestCase(B2LuigiTestCase):
+    def setUp(self):
+        super().setUp()
+
+        b2luigi.set_setting("result_dir", os.path.join(self.test_dir, "results"))
+        b2luigi.set_setting("bulk_submission_size", 3)
+
+    def tearDown(self):
+        b2luigi.clear_setting("bulk_submission_size")
+
+        super().tearDown()
+
+    @staticmethod
+    def _create_process(task):
+        return LSFProcess(task=task, scheduler=None, result_queue=queue.Queue(), worker_timeout=None)
+
+    def test_array_submission(self):
+        long_task = MyTask("array_long")
+        long_task.queue = "l"
+        processes = [self._create_process(task) for task in [MyTask("array_0"), long_task, MyTask("array_1")]]
+
+        outputs = [b"Job <1234> is submitted to default queue <s>.\n", b"Job <1235> is submitted to queue <l>.\n"]
+        with patch("subprocess.check_output", side_effect=outputs) as check_output:
+            for process in processes:
+                process.run()
+
+        self.assertEqual([process._batch_job_id for process in processes], ["1234[1]", "1235", "1234[2]"])
+
+        array_command = check_output.call_args_list[0][0][0]
+        self.assertIn("b2luigi[1-2]", array_command)
+        self.assertNotIn("-q", array_command)
+
+        array_script = array_command[-1]
+        with open(array_script, "r") as f:
+            script_lines = f.read().splitlines()
+
+        self.assertEqual(script_lines[1], 'case "$LSB_JOBINDEX" in')
+        self.assertTrue(script_lines[2].startswith("    1) exec "))
+        self.assertIn("some_parameter=array_0", script_lines[2])
+        self.assertIn("some_parameter=array_1", script_lines[3])
+
+        self.assertIn(get_job_group(), array_command)
+
+        single_command = check_output.call_args_list[1][0][0]
+        self.assertIn(get_job_group(), single_command)
+        self.assertIn("-q", single_command)
+        self.assertIn("l", single_command)
+
+    def test_array_job_status(self):
+        cache = LSFJobStatusCache()
+        output = (b'{"RECORDS": [{"JOBID": "1234", "STAT": "DONE", "JOBINDEX": "1"},'
+                  b'{"JOBID": "1234[2]", "STAT": "EXIT", "JOBINDEX": "2"},'
+                  b'{"JOBID": "1235", "STAT": "RUN", "JOBINDEX": "0"}]}')
+
+        with patch("subprocess.check_output", return_value=output) as check_output:
+            self.assertEqual(cache["1234[1]"], "DONE")
+            self.assertEqual(cache["1234[2]"], "EXIT")
+            self.assertEqual(cache["1235"], "RUN")
+
+        self.assertEqual(check_output.call_args[0][0][-2:], ["-g", get_job_group()])
+
+    def test_parse_bhist_output(self):
+        header = ("Job <1234>, User <user>, Project <default>, Command </some/very/long/path/to/the/executable_wra\n"
+                  "                     pper.sh>\n"
+                  "Fri Oct 18 10:00:00: Submitted from host <host>, to Queue <s>, CWD <$HOME>;\n")
+
+        self.assertEqual(_parse_bhist_output(header), JobStatus.running)
+        self.assertEqual(_parse_bhist_output(header + "Fri Oct 18 10:05:00: Done successfully. The CPU time used\n"
+                                                      "                      is 1.0 seconds;\n"),
+                         JobStatus.successful)
+        self.assertEqual(_parse_bhist_output(header + "Fri Oct 18 10:05:00: Exited with exit code 1. The CPU tim\n"
+                                                      "                     e used is 1.0 seconds;\n"),
+                         JobStatus.aborted)
+        self.assertEqual(_parse_bhist_output("No matching job found\n"), JobStatus.unknown)
+
+    def test_unknown_job(self):
+        process = self._create_process(MyTask("unknown"))
+        process._batch_job_id = "999"
+
+        with patch("subprocess.check_output", return_value=b'{"RECORDS": []}'):
+            self.assertEqual(process.get_job_status(), JobStatus.unknown)
+
+        with patch("subprocess.check_output", return_value=b"Fri Oct 18 10:05:00: Done successfully.\n") as check_output:
+            self.assertEqual(process.confirm_job_status(), JobStatus.successful)
+        self.assertEqual(check_output.call_args[0][0], ["bhist", "-l", "999"])
+
+    def test_unknown_but_running_job(self):
+        b2luigi.set_setting("batch_job_unknown_grace_period", 60)
+        process = self._create_process(MyTask("unknown_running"))
+        process._batch_job_id = "999"
+
+        def check_output(command, **kwargs):
+            if command[0] == "bhist":
+                return b"Fri Oct 18 10:00:00: Submitted from host <host>, to Queue <s>, CWD <$HOME>;\n"
+            return b'{"RECORDS": []}'
+
+        try:
+            with patch("subprocess.check_output", side_effect=check_output) as mocked_check_output, \
+                    patch("time.time", return_value=1000):
+                self.assertTrue(process._check_job_status())
+
+            # bhist confirms the job is still running
+            with patch("subprocess.check_output", side_effect=check_output) as mocked_check_output, \
+                    patch("time.time", return_value=1100):
+                self.assertTrue(process._check_job_status())
+            self.assertIn(["bhist", "-l", "999"], [call[0][0] for call in mocked_check_output.call_args_list])
+
+            # so it is not asked again within the next grace period
+            with patch("subprocess.check_output", side_effect=check_output) as mocked_check_output, \
+                    patch("time.time", return_value=1150):
+                self.assertTrue(process._check_job_status())
+            self.assertNotIn(["bhist", "-l", "999"], [call[0][0] for call in mocked_check_output.call_args_list])
+            self.assertEqual(process._unsuccessful_confirmations, 0)
+        finally:
+            b2luigi.clear_setting("batch_job_unknown_grace_period")
+
+    def test_reattach_job(self):
+        process = self._create_process(MyTask("reattach"))
+
+        records = b'{"RECORDS": [{"JOBID": "999", "STAT": "RUN", "JOBINDEX": "0"}, {"ERROR": "Job <998> is not found"}]}'
+        with patch("b2luigi.batch.processes.lsf._batch_job_status_cache", LSFJobStatusCache()), \
+                patch("subprocess.check_output", return_value=b'{"RECORDS": []}') as check_output, \
+                patch("subprocess.run", return_value=Mock(stdout=records)) as run:
+            self.assertTrue(process.reattach_job("999", submission_time=0))
+
+        # the job of the earlier session is asked for together with the job group of this session
+        self.assertEqual(check_output.call_args[0][0][-2:], ["-g", get_job_group()])
+        self.assertEqual(run.call_args[0][0][-1], "999")
+
+    def test_kill_all_jobs(self):
+        processes = [self._create_process(MyTask(f"kill_{i}")) for i in range(4)]
+        for i, process in enumerate(processes[:3]):
+            process._batch_job_id = str(1000 + i)
+
+        # The last process is still waiting for its submission
+        with patch("subprocess.check_output") as check_output:
+            processes[3].run()
+        check_output.assert_not_called()
+
+        with patch("subprocess.run") as run, patch.object(LSFProcess, "kill_chunk_size", 2):
+            LSFProcess.terminate_all(processes)
+
+        self.assertEqual([call[0][0] for call in run.call_args_list], [["bkill", "1000", "1001"], ["bkill", "1002"]])
+        self.assertFalse(any(process.is_alive() for process in processes))
+
+        b2luigi.set_setting("batch_kill_session", True)
+        processes = [self._create_process(MyTask(f"kill_{i}")) for i in range(2)]
+        with patch("subprocess.run") as run:
+            LSFProcess.terminate_all(processes)
+        b2luigi.clear_setting("batch_kill_session")
+
+        self.assertEqual(run.call_args[0][0], ["bkill", "-g", get_job_group(), "0"])
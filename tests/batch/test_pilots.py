@@ -0,0 +1,96 @@
+import datetime
+from unittest.mock import Mock, patch
+
+import b2luigi
+import luigi.scheduler
+import luigi.worker
+from b2luigi.batch.pilots import PilotTask
+from b2luigi.batch.processes import JobStatus
+from b2luigi.batch.workers import PilotWorker, SendJobWorkerSchedulerFactory, SendPilotWorker
+from b2luigi.cli import runner
+
+from ..helpers import B2LuigiTestCase
+from .batch_task_1 import MyTask
+from .test_batch_process import RecordingProcess
+
+
+class PilotTestCase(B2LuigiTestCase):
+    def test_pilot_task(self):
+        pilot = PilotTask(pilot_number=1, scheduler_host="localhost", scheduler_port=8082)
+
+        # the scheduler does not change the identity of the pilot
+        self.assertEqual(pilot.task_id, PilotTask(pilot_number=1, scheduler_host="other", scheduler_port=1).task_id)
+        self.assertFalse(pilot.complete())
+
+    def test_pilot_worker(self):
+        b2luigi.set_setting("batch_system", "htcondor")
+        b2luigi.set_setting("pilot_idle_timeout", 60)
+
+        try:
+            worker = SendJobWorkerSchedulerFactory().create_worker(scheduler=luigi.scheduler.Scheduler(),
+                                                                   worker_processes=1, assistant=True)
+            self.assertIsInstance(worker, PilotWorker)
+
+            # all tasks are run in the pilot itself
+            task_process = worker._create_task_process(MyTask("pilot"))
+            self.assertIsInstance(task_process, luigi.worker.TaskProcess)
+            self.assertFalse(task_process.use_multiprocessing)
+
+            # the pilot stops after some time without anything to do
+            self.assertTrue(worker._keep_alive(None))
+            worker._idle_since = datetime.datetime.now() - datetime.timedelta(seconds=30)
+            self.assertTrue(worker._keep_alive(None))
+            worker._idle_since = datetime.datetime.now() - datetime.timedelta(seconds=90)
+            self.assertFalse(worker._keep_alive(None))
+        finally:
+            b2luigi.clear_setting("batch_system")
+            b2luigi.clear_setting("pilot_idle_timeout")
+
+    def test_send_pilots(self):
+        RecordingProcess.started_tasks = []
+        RecordingProcess.killed_tasks = []
+
+        def create_batch_process(task, result_queue):
+            return RecordingProcess(task=task, scheduler=None, result_queue=result_queue, worker_timeout=None)
+
+        with patch.object(SendPilotWorker, "_create_batch_process", side_effect=create_batch_process):
+            with SendPilotWorker(scheduler_host="localhost", scheduler_port=8082, number_of_pilots=2,
+                                 scheduler=luigi.scheduler.Scheduler()) as worker:
+                self.assertEqual(worker.worker_processes, 0)
+                self.assertEqual([task.pilot_number for task in RecordingProcess.started_tasks], [0, 1])
+                pilots = list(worker._pilots)
+
+                # wait as long as there is something to do for the running pilots
+                self.assertTrue(worker._keep_alive(Mock(n_pending_tasks=3, running_tasks=[])))
+                self.assertFalse(worker._keep_alive(Mock(n_pending_tasks=0, running_tasks=[])))
+
+                pilots[0].job_status = JobStatus.successful
+                self.assertTrue(worker._keep_alive(Mock(n_pending_tasks=0, running_tasks=[{"task_id": "a"}])))
+
+                # the results of the pilots are not handed to luigi
+                self.assertTrue(worker._task_result_queue.empty())
+                self.assertFalse(pilots[0]._result_queue.empty())
+
+        # pilots still running at the end are killed
+        self.assertEqual(RecordingProcess.killed_tasks, [pilots[1].task])
+
+        # without any pilot, there is no reason to wait
+        self.assertFalse(worker._keep_alive(Mock(n_pending_tasks=3, running_tasks=[])))
+
+    def test_unsupported_batch_systems(self):
+        for batch_system in ["local", "gbasf2"]:
+            b2luigi.set_setting("batch_system", batch_system)
+            try:
+                with self.assertRaisesRegex(ValueError, batch_system):
+                    SendPilotWorker(scheduler_host="localhost", scheduler_port=8082, number_of_pilots=2,
+                                    scheduler=luigi.scheduler.Scheduler())
+            finally:
+                b2luigi.clear_setting("batch_system")
+
+    def test_pilots_need_central_scheduler(self):
+        b2luigi.set_setting("batch_pilots", 2)
+        try:
+            cli_args = Mock(scheduler_host="", scheduler_port=0)
+            self.assertRaises(ValueError, runner.run_batched, [MyTask("pilot")], cli_args, {})
+        finally:
+            b2luigi.clear_setting("batch_pilots")
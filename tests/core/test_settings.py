@@ -1,10 +1,12 @@
 import json
 import os
 import warnings
+from unittest import mock
 
 from ..helpers import B2LuigiTestCase
 
 import b2luigi
+from b2luigi.core import settings
 from b2luigi.core.settings import DeprecatedSettingsWarning
 
 
@@ -82,3 +84,39 @@ class TaskTestCase(B2LuigiTestCase):
                                                                  deprecated_keys=["my_old_setting"]))
 
             self.assertEqual(len(w), 0)
+
+    def test_settings_file_is_cached(self):
+        with open("settings.json", "w") as f:
+            json.dump({"my_setting": "my file value", "my_list_setting": [1, 2]}, f)
+
+        with mock.patch("json.load", wraps=json.load) as json_load:
+            self.assertEqual("my file value", b2luigi.get_setting("my_setting"))
+            self.assertEqual("my file value", b2luigi.get_setting("my_setting"))
+            self.assertEqual("default", b2luigi.get_setting("my_missing_setting", "default"))
+            self.assertEqual("default", b2luigi.get_setting("my_missing_setting", "default"))
+
+            self.assertEqual(json_load.call_count, 1)
+
+        # Modifying the returned value does not change the cached settings
+        b2luigi.get_setting("my_list_setting").append(3)
+        self.assertEqual([1, 2], b2luigi.get_setting("my_list_setting"))
+
+    def test_settings_file_is_reloaded_on_change(self):
+        with open("settings.json", "w") as f:
+            json.dump({"my_setting": "my file value"}, f)
+
+        self.assertEqual("my file value", b2luigi.get_setting("my_setting"))
+
+        with open("settings.json", "w") as f:
+            json.dump({"my_setting": "my new file value"}, f)
+        # make sure the modification time differs even on file systems with a coarse resolution
+        stat_result = os.stat("settings.json")
+        os.utime("settings.json", ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 10**9))
+
+        self.assertEqual("my new file value", b2luigi.get_setting("my_setting"))
+
+        os.remove("settings.json")
+        self.assertRaises(ValueError, b2luigi.get_setting, "my_setting")
+
+        settings._clear_settings_file_cache()
+        self.assertFalse(settings._settings_file_cache)
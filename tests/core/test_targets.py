@@ -0,0 +1,83 @@
+import os
+from unittest import mock
+
+from ..helpers import B2LuigiTestCase
+
+import b2luigi
+from b2luigi.core import targets
+
+
+class TargetExistenceCacheTestCase(B2LuigiTestCase):
+    def setUp(self):
+        super().setUp()
+
+        targets._target_existence_cache.clear()
+        b2luigi.set_setting("cache_target_existence", True)
+
+    def tearDown(self):
+        b2luigi.clear_setting("cache_target_existence")
+        targets._target_existence_cache.clear()
+
+        super().tearDown()
+
+    def test_single_listing_per_folder(self):
+        os.makedirs("some_folder")
+        for file_name in ["a", "b"]:
+            with open(os.path.join("some_folder", file_name), "w") as f:
+                f.write("Test")
+
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            self.assertTrue(targets.CachedLocalTarget("some_folder/a").exists())
+            self.assertTrue(targets.CachedLocalTarget("some_folder/b").exists())
+            self.assertFalse(targets.CachedLocalTarget("some_folder/c").exists())
+            self.assertFalse(targets.CachedLocalTarget("missing_folder/a").exists())
+            self.assertFalse(targets.CachedLocalTarget("missing_folder/b").exists())
+
+            self.assertEqual(scandir.call_count, 2)
+
+    def test_invalidation(self):
+        target = targets.CachedLocalTarget("some_folder/a")
+        self.assertFalse(target.exists())
+
+        target.makedirs()
+        self.assertTrue(targets.CachedLocalTarget("some_folder").exists())
+        self.assertFalse(target.exists())
+
+        with target.temporary_path() as temporary_path:
+            with open(temporary_path, "w") as f:
+                f.write("Test")
+        self.assertTrue(target.exists())
+
+        target.move("some_folder/b")
+        self.assertFalse(target.exists())
+        self.assertTrue(targets.CachedLocalTarget("some_folder/b").exists())
+
+        targets.CachedLocalTarget("some_folder/b").remove()
+        self.assertFalse(targets.CachedLocalTarget("some_folder/b").exists())
+
+    def test_task_outputs(self):
+        class CachedTask(b2luigi.Task):
+            some_parameter = b2luigi.IntParameter()
+
+            def output(self):
+                yield self.add_to_output("test.txt")
+
+            def run(self):
+                # not using any b2luigi functionality, so the cache is not invalidated during the run
+                os.makedirs(os.path.dirname(self.get_output_file_name("test.txt")))
+                with open(self.get_output_file_name("test.txt"), "w") as f:
+                    f.write("Test")
+
+        b2luigi.set_setting("result_dir", os.path.join(self.test_dir, "results"))
+        task = CachedTask(some_parameter=1)
+        self.assertIsInstance(task._get_output_target("test.txt"), targets.CachedLocalTarget)
+        self.assertFalse(task.complete())
+
+        b2luigi.build([task], local_scheduler=True, log_level="ERROR")
+
+        self.assertTrue(os.path.exists(task.get_output_file_name("test.txt")))
+        self.assertTrue(task.complete())
+
+        b2luigi.clear_setting("cache_target_existence")
+        self.assertNotIsInstance(CachedTask(some_parameter=2)._get_output_target("test.txt"),
+                                 targets.CachedLocalTarget)
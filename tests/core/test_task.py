@@ -76,3 +76,86 @@ class TaskTestCase(B2LuigiTestCase):
 
         for i in range(100):
             self.assertIn(f"results/some_parameter={i}/file_a", input_file_names)
+
+    def test_output_caching(self):
+        class TaskA(b2luigi.Task):
+            some_parameter = b2luigi.IntParameter()
+            output_calls = 0
+
+            def output(self):
+                TaskA.output_calls += 1
+                yield self.add_to_output("file_a")
+                yield self.add_to_output("file_b")
+
+        task = TaskA(some_parameter=1)
+
+        file_name = task.get_output_file_name("file_a")
+        self.assertIs(task._get_output_target("file_a"), task._get_output_target("file_a"))
+        self.assertEqual(task.get_output_file_name("file_a"), file_name)
+        self.assertIn("file_b", task.get_output_file_name("file_b"))
+        self.assertEqual(TaskA.output_calls, 1)
+
+        class TaskB(TaskA):
+            cache_output_targets = False
+
+        task = TaskB(some_parameter=1)
+        TaskA.output_calls = 0
+
+        task.get_output_file_name("file_a")
+        task.get_output_file_name("file_a")
+        self.assertEqual(TaskA.output_calls, 2)
+
+    def test_input_caching(self):
+        class TaskA(b2luigi.Task):
+            some_parameter = b2luigi.IntParameter()
+
+            def output(self):
+                yield self.add_to_output("file_a")
+                yield self.add_to_output("file_b")
+
+        class TaskB(b2luigi.Task):
+            input_calls = 0
+
+            def requires(self):
+                for i in range(10):
+                    yield self.clone(TaskA, some_parameter=i)
+
+            def input(self):
+                TaskB.input_calls += 1
+                return super().input()
+
+        task = TaskB()
+
+        file_names = task.get_input_file_names("file_a")
+        self.assertEqual(len(file_names), 10)
+
+        # changing the result does not change the cache
+        file_names.append("something")
+        self.assertEqual(task.get_input_file_names("file_a"), file_names[:-1])
+        self.assertEqual(task.get_input_file_names()["file_b"], task.get_input_file_names("file_b"))
+        self.assertEqual(TaskB.input_calls, 1)
+
+        self.assertEqual(list(task.iter_input_file_names("file_b")), task.get_input_file_names("file_b"))
+        self.assertEqual(list(task.iter_input_file_names("file_c")), [])
+        self.assertEqual(TaskB.input_calls, 1)
+
+        # the iterator also works without the cache
+        task._use_input_file_names_cache = False
+        self.assertEqual(list(task.iter_input_file_names("file_a")), file_names[:-1])
+        self.assertEqual(list(task.iter_input_file_names("file_c")), [])
+        self.assertEqual(task.get_input_file_names("file_a"), file_names[:-1])
+        self.assertEqual(TaskB.input_calls, 4)
+
+    def test_input_caching_without_requirements(self):
+        class TaskWithoutRequirements(b2luigi.Task):
+            pass
+
+        for use_cache in [True, False]:
+            task = TaskWithoutRequirements()
+            task._use_input_file_names_cache = use_cache
+
+            # asking twice also uses the cached result (if turned on)
+            for _ in range(2):
+                self.assertEqual(task.get_input_file_names(), {})
+                self.assertEqual(task.get_input_file_names("file_a"), [])
+                self.assertEqual(list(task.iter_input_file_names("file_a")), [])
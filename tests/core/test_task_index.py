@@ -0,0 +1,114 @@
+import os
+
+from ..helpers import B2LuigiTestCase
+
+import b2luigi
+from b2luigi.core import task_index, utils
+
+
+class TaskIndexTestCase(B2LuigiTestCase):
+    def setUp(self):
+        super().setUp()
+
+        b2luigi.set_setting("result_dir", os.path.join(self.test_dir, "results"))
+        b2luigi.set_setting("task_index", os.path.join(self.test_dir, "index", "task_index.sqlite"))
+
+        self.complete_calls = 0
+        test_case = self
+
+        class IndexedTask(b2luigi.Task):
+            some_parameter = b2luigi.IntParameter()
+
+            def output(self):
+                yield self.add_to_output("a.txt")
+                yield self.add_to_output("b.txt")
+
+            def complete(self):
+                test_case.complete_calls += 1
+                return super().complete()
+
+            def run(self):
+                for key in ["a.txt", "b.txt"]:
+                    with open(self.get_output_file_name(key), "w") as f:
+                        f.write("Test")
+
+        self.task = IndexedTask(some_parameter=1)
+
+    def tearDown(self):
+        b2luigi.clear_setting("task_index")
+        b2luigi.clear_setting("task_index_validation")
+        self._close_task_indices()
+
+        super().tearDown()
+
+    @staticmethod
+    def _close_task_indices():
+        for index in task_index._task_indices.values():
+            index.close()
+        task_index._task_indices.clear()
+
+    def _run_task(self):
+        utils.create_output_dirs(self.task)
+        self.task.run()
+
+    def test_check_complete(self):
+        index = task_index.get_task_index()
+        self.assertIs(index, task_index.get_task_index())
+
+        self.assertFalse(task_index.check_complete(self.task))
+        self.assertEqual(len(index), 0)
+
+        self._run_task()
+        self.assertTrue(task_index.check_complete(self.task))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(self.complete_calls, 2)
+
+        # Now the index is used
+        self.assertTrue(task_index.check_complete(self.task))
+        self.assertEqual(self.complete_calls, 2)
+
+        entry = index.get(self.task.task_id)
+        self.assertEqual(entry["parameters"], {"some_parameter": "1"})
+        self.assertEqual([output[:2] for output in entry["outputs"]],
+                         [["a.txt", self.task.get_output_file_name("a.txt")],
+                          ["b.txt", self.task.get_output_file_name("b.txt")]])
+
+    def test_lazy_validation(self):
+        self._run_task()
+        task_index.record_complete_task(self.task)
+
+        with open(self.task.get_output_file_name("a.txt"), "w") as f:
+            f.write("Changed")
+
+        index = task_index.get_task_index()
+        self.assertFalse(index.is_complete(self.task))
+        self.assertEqual(len(index), 0)
+
+        self.assertTrue(index.record(self.task))
+        os.remove(self.task.get_output_file_name("b.txt"))
+        self.assertFalse(task_index.check_complete(self.task))
+        self.assertFalse(index.record(self.task))
+
+    def test_no_validation(self):
+        b2luigi.set_setting("task_index_validation", "none")
+
+        self._run_task()
+        task_index.record_complete_task(self.task)
+        os.remove(self.task.get_output_file_name("b.txt"))
+
+        self.assertTrue(task_index.get_task_index().is_complete(self.task))
+
+    def test_persistence(self):
+        self._run_task()
+        task_index.record_complete_task(self.task)
+        self._close_task_indices()
+
+        self.assertTrue(task_index.get_task_index().is_complete(self.task))
+
+        output_files = utils.get_all_output_files_in_tree(self.task)
+        self.assertEqual(output_files["a.txt"], [dict(exists=True, parameters={"some_parameter": "1"},
+                                                      file_name=self.task.get_output_file_name("a.txt"))])
+        self.assertEqual(self.complete_calls, 0)
+
+    def test_invalid_validation_mode(self):
+        self.assertRaises(ValueError, task_index.TaskIndex, "task_index.sqlite", validation="something")
@@ -1,7 +1,19 @@
+import argparse
+import collections
+import os
 from unittest import TestCase
+from unittest.mock import patch
 
+import luigi.scheduler
+import luigi.worker
+
+import b2luigi
+from b2luigi.batch.workers import SendJobWorkerSchedulerFactory
+from b2luigi.cli import runner
 from b2luigi.core import utils
 
+from ..helpers import B2LuigiTestCase
+
 
 class ProductDictTestCase(TestCase):
     def test_basic_usage(self):
@@ -145,3 +157,213 @@ class FlattenTestCase(TestCase):
         self.assertEqual(outputs["key1"], ["value1", "repeated"])
         self.assertIn("key2", outputs)
         self.assertEqual(outputs["key2"], ["value2"])
+
+    def test_deep_nesting(self):
+        inputs = {"key": "value"}
+        for _ in range(10000):
+            inputs = [inputs, "other"]
+
+        outputs = utils.flatten_to_list_of_dicts(inputs)
+        self.assertEqual(outputs["key"], ["value"])
+        self.assertEqual(len(outputs["other"]), 10000)
+
+    def test_iter_flatten(self):
+        inputs = [1, [2, (3, "four")], iter([{"five": 5}]), [[]], 6]
+
+        self.assertEqual(list(utils._iter_flatten(inputs)), [1, 2, 3, "four", {"five": 5}, 6])
+        self.assertEqual(list(utils._iter_flatten("string")), ["string"])
+        self.assertEqual(list(utils._iter_flatten(7)), [7])
+
+
+class TaskIteratorTestCase(TestCase):
+    def setUp(self):
+        self.deps_calls = collections.Counter()
+        self.complete_calls = collections.Counter()
+
+        test_case = self
+
+        class CountingTask(b2luigi.Task):
+            level = b2luigi.IntParameter()
+            index = b2luigi.IntParameter(default=0)
+            width = b2luigi.IntParameter(default=2)
+            complete_below = b2luigi.IntParameter(default=-1, significant=False)
+
+            def requires(self):
+                if self.level == 0:
+                    return
+                # every task of one level requires all tasks of the level below
+                for index in range(self.width):
+                    yield self.clone(level=self.level - 1, index=index)
+
+            def deps(self):
+                test_case.deps_calls[self.task_id] += 1
+                return super().deps()
+
+            def complete(self):
+                test_case.complete_calls[self.task_id] += 1
+                return self.level < self.complete_below
+
+        self.task_class = CountingTask
+
+    def test_diamond_graph(self):
+        tasks = list(utils.task_iterator(self.task_class(level=10)))
+
+        self.assertEqual(len(tasks), 1 + 10 * 2)
+        self.assertEqual(len({task.task_id for task in tasks}), len(tasks))
+        self.assertEqual(max(self.deps_calls.values()), 1)
+
+        # depth first order
+        self.assertEqual(tasks[0].level, 10)
+        self.assertEqual([task.level for task in tasks[1:11]], list(reversed(range(10))))
+
+    def test_only_non_complete(self):
+        visited = set()
+        completeness = {}
+        tasks = list(utils.task_iterator(self.task_class(level=10, complete_below=5), only_non_complete=True,
+                                         visited=visited, completeness=completeness))
+
+        self.assertEqual(len(tasks), 1 + 5 * 2)
+        self.assertTrue(all(task.level >= 5 for task in tasks))
+        self.assertEqual(max(self.complete_calls.values()), 1)
+        self.assertEqual(len(completeness), 1 + 6 * 2)
+
+        # A second root sharing the same sub graph is not traversed again
+        tasks = list(utils.task_iterator(self.task_class(level=11, complete_below=5), only_non_complete=True,
+                                         visited=visited, completeness=completeness))
+        self.assertEqual([(task.level, task.index) for task in tasks], [(11, 0), (10, 1)])
+        self.assertEqual(max(self.complete_calls.values()), 1)
+
+    def test_check_complete_in_parallel(self):
+        checked_tasks = {}
+        completeness = utils.check_complete_in_parallel([self.task_class(level=10, complete_below=5)], threads=4,
+                                                        checked_tasks=checked_tasks)
+
+        # the dependencies of complete tasks are not checked
+        self.assertEqual(len(completeness), 1 + 6 * 2)
+        self.assertEqual(set(completeness), set(checked_tasks))
+        self.assertEqual(max(self.complete_calls.values()), 1)
+        self.assertEqual(sum(completeness.values()), 2)
+
+        # luigi can reuse the results of the complete tasks
+        self.complete_calls.clear()
+        utils.remember_completeness(completeness)
+        self.addCleanup(utils.forget_completeness)
+
+        worker = SendJobWorkerSchedulerFactory().create_worker(scheduler=luigi.scheduler.Scheduler(),
+                                                               worker_processes=1)
+        for task in checked_tasks.values():
+            self.assertEqual(luigi.worker.check_complete_cached(task, worker._task_completion_cache),
+                             completeness[task.task_id])
+            # the tasks themselves are not changed, so they can still be sent to other processes
+            self.assertNotIn("complete", vars(task))
+        # non-complete tasks are checked again, as they may have run in between
+        self.assertEqual(sum(self.complete_calls.values()), 1 + 5 * 2)
+        self.assertEqual(set(self.complete_calls), {task_id for task_id, is_complete in completeness.items()
+                                                    if not is_complete})
+
+        # without a completion cache (luigi before 3.1), all tasks are checked again
+        original_init = luigi.worker.Worker.__init__
+
+        def init_without_cache(worker, *args, **kwargs):
+            original_init(worker, *args, **kwargs)
+            del worker._task_completion_cache
+
+        with patch.object(luigi.worker.Worker, "__init__", init_without_cache):
+            worker = SendJobWorkerSchedulerFactory().create_worker(scheduler=luigi.scheduler.Scheduler(),
+                                                                   worker_processes=1)
+        self.assertFalse(hasattr(worker, "_task_completion_cache"))
+
+        # the results are forgotten after running luigi
+        cli_args = argparse.Namespace(complete_check_threads=2, scheduler_host="", scheduler_port=0)
+        with patch("luigi.build") as build:
+            runner.run_luigi([self.task_class(level=10, complete_below=5)], cli_args, {})
+        build.assert_called_once()
+        self.assertFalse(utils.get_known_complete_task_ids())
+
+        # A given completeness is reused
+        self.complete_calls.clear()
+        completeness = {self.task_class(level=10).task_id: True}
+        utils.check_complete_in_parallel([self.task_class(level=10)], threads=4, completeness=completeness)
+        self.assertFalse(self.complete_calls)
+
+    def test_deep_chain(self):
+        tasks = list(utils.task_iterator(self.task_class(level=5000, width=1)))
+        self.assertEqual(len(tasks), 5001)
+
+
+class TaskDescriptionTestCase(B2LuigiTestCase):
+    def test_write_and_create_task(self):
+        class DescribedTask(b2luigi.Task):
+            some_parameter = b2luigi.IntParameter()
+            some_list_parameter = b2luigi.ListParameter(hashed=True)
+            insignificant_parameter = b2luigi.Parameter(significant=False, default="default")
+
+        task = DescribedTask(some_parameter=3, some_list_parameter=[1, "a/b"], insignificant_parameter="other")
+        task_description_file = utils.write_task_description(task)
+
+        self.assertEqual(task_description_file, utils.get_task_description_file(task))
+        self.assertTrue(os.path.exists(task_description_file))
+
+        rebuilt_task = utils.create_task_from_description(task_description_file)
+        self.assertEqual(rebuilt_task.task_id, task.task_id)
+        self.assertEqual(rebuilt_task.insignificant_parameter, "other")
+
+    def test_batch_worker_task(self):
+        class SearchedTask(b2luigi.Task):
+            some_parameter = b2luigi.IntParameter()
+
+        class SearchedRootTask(b2luigi.WrapperTask):
+            def requires(self):
+                for i in range(3):
+                    yield SearchedTask(some_parameter=i)
+
+        task = SearchedTask(some_parameter=2)
+        task_description_file = utils.write_task_description(task)
+
+        cli_args = argparse.Namespace(task_id=task.task_id, task_file=task_description_file)
+        self.assertEqual(runner._get_batch_worker_task([], cli_args).task_id, task.task_id)
+
+        # Fall back to searching the task graph
+        cli_args = argparse.Namespace(task_id=task.task_id, task_file="not_existing.json")
+        self.assertEqual(runner._get_batch_worker_task([SearchedRootTask()], cli_args).task_id, task.task_id)
+
+        cli_args = argparse.Namespace(task_id="SearchedTask_not_existing", task_file="")
+        self.assertRaises(ValueError, runner._get_batch_worker_task, [SearchedRootTask()], cli_args)
+
+
+class FilterFromParamsTestCase(TestCase):
+    @staticmethod
+    def _filter_by_cross_product(output_files, **kwargs):
+        # The straight forward implementation, which is used as reference
+        file_names = []
+        for kwargs in utils.product_dict(**utils.fill_kwargs_with_lists(**kwargs)):
+            for output_dict in output_files:
+                parameters = output_dict["parameters"]
+                if all(key not in parameters or str(parameters[key]) == str(value) for key, value in kwargs.items()):
+                    file_names.append(output_dict)
+
+        return {x["file_name"]: x for x in file_names}
+
+    def test_filter(self):
+        output_files = []
+        for a in range(5):
+            for b in ["x", "y", "z"]:
+                output_files.append(dict(parameters={"a": str(a), "b": b}, file_name=f"a={a}/b={b}/file.txt"))
+                output_files.append(dict(parameters={"a": str(a)}, file_name=f"a={a}/file.txt"))
+
+        index = utils.OutputParameterIndex(output_files)
+
+        filters = [
+            dict(a=1), dict(a=[1, 2]), dict(a="1", b="y"), dict(a=[1, 3], b=["x", "z"]),
+            dict(b="x"), dict(c=1), dict(a=7), dict(a=[]), dict(a=None), dict(a=[1, 2], b=[]),
+        ]
+        for kwargs in filters:
+            expected = self._filter_by_cross_product(output_files, **kwargs)
+
+            for output_files_or_index in [output_files, index]:
+                result = list(utils.filter_from_params(output_files_or_index, **kwargs))
+                self.assertEqual({x["file_name"]: x for x in result}, expected, kwargs)
+                self.assertEqual(len(result), len(expected), kwargs)
+
+        self.assertIs(utils.filter_from_params(output_files), output_files)
+        self.assertEqual(len(utils.filter_from_params(index)), len(output_files))